@@ -10,7 +10,7 @@ import ActiveBookingsModal from './components/ActiveBookingsModal';
 import ExchangeRateModal from './components/ExchangeRateModal'; 
 import ExportModal from './components/ExportModal'; 
 import { useInventory } from './hooks/useInventory';
-import type { Product } from './types';
+import type { Product, FacetNode } from './types';
 
 function App() {
   // --- UI State ---
@@ -19,7 +19,10 @@ function App() {
   const [isSidebarOpen, setSidebarOpen] = useState(false);
 
   // --- Data & Business Logic (via Hook) ---
-  const { products, rates, loading, fetchProducts } = useInventory();
+  const { products, rates, loading, fetchProducts, searchProducts, fetchInventoryTree } = useInventory();
+  const [searchResults, setSearchResults] = useState<Product[] | null>(null);
+  const [searchTruncated, setSearchTruncated] = useState(false);
+  const [facetTree, setFacetTree] = useState<FacetNode[] | null>(null);
 
   // --- Modal States ---
   const [selectedProduct, setSelectedProduct] = useState<Product | null>(null);
@@ -39,6 +42,37 @@ function App() {
     fetchProducts();
   }, [fetchProducts]);
 
+  // Debounced server search; the tree falls back to local filtering until results arrive.
+  // Words under 3 characters can't use the server's trigram index, so those stay local.
+  useEffect(() => {
+    setSearchResults(null);
+    setSearchTruncated(false);
+    const longestWord = Math.max(0, ...searchQuery.split(/[\s,]+/).map(w => w.length));
+    if (longestWord < 3) return;
+    let cancelled = false;
+    const timer = setTimeout(() => {
+      searchProducts(searchQuery)
+        .then(result => {
+          if (cancelled) return;
+          setSearchResults(result.products);
+          setSearchTruncated(result.truncated || result.products.length < result.total);
+        })
+        .catch(err => console.error("Search Error:", err));
+    }, 300);
+    return () => { cancelled = true; clearTimeout(timer); };
+  }, [searchQuery, searchProducts]);
+
+  // Group totals for the BRAND/CATEGORY tabs; refetched when the tab or the catalog changes
+  useEffect(() => {
+    setFacetTree(null);
+    if (activeTab !== 'BRAND' && activeTab !== 'CATEGORY') return;
+    let cancelled = false;
+    fetchInventoryTree(activeTab === 'BRAND' ? 'brand' : 'category')
+      .then(tree => { if (!cancelled) setFacetTree(tree); })
+      .catch(err => console.error("Inventory Tree Error:", err));
+    return () => { cancelled = true; };
+  }, [activeTab, products, fetchInventoryTree]);
+
   // --- Handlers ---
 
   const handleEditClick = (product: Product) => {
@@ -78,6 +112,9 @@ function App() {
         >
             <InventoryTree 
                 products={products}
+                searchResults={searchResults}
+                searchTruncated={searchTruncated}
+                facetTree={facetTree}
                 activeTab={activeTab}
                 searchQuery={searchQuery}
                 loading={loading}
@@ -122,7 +159,6 @@ function App() {
             isOpen={isImportOpen}
             onClose={() => setIsImportOpen(false)}
             onSuccess={handleRefresh}
-            existingProducts={products} 
         />
         
         <DiscountManagerModal 
@@ -1,7 +1,7 @@
 import React, { useState, useEffect } from 'react';
 import { X, Calendar, User, Loader2, Clock } from 'lucide-react';
 import axios from 'axios';
-import type { InventoryItem, Product } from '../types';
+import type { InventoryItem } from '../types';
 
 interface Props {
   isOpen: boolean;
@@ -26,24 +26,11 @@ const ActiveBookingsModal: React.FC<Props> = ({ isOpen, onClose, onSuccess }) =>
   const fetchBookings = async () => {
       setLoading(true);
       try {
-          const res = await axios.get('http://127.0.0.1:5001/edievo-project/asia-southeast2/get_all_products');
-          const allProducts = res.data.data;
-          const bookedProducts = allProducts.filter((p: Product) => p.booked_stock > 0);
-          
-          let allBookedItems: ExtendedInventoryItem[] = [];
-
-          for (const p of bookedProducts) {
-              const invRes = await axios.get(`http://127.0.0.1:5001/edievo-project/asia-southeast2/get_product_inventory?product_id=${p.id}`);
-              const items = invRes.data.data.filter((i: InventoryItem) => i.status === 'BOOKED');
-              
-              const enrichedItems = items.map((i: InventoryItem) => ({
-                  ...i,
-                  product_category: p.category,
-                  product_code: p.code
-              }));
-              
-              allBookedItems = [...allBookedItems, ...enrichedItems];
-          }
+          // Server joins BOOKED items with their products, sorted by expiry
+          const res = await axios.get('http://127.0.0.1:5001/edievo-project/asia-southeast2/get_active_bookings', {
+              params: { order: 'asc' }
+          });
+          const allBookedItems: ExtendedInventoryItem[] = res.data.data;
           
           setBookings(allBookedItems);
       } catch (err) {
@@ -17,6 +17,8 @@ const DiscountManagerModal: React.FC<Props> = ({ isOpen, onClose, onSuccess }) =
   
   const [editingId, setEditingId] = useState<string | null>(null);
   const [formData, setFormData] = useState<Partial<DiscountRule>>({});
+  // Background job that rewrites the rule on every product using it
+  const [jobStatus, setJobStatus] = useState<string | null>(null);
 
   useEffect(() => {
     if (isOpen) {
@@ -53,13 +55,17 @@ const DiscountManagerModal: React.FC<Props> = ({ isOpen, onClose, onSuccess }) =
     
     setActionLoading('SAVE');
     try {
-        await axios.post('http://127.0.0.1:5001/edievo-project/asia-southeast2/manage_discount', {
+        const res = await axios.post('http://127.0.0.1:5001/edievo-project/asia-southeast2/manage_discount', {
             mode: 'EDIT', 
             discount: formData
         });
         await fetchDiscounts();
-        onSuccess(); 
         setEditingId(null);
+        if (res.data.job_id) {
+            pollJob(res.data.job_id);
+        } else {
+            onSuccess();
+        }
     } catch (err) {
         console.error(err);
         let msg = "Failed to save discount";
@@ -72,6 +78,28 @@ const DiscountManagerModal: React.FC<Props> = ({ isOpen, onClose, onSuccess }) =
     }
   };
 
+  const pollJob = (jobId: string) => {
+    setJobStatus('Updating products...');
+    const timer = window.setInterval(async () => {
+        try {
+            const res = await axios.get('http://127.0.0.1:5001/edievo-project/asia-southeast2/get_discount_job', { params: { job_id: jobId } });
+            const job = res.data.data;
+            if (job.status === 'DONE') {
+                window.clearInterval(timer);
+                setJobStatus(null);
+                onSuccess();
+            } else if (job.status === 'FAILED') {
+                window.clearInterval(timer);
+                setJobStatus(`Product update failed: ${job.error || 'unknown error'}`);
+            } else {
+                setJobStatus(`Updating products... (${job.updated} updated)`);
+            }
+        } catch (err) {
+            console.error(err);
+        }
+    }, 2000);
+  };
+
   const handleDelete = async (id: string) => {
     if (!window.confirm("Delete this discount rule?")) return;
     setActionLoading(id);
@@ -112,6 +140,11 @@ const DiscountManagerModal: React.FC<Props> = ({ isOpen, onClose, onSuccess }) =
         </div>
 
         <div className="p-4 overflow-y-auto flex-grow bg-gray-50 space-y-3">
+            {jobStatus && (
+                <div className="flex items-center gap-2 text-xs font-bold text-primary bg-primary/5 border border-primary/20 p-2">
+                    <Loader2 size={12} className="animate-spin" /> {jobStatus}
+                </div>
+            )}
              {!editingId && (
                 <button 
                     onClick={() => handleEdit()}
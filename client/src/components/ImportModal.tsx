@@ -1,32 +1,31 @@
 import React, { useState, useRef, useEffect, useCallback } from 'react';
-import Papa from 'papaparse';
-import * as XLSX from 'xlsx';
 import axios from 'axios';
+import { v4 as uuidv4 } from 'uuid';
 import { X, Upload, FileSpreadsheet, CheckCircle, Loader2 } from 'lucide-react';
-import type { Product } from '../types';
 
-// Use 'unknown' to satisfy linter
-interface ImportRow {
-  [key: string]: unknown;
-}
+const API_BASE = 'http://127.0.0.1:5001/edievo-project/asia-southeast2';
 
 interface Props {
   isOpen: boolean;
   onClose: () => void;
   onSuccess: () => void;
-  existingProducts: Product[];
 }
 
-const ImportModal: React.FC<Props> = ({ isOpen, onClose, onSuccess, existingProducts }) => {
+interface RowError {
+  row: number;
+  errors: string[];
+}
+
+const ImportModal: React.FC<Props> = ({ isOpen, onClose, onSuccess }) => {
   const [step, setStep] = useState<'UPLOAD' | 'CONFIRM' | 'PROCESSING' | 'SUCCESS'>('UPLOAD');
   const [stats, setStats] = useState({ totalRows: 0, newItems: 0, brands: 0, categories: 0, duplicates: 0, updates: 0 });
-  const [parsedData, setParsedData] = useState<ImportRow[]>([]);
+  const [selectedFile, setSelectedFile] = useState<File | null>(null);
   const [logs, setLogs] = useState<string[]>([]);
   const fileInputRef = useRef<HTMLInputElement>(null);
 
   const reset = useCallback(() => {
     setStep('UPLOAD');
-    setParsedData([]);
+    setSelectedFile(null);
     setLogs([]);
     setStats({ totalRows: 0, newItems: 0, brands: 0, categories: 0, duplicates: 0, updates: 0 });
     if (fileInputRef.current) {
@@ -40,243 +39,77 @@ const ImportModal: React.FC<Props> = ({ isOpen, onClose, onSuccess, existingProd
 
   if (!isOpen) return null;
 
-  const handleFileSelect = (e: React.ChangeEvent<HTMLInputElement>) => {
-    if (e.target.files && e.target.files[0]) {
-      const file = e.target.files[0];
-      const ext = file.name.split('.').pop()?.toLowerCase();
-
-      if (ext === 'csv') {
-        parseCSV(file);
-      } else if (ext === 'xlsx' || ext === 'xls') {
-        parseExcel(file);
-      } else {
-        alert("Please upload a .csv or .xlsx file");
-      }
-    }
-  };
-
-  const getValue = (row: ImportRow, ...keys: string[]): unknown => {
-    const rowKeys = Object.keys(row);
-    for (const key of keys) {
-        if (row[key] !== undefined) return row[key];
-        
-        const foundKey = rowKeys.find(k => k.trim().toLowerCase() === key.trim().toLowerCase());
-        if (foundKey && row[foundKey] !== undefined) return row[foundKey];
-    }
-    return undefined;
+  const buildForm = (file: File, extra: Record<string, string>) => {
+    const form = new FormData();
+    form.append('file', file);
+    Object.entries(extra).forEach(([k, v]) => form.append(k, v));
+    return form;
   };
 
-  const parseCSV = (file: File) => {
-    Papa.parse<ImportRow>(file, {
-      header: true,
-      skipEmptyLines: true,
-      // eslint-disable-next-line @typescript-eslint/no-explicit-any
-      complete: (results: any) => processPreview(results.data),
-      error: (error: Error) => alert("Error parsing CSV: " + error.message)
-    });
+  const logRowErrors = (errors: RowError[]) => {
+    if (!errors || errors.length === 0) return;
+    setLogs(prev => [...prev, ...errors.map(e => `Row ${e.row}: ${e.errors.join(', ')}`)]);
   };
 
-  const parseExcel = (file: File) => {
-    const reader = new FileReader();
-    reader.readAsArrayBuffer(file);
-    
-    reader.onload = (e) => {
-      try {
-        const data = e.target?.result;
-        const workbook = XLSX.read(data, { type: 'array' });
-        const sheetName = workbook.SheetNames[0]; 
-        const sheet = workbook.Sheets[sheetName];
-        const json = XLSX.utils.sheet_to_json<ImportRow>(sheet);
-        processPreview(json);
-      } catch (err) {
-        console.error(err);
-        alert("Error parsing Excel file");
-      }
-    };
-  };
+  const handleFileSelect = async (e: React.ChangeEvent<HTMLInputElement>) => {
+    if (!e.target.files || !e.target.files[0]) return;
+    const file = e.target.files[0];
+    const ext = file.name.split('.').pop()?.toLowerCase();
 
-  const processPreview = (rows: ImportRow[]) => {
-    const existingIds = new Set(existingProducts.map(p => p.id));
-    const existingNames = new Set(existingProducts.map(p => `${p.brand?.trim().toUpperCase()}-${p.collection?.trim().toUpperCase()}`));
-    
-    const existingBrandsSet = new Set(existingProducts.map(p => p.brand?.trim().toUpperCase()).filter(Boolean));
-    const existingCategoriesSet = new Set(existingProducts.map(p => p.category?.trim().toUpperCase()).filter(Boolean));
-
-    const updateRows: ImportRow[] = [];
-    const insertRows: ImportRow[] = [];
-    let duplicateCount = 0;
-
-    rows.forEach(row => {
-        const brand = String(getValue(row, 'brand', 'Brand') || '').trim();
-        const collection = String(getValue(row, 'collection name', 'Collection', 'collection') || '').trim();
-        const systemId = String(getValue(row, 'system id', 'System ID') || '').trim();
-        
-        if (!brand && !collection) return;
-
-        // 1. IS UPDATE?
-        if (systemId && existingIds.has(systemId)) {
-            updateRows.push(row);
-            return;
-        }
-
-        // 2. IS DUPLICATE?
-        const key = `${brand.toUpperCase()}-${collection.toUpperCase()}`;
-        if (existingNames.has(key)) {
-            duplicateCount++;
-        } else {
-            // 3. IS NEW ITEM
-            insertRows.push(row);
-        }
-    });
-
-    const allActionableRows = [...updateRows, ...insertRows];
-    const newBrandsFound = new Set<string>();
-    const newCategoriesFound = new Set<string>();
-
-    allActionableRows.forEach(row => {
-        const brand = String(getValue(row, 'brand', 'Brand') || '').trim();
-        const category = String(getValue(row, 'category', 'Category') || '').trim();
-
-        if (brand && !existingBrandsSet.has(brand.toUpperCase())) {
-            newBrandsFound.add(brand.toUpperCase());
-        }
-
-        if (category && !existingCategoriesSet.has(category.toUpperCase())) {
-            newCategoriesFound.add(category.toUpperCase());
-        }
-    });
-    
-    setStats({
-      totalRows: updateRows.length + insertRows.length,
-      newItems: insertRows.length,
-      duplicates: duplicateCount,
-      updates: updateRows.length,
-      brands: newBrandsFound.size,
-      categories: newCategoriesFound.size
-    });
-
-    setParsedData([...updateRows, ...insertRows]);
-    setStep('CONFIRM');
-  };
-
-  const cleanPrice = (val: unknown): number => {
-    if (!val) return 0;
-    const clean = String(val).replace(/[^0-9.]/g, '');
-    return parseInt(clean, 10) || 0;
-  };
+    if (ext === 'xls') {
+      alert("Legacy .xls files are not supported. Please save the file as .xlsx and try again.");
+      return;
+    }
+    if (ext !== 'csv' && ext !== 'xlsx') {
+      alert("Please upload a .csv or .xlsx file");
+      return;
+    }
 
-  const parseDiscounts = (val: unknown) => {
-    if (!val) return [];
-    const parts = String(val).replace(/%/g, '').split('+');
-    return parts.map(v => ({
-        name: `${v.trim()}%`,
-        value: parseFloat(v.trim())
-    })).filter(d => !isNaN(d.value) && d.value > 0);
+    // Dry run: the server parses and validates the file without writing anything
+    try {
+      setSelectedFile(file);
+      const res = await axios.post(`${API_BASE}/import_products_file`, buildForm(file, { dry_run: '1' }));
+      const s = res.data.stats;
+      setStats({
+        totalRows: s.total_rows,
+        newItems: s.new_items,
+        duplicates: s.duplicates,
+        updates: s.updates,
+        brands: s.brands,
+        categories: s.categories
+      });
+      logRowErrors(res.data.errors);
+      setStep('CONFIRM');
+    } catch (err) {
+      console.error(err);
+      alert("Error analyzing file");
+      reset();
+    }
   };
 
   const handleImport = async () => {
-    if (parsedData.length === 0) return; 
+    if (!selectedFile || stats.totalRows === 0) return;
 
     setStep('PROCESSING');
-    setLogs(prev => [...prev, "Analyzing schema..."]);
+    setLogs(prev => [...prev, "Uploading file..."]);
 
     try {
-      const productsPayload = parsedData.map(row => {
-        const isSmartSchema = getValue(row, 'retail price (eur)') !== undefined || getValue(row, 'not for sale') !== undefined;
-
-        let brand, category, collection, code, total_stock;
-        let priceIDR, priceEUR, priceUSD, nettPrice;
-        let isNFS, isUpcoming, eta;
-        let discounts;
-        let image_url, detail, dims, finish, location;
-        let systemId;
-
-        if (isSmartSchema) {
-            brand = String(getValue(row, 'brand') || '');
-            category = String(getValue(row, 'category') || '');
-            collection = String(getValue(row, 'collection name') || '');
-            code = String(getValue(row, 'manufacturer id') || '');
-            total_stock = parseInt(String(getValue(row, 'total qty') || '0'));
-
-            priceIDR = cleanPrice(getValue(row, 'retail price (idr)'));
-            priceEUR = cleanPrice(getValue(row, 'retail price (eur)'));
-            priceUSD = cleanPrice(getValue(row, 'retail price (usd)'));
-            nettPrice = cleanPrice(getValue(row, 'nett price (idr)'));
-
-            const nfsVal = String(getValue(row, 'not for sale') || '').toLowerCase();
-            isNFS = nfsVal.includes('not for sale') || nfsVal === 'true';
-
-            const upcomingVal = String(getValue(row, 'upcoming') || '').toLowerCase();
-            isUpcoming = upcomingVal.includes('upcoming') || upcomingVal === 'true';
-
-            eta = String(getValue(row, 'eta') || '');
-            discounts = parseDiscounts(getValue(row, 'discounts'));
-            
-            image_url = String(getValue(row, 'image file') || '');
-            detail = String(getValue(row, 'detail') || '');
-            dims = String(getValue(row, 'dimensions') || '');
-            finish = String(getValue(row, 'finishing') || '');
-            location = String(getValue(row, 'location') || '');
-            systemId = String(getValue(row, 'system id') || '');
-
-        } else {
-            brand = String(getValue(row, 'brand', 'Brand') || '');
-            category = String(getValue(row, 'category', 'Category') || '');
-            collection = String(getValue(row, 'collection', 'Collection') || '');
-            code = String(getValue(row, 'code', 'Code') || '');
-            total_stock = parseInt(String(getValue(row, 'quantity', 'qty') || '0'));
-
-            priceIDR = cleanPrice(getValue(row, 'retail price', 'retail_price_idr'));
-            priceEUR = cleanPrice(getValue(row, 'retail price in euro', 'retail_price_eur'));
-            priceUSD = cleanPrice(getValue(row, 'retail price in usd', 'retail_price_usd'));
-            nettPrice = cleanPrice(getValue(row, 'nett price', 'nett_price_idr'));
-
-            const rawStatus = String(getValue(row, 'status') || '').toUpperCase();
-            isNFS = rawStatus.includes('NOT FOR SALE') || rawStatus.includes('NFS');
-            isUpcoming = rawStatus.includes('UPCOMING');
-            eta = String(getValue(row, 'eta', 'arriving_eta') || '');
-
-            discounts = parseDiscounts(getValue(row, 'discount'));
-            
-            image_url = String(getValue(row, 'image') || '');
-            detail = String(getValue(row, 'detail', 'description') || '');
-            dims = String(getValue(row, 'size', 'dimensions') || '');
-            finish = String(getValue(row, 'finishing') || '');
-            location = String(getValue(row, 'location') || '');
-            systemId = ''; 
-        }
-        
-        return {
-          id: systemId,
-          brand: brand,
-          category: category,
-          collection: collection,
-          code: code,
-          image_url: image_url ? (image_url.includes('products/') ? image_url : `products/${image_url}`) : '',
-          total_stock: total_stock,
-          retail_price_idr: priceIDR,
-          retail_price_eur: priceEUR,
-          retail_price_usd: priceUSD,
-          nett_price_idr: nettPrice,
-          discounts: discounts,
-          detail: detail,
-          dimensions: dims,
-          finishing: finish,
-          is_not_for_sale: isNFS,
-          is_upcoming: isUpcoming,
-          upcoming_eta: eta,
-          location: location || 'Warehouse (Import)'
-        };
-      });
-
-      setLogs(prev => [...prev, `Mapped ${productsPayload.length} items. Sending to backend...`]);
+      // The server queues the import and answers with the job to poll
+      const res = await axios.post(`${API_BASE}/import_products_file`, buildForm(selectedFile, { job_id: uuidv4() }));
+      const job = await waitForImportJob(res.data.job_id);
 
-      const res = await axios.post('http://127.0.0.1:5001/edievo-project/asia-southeast2/bulk_import_products', {
-        products: productsPayload
-      });
-
-      if (res.data.success) {
+      if (job.status === 'FAILED') {
+        throw new Error(job.error || 'Import job failed');
+      }
+      if (job.success) {
         setStep('SUCCESS');
+      } else {
+        // Each product is all-or-nothing; report the ones that were not written
+        const failed: string[] = job.failed_products || [];
+        logRowErrors(job.errors);
+        setLogs(prev => [...prev, `Imported ${job.products_written} products. ${failed.length} failed: ${failed.join(', ')}`]);
+        alert("Some rows failed to import. Check logs.");
+        setStep('CONFIRM');
       }
 
     } catch (err) {
@@ -289,6 +122,17 @@ const ImportModal: React.FC<Props> = ({ isOpen, onClose, onSuccess, existingProd
     }
   };
 
+  // Polls the job document until the import finished, logging progress on the way
+  const waitForImportJob = async (jobId: string) => {
+    while (true) {
+      await new Promise(resolve => window.setTimeout(resolve, 1500));
+      const res = await axios.get(`${API_BASE}/get_import_status`, { params: { job_id: jobId } });
+      const job = res.data.data;
+      setLogs(prev => [...prev.filter(l => !l.startsWith('Progress:')), `Progress: ${job.rows_processed} rows read, ${job.products_written} products written`]);
+      if (job.status === 'DONE' || job.status === 'FAILED') return job;
+    }
+  };
+
   return (
     <div className="fixed inset-0 z-[70] flex items-center justify-center p-4">
       <div className="absolute inset-0 bg-black/50 backdrop-blur-sm" onClick={() => { if(step !== 'PROCESSING') onClose(); }} />
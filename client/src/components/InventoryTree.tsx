@@ -1,12 +1,15 @@
 import { useMemo, useState } from 'react';
 import { buildProductTree, type GroupNode } from '../utils';
-import type { Product } from '../types';
+import type { Product, FacetNode, FacetTotals } from '../types';
 import { ChevronDown, ChevronRight, Layers, Percent, AlertCircle, Clock, Book, XCircle, RefreshCw, ChevronsDown, ChevronsUp } from 'lucide-react';
 import clsx from 'clsx';
 import StorageImage from './StorageImage';
 
 interface Props {
   products: Product[];
+  searchResults?: Product[] | null;
+  searchTruncated?: boolean;
+  facetTree?: FacetNode[] | null;
   activeTab: string;
   searchQuery: string;
   loading: boolean;
@@ -54,7 +57,7 @@ function buildStatusTree(items: Product[]): GroupNode[] {
         });
 }
 
-export default function InventoryTree({ products, activeTab, searchQuery, loading, onSelectProduct, onRefresh }: Props) {
+export default function InventoryTree({ products, searchResults, searchTruncated, facetTree, activeTab, searchQuery, loading, onSelectProduct, onRefresh }: Props) {
   const [expandedState, setExpandedState] = useState<Record<string, Set<string>>>({
     BRAND: new Set(),
     CATEGORY: new Set(),
@@ -78,8 +81,10 @@ export default function InventoryTree({ products, activeTab, searchQuery, loadin
   };
 
   const treeData = useMemo(() => {
-    const filtered = products.filter(p => {
-      if (searchQuery) {
+    // Server matches are already filtered by the query
+    const useServerResults = !!searchQuery && !!searchResults;
+    const filtered = (useServerResults && searchResults ? searchResults : products).filter(p => {
+      if (searchQuery && !useServerResults) {
         const terms = searchQuery.toLowerCase().split(',').map(t => t.trim()).filter(t => t.length > 0);
         if (terms.length > 0) {
             const searchableText = `${p.brand} ${p.category} ${p.collection} ${p.code} ${p.manufacturer_code || ''}`.toLowerCase();
@@ -105,7 +110,22 @@ export default function InventoryTree({ products, activeTab, searchQuery, loadin
     if (activeTab === 'LOCATION') levels = ['current_location', 'brand', 'category'];
 
     return buildProductTree(filtered, levels);
-  }, [products, activeTab, searchQuery]);
+  }, [products, searchResults, activeTab, searchQuery]);
+
+  // Server totals keyed like the rendered nodes (parent-child); they cover whole groups,
+  // so they are only shown while no search narrows the tree
+  const facetTotals = useMemo(() => {
+    const totals = new Map<string, FacetTotals>();
+    const traverse = (nodes: FacetNode[], parentKey = '') => {
+        nodes.forEach(node => {
+            const uniqueKey = parentKey ? `${parentKey}-${node.key}` : node.key;
+            totals.set(uniqueKey, node.totals);
+            traverse(node.subgroups, uniqueKey);
+        });
+    };
+    if (facetTree && !searchQuery) traverse(facetTree);
+    return totals;
+  }, [facetTree, searchQuery]);
 
   const handleExpandAll = () => {
     const allKeys = new Set<string>();
@@ -191,6 +211,7 @@ export default function InventoryTree({ products, activeTab, searchQuery, loadin
     const uniqueKey = parentKey ? `${parentKey}-${node.key}` : node.key;
     const isExpanded = currentExpandedKeys.has(uniqueKey) || searchQuery.length > 0;
     const isDeepLevel = node.level > 0;
+    const totals = facetTotals.get(uniqueKey);
     
     return (
       <div key={uniqueKey} className={clsx("border-gray-100", isDeepLevel ? "border-l-2 ml-4" : "border-b bg-white")}>
@@ -216,6 +237,11 @@ export default function InventoryTree({ products, activeTab, searchQuery, loadin
             )}>
               {node.items.length}
             </span>
+            {totals && (
+              <span className="text-[10px] font-bold text-primary/70">
+                {totals.total_stock} pcs • {totals.booked_stock} booked
+              </span>
+            )}
           </div>
           {node.subgroups.length > 0 && (
             isExpanded ? <ChevronDown size={16} className="text-primary"/> : <ChevronRight size={16} className="text-gray-300"/>
@@ -270,7 +296,7 @@ export default function InventoryTree({ products, activeTab, searchQuery, loadin
         <div className="sticky top-0 z-10 bg-gray-50/95 backdrop-blur-sm border-b border-gray-200 px-4 py-2 flex justify-between items-center shadow-sm">
             <span className="text-[10px] font-bold text-gray-500 uppercase tracking-wider">
                 {searchQuery ? (
-                    <>Found {getTotalItems()} items</>
+                    <>Found {getTotalItems()} items{searchTruncated && ' (partial results, refine your search)'}</>
                 ) : (
                     <>{treeData.length} Groups</>
                 )}
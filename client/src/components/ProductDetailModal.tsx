@@ -1,7 +1,7 @@
 import React, { useEffect, useState, useRef, useMemo } from 'react';
 import { X, MapPin, QrCode, History, Package, ZoomIn, Settings, AlertTriangle, Clock, Percent, Book, User, Edit2, Loader2, Info } from 'lucide-react';
 import axios from 'axios';
-import type { Product, InventoryItem, ExchangeRates } from '../types';
+import type { Product, InventoryItem, ExchangeRates, HistoryEvent } from '../types';
 import StorageImage from './StorageImage';
 import clsx from 'clsx';
 
@@ -27,6 +27,18 @@ const ProductDetailModal: React.FC<Props> = ({ product, isOpen, onClose, onEdit,
   const [bookForm, setBookForm] = useState({ client_name: '', expired_at: '', notes: '' });
   
   const [isProcessing, setIsProcessing] = useState(false);
+  const [fullHistory, setFullHistory] = useState<Record<string, { events: HistoryEvent[]; cursor: string | null }>>({});
+
+  const loadHistory = async (itemId: string) => {
+      const cursor = fullHistory[itemId]?.cursor;
+      try {
+          const res = await axios.get(`http://127.0.0.1:5001/edievo-project/asia-southeast2/get_item_history`, { params: { item_id: itemId, page_size: 20, cursor } });
+          setFullHistory(prev => ({
+              ...prev,
+              [itemId]: { events: [...(prev[itemId]?.events || []), ...res.data.data], cursor: res.data.next_cursor }
+          }));
+      } catch (err) { console.error(err); }
+  };
 
   useEffect(() => {
     const fetchInventory = async () => {
@@ -56,6 +68,7 @@ const ProductDetailModal: React.FC<Props> = ({ product, isOpen, onClose, onEdit,
     } else {
         setInventory([]);
     }
+    setFullHistory({});
   }, [isOpen, product]);
 
   const reloadData = async () => {
@@ -94,13 +107,15 @@ const ProductDetailModal: React.FC<Props> = ({ product, isOpen, onClose, onEdit,
 
   const displayNettPrice = useMemo(() => {
       if (!product) return 0;
+      // A hand-entered nett doesn't follow the rates or discounts
+      if (product.nett_price_manual && product.nett_price_idr !== undefined) return product.nett_price_idr;
       if (!product.discounts || product.discounts.length === 0) return displayPrice;
 
       let current = displayPrice;
       product.discounts.forEach(d => {
           current = current * ((100 - d.value) / 100);
       });
-      return current;
+      return Math.trunc(current);
   }, [displayPrice, product]);
 
   if (!isOpen || !product) return null;
@@ -422,7 +437,7 @@ const ProductDetailModal: React.FC<Props> = ({ product, isOpen, onClose, onEdit,
                                         
                                         {item.history_log && item.history_log.length > 0 && !isBookingThis && (
                                             <div className="mt-2 pt-2 border-t border-gray-100 max-h-32 overflow-y-auto">
-                                                {[...item.history_log].reverse().slice(0, 10).map((log, i) => (
+                                                {(fullHistory[item.id]?.events || [...item.history_log].reverse()).map((log, i) => (
                                                     <div key={i} className="flex items-start gap-1 text-[10px] text-gray-400 mb-1 last:mb-0">
                                                         <History size={10} className="mt-0.5 shrink-0"/>
                                                         <span>
@@ -433,6 +448,11 @@ const ProductDetailModal: React.FC<Props> = ({ product, isOpen, onClose, onEdit,
                                                         </span>
                                                     </div>
                                                 ))}
+                                                {(!fullHistory[item.id] || fullHistory[item.id].cursor) && (
+                                                    <button type="button" onClick={() => loadHistory(item.id)} className="text-[10px] font-bold text-primary hover:underline">
+                                                        {fullHistory[item.id] ? 'Load more' : 'Full history'}
+                                                    </button>
+                                                )}
                                             </div>
                                         )}
                                     </div>
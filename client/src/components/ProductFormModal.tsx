@@ -96,7 +96,8 @@ const ProductFormModal: React.FC<Props> = ({ isOpen, mode, initialData, existing
     localDiscounts.forEach(d => {
         current = current * ((100 - d.value) / 100);
     });
-    return Math.round(current);
+    // Truncated like the server's compute_nett_price, so both sides agree to the rupiah
+    return Math.trunc(current);
   }, [formData.retail_price_idr, localDiscounts]);
 
   if (!isOpen) return null;
@@ -152,10 +153,14 @@ const ProductFormModal: React.FC<Props> = ({ isOpen, mode, initialData, existing
             upcoming_eta: formData.upcoming_eta || ''
         };
 
-        await axios.post('http://127.0.0.1:5001/edievo-project/asia-southeast2/manage_product', {
+        const res = await axios.post('http://127.0.0.1:5001/edievo-project/asia-southeast2/manage_product', {
             mode: mode,
             product: payload
         });
+        if (res.status === 202) {
+            // Large quantities are created by a background job (progress via get_unit_job)
+            alert(`Product saved. ${payload.total_stock} units are being created in the background and will appear shortly.`);
+        }
         
         await logActivity(
             mode === 'ADD' ? 'ITEM_ADDED' : 'ITEM_EDITED', 
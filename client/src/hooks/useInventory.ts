@@ -1,13 +1,23 @@
-import { useState, useCallback } from 'react';
+import { useState, useCallback, useRef } from 'react';
 import axios from 'axios';
-import type { Product, ExchangeRates } from '../types';
+import type { Product, ExchangeRates, FacetNode } from '../types';
+
+export interface SearchResult {
+  products: Product[];
+  total: number;
+  truncated: boolean;
+}
 
 export function useInventory() {
   const [products, setProducts] = useState<Product[]>([]);
   const [rates, setRates] = useState<ExchangeRates | null>(null);
   const [loading, setLoading] = useState(true);
 
-  // We define the API base here to keep it consistent. 
+  // Delta-sync state: the last full/partial catalog and the server sync timestamp
+  const productsRef = useRef<Product[]>([]);
+  const syncTsRef = useRef<string | null>(null);
+
+  // We define the API base here to keep it consistent.
   // In a real production setup, this might come from import.meta.env.VITE_API_URL
   const API_BASE = 'http://127.0.0.1:5001/edievo-project/asia-southeast2';
 
@@ -18,13 +28,31 @@ export function useInventory() {
         // Preserving the existing logic: Trigger background cleanup on first load
         await axios.post(`${API_BASE}/check_expired_bookings`);
       }
-      
+
       const rateRes = await axios.get(`${API_BASE}/get_exchange_rates`);
       setRates(rateRes.data.data);
 
-      const res = await axios.get(`${API_BASE}/get_all_products`);
-      setProducts(res.data.data);
-      return res.data.data;
+      let nextProducts: Product[];
+      if (silent && syncTsRef.current) {
+        // Silent refresh: only pull products changed/deleted since the last sync
+        const res = await axios.get(`${API_BASE}/get_products_since`, { params: { ts: syncTsRef.current } });
+        const changed = new Map<string, Product>(res.data.data.map((p: Product) => [p.id, p]));
+        const deleted = new Set<string>(res.data.deleted);
+        nextProducts = productsRef.current
+          .filter(p => !deleted.has(p.id))
+          .map(p => changed.get(p.id) || p);
+        const known = new Set(nextProducts.map(p => p.id));
+        changed.forEach((p, id) => { if (!known.has(id)) nextProducts.push(p); });
+        syncTsRef.current = res.data.sync_ts;
+      } else {
+        const res = await axios.get(`${API_BASE}/get_all_products`);
+        nextProducts = res.data.data;
+        syncTsRef.current = res.data.sync_ts;
+      }
+
+      productsRef.current = nextProducts;
+      setProducts(nextProducts);
+      return nextProducts;
     } catch (err) {
       console.error("API Error:", err);
       return [];
@@ -33,5 +61,29 @@ export function useInventory() {
     }
   }, []);
 
-  return { products, rates, loading, fetchProducts };
-}
\ No newline at end of file
+  // Server-side search: ranked matches without filtering the whole catalog locally.
+  // Follows next_cursor until every match is loaded; truncated means the query was
+  // too broad for the server to scan all candidates.
+  const searchProducts = useCallback(async (query: string): Promise<SearchResult> => {
+    const found: Product[] = [];
+    let cursor: string | null = null;
+    let total = 0;
+    let truncated = false;
+    do {
+      const res = await axios.get(`${API_BASE}/search_products`, { params: { q: query, page_size: 500, cursor } });
+      found.push(...res.data.data);
+      total = res.data.total;
+      truncated = res.data.truncated;
+      cursor = res.data.next_cursor;
+    } while (cursor);
+    return { products: found, total, truncated };
+  }, []);
+
+  // Group totals (stock, value) for the BRAND/CATEGORY tabs, read from the server aggregates
+  const fetchInventoryTree = useCallback(async (by: 'brand' | 'category'): Promise<FacetNode[]> => {
+    const res = await axios.get(`${API_BASE}/get_inventory_tree`, { params: { by } });
+    return res.data.data;
+  }, []);
+
+  return { products, rates, loading, fetchProducts, searchProducts, fetchInventoryTree };
+}
@@ -21,6 +21,21 @@ export interface ItemBooking {
   notes?: string;
 }
 
+// Materialized group totals from get_inventory_tree
+export interface FacetTotals {
+  products: number;
+  total_stock: number;
+  booked_stock: number;
+  sold_stock: number;
+  stock_value_idr: number;
+}
+
+export interface FacetNode {
+  key: string;
+  totals: FacetTotals;
+  subgroups: FacetNode[];
+}
+
 // [NEW] Interface for Global Rates
 export interface ExchangeRates {
     eur_rate: number;
@@ -51,6 +66,7 @@ export interface Product {
   retail_price_usd?: number;
   
   nett_price_idr?: number; 
+  nett_price_manual?: boolean; // Set when an import gave an explicit nett price
   discounts?: Discount[];   
   discount_ids?: string[]; 
   
@@ -62,6 +78,8 @@ export interface Product {
   is_upcoming?: boolean;
   upcoming_eta?: string; 
 
+  location_counts?: Record<string, number>; // Units per physical location (excludes SOLD)
+
   last_sequence?: number; // Internal counter for stock serialization
   created_at?: string;
 }
@@ -79,11 +97,15 @@ export interface InventoryItem {
   po_number?: string;
   
   current_location: string;
-  history_log: {
-    action: string;
-    batch_id?: string;
-    location: string;
-    date: string;
-    note?: string;
-  }[];
+  // Last few events only; the full log comes from get_item_history
+  history_log: HistoryEvent[];
+}
+
+export interface HistoryEvent {
+  id?: string;
+  action: string;
+  batch_id?: string;
+  location: string;
+  date: string;
+  note?: string;
 }
\ No newline at end of file
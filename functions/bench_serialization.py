@@ -0,0 +1,115 @@
+import copy
+import datetime
+import json
+import random
+import timeit
+import uuid
+
+from google.api_core.datetime_helpers import DatetimeWithNanoseconds
+from src.utils import dumps, iter_json, orjson
+
+# Micro-benchmark: the old serialize_doc + json.dumps path vs the single-pass encoder.
+# Run from functions/:  python bench_serialization.py
+# No Firestore connection needed; payloads are synthetic but shaped like real documents.
+
+# --- CONFIGURATION ---
+PRODUCT_COUNT = 2000
+ITEM_COUNT = 5000
+REPEAT = 5
+
+def legacy_serialize_doc(doc_dict):
+    """Verbatim copy of the removed utils.serialize_doc: in-place, top level + lists of dicts only."""
+    if not doc_dict: return {}
+    for key, value in doc_dict.items():
+        if isinstance(value, datetime.datetime):
+            doc_dict[key] = value.isoformat()
+        if isinstance(value, list):
+            for item in value:
+                if isinstance(item, dict):
+                    legacy_serialize_doc(item)
+    return doc_dict
+
+def ts(days_ago=0):
+    return DatetimeWithNanoseconds.now(datetime.timezone.utc) - datetime.timedelta(days=days_ago)
+
+def make_product(i):
+    discounts = [{'id': str(uuid.uuid4()), 'name': f"Promo {v}%", 'value': v} for v in random.sample([5, 10, 15, 20], random.randint(0, 2))]
+    return {
+        'id': uuid.uuid4().hex[:20],
+        'brand': random.choice(['SLAMP', 'FLOS', 'ARTEMIDE', 'VIBIA']),
+        'category': random.choice(['Pendant', 'Table', 'Floor', 'Wall']),
+        'collection': f"Collection {i % 300}",
+        'code': f"BRND-CATG-COLL{i:02d}",
+        'manufacturer_code': f"MC-{i:06d}",
+        'image_url': f"products/{i}.jpg",
+        'detail': 'Hand-finished lampshade with dimmable LED module. ' * 3,
+        'dimensions': '45 x 45 x 120 cm',
+        'finishing': 'Matte black',
+        'currency': 'EUR',
+        'retail_price_eur': random.randint(100, 5000),
+        'retail_price_usd': 0,
+        'retail_price_idr': random.randint(1, 90) * 1_000_000,
+        'nett_price_idr': random.randint(1, 80) * 1_000_000,
+        'discounts': discounts,
+        'discount_ids': [d['id'] for d in discounts],
+        'total_stock': random.randint(0, 40),
+        'booked_stock': random.randint(0, 3),
+        'sold_stock': random.randint(0, 10),
+        'location_counts': {'Warehouse (New)': random.randint(0, 20), 'Showroom': random.randint(0, 5)},
+        'is_not_for_sale': False,
+        'is_upcoming': False,
+        'upcoming_eta': '',
+        'last_sequence': random.randint(0, 40),
+        'created_at': ts(400),
+        'updated_at': ts(3),
+    }
+
+def make_item(i):
+    history = [{'action': 'BOOKED', 'location': 'Showroom', 'date': ts(d), 'note': 'Booked for client by staff'} for d in range(10)]
+    item = {
+        'id': uuid.uuid4().hex[:20],
+        'product_id': uuid.uuid4().hex[:20],
+        'product_name': 'SLAMP - Collection 12',
+        'qr_code': f"BRND-CATG-COLL{i % 99:02d}-{i:04d}",
+        'status': 'BOOKED' if i % 4 == 0 else 'AVAILABLE',
+        'current_location': 'Showroom',
+        'created_at': ts(300),
+        'history_log': history,
+    }
+    if item['status'] == 'BOOKED':
+        # Bookings store their dates as ISO strings, which is why the old path never had to recurse here
+        item['booking'] = {'booked_by': 'Client', 'system_user': 'Staff', 'booked_at': ts(1).isoformat(), 'expired_at': ts(-3).isoformat(), 'notes': ''}
+    return item
+
+def bench(label, payload):
+    def legacy():
+        # The old path mutated its input, so every run needs a fresh copy (the copy is timed separately)
+        data = copy.deepcopy(payload)
+        return json.dumps({'data': [legacy_serialize_doc(d) for d in data]})
+
+    def deepcopy_only():
+        return copy.deepcopy(payload)
+
+    def single_pass():
+        return dumps({'data': payload})
+
+    def streamed():
+        return ''.join(iter_json({'data': iter(payload)}))
+
+    copy_time = min(timeit.repeat(deepcopy_only, number=1, repeat=REPEAT))
+    results = {
+        'legacy serialize_doc + json.dumps': min(timeit.repeat(legacy, number=1, repeat=REPEAT)) - copy_time,
+        'dumps (single pass)': min(timeit.repeat(single_pass, number=1, repeat=REPEAT)),
+        'iter_json (streamed)': min(timeit.repeat(streamed, number=1, repeat=REPEAT)),
+    }
+    size_kb = len(single_pass()) / 1024
+    print(f"\n{label}: {len(payload)} docs, {size_kb:,.0f} KB of JSON")
+    base = results['legacy serialize_doc + json.dumps']
+    for name, seconds in results.items():
+        print(f"  {name:<36} {seconds * 1000:8.1f} ms   x{base / seconds:4.1f}")
+
+if __name__ == '__main__':
+    random.seed(42)
+    print(f"Backend: {'orjson' if orjson is not None else 'stdlib json'}")
+    bench('get_all_products', [make_product(i) for i in range(PRODUCT_COUNT)])
+    bench('get_product_inventory', [make_item(i) for i in range(ITEM_COUNT)])
@@ -0,0 +1,82 @@
+import json
+import os
+import subprocess
+import sys
+
+# Cold-start benchmark for the functions entrypoint.
+# Every deployed function loads main.py, so its import cost is paid by every
+# cold start; heavy libraries must only be imported inside the code paths that
+# use them (export, file import parsing, the repricing task).
+#
+#   python bench_startup.py          # per-endpoint cold import + first-use cost
+#   python bench_startup.py --check  # exit 1 if importing main pulls in a heavy module
+#
+# Run from functions/. No Firestore connection is made; the emulator settings
+# below only let firebase_admin create its clients.
+
+# --- CONFIGURATION ---
+HEAVY_MODULES = ['pandas', 'numpy', 'openpyxl', 'google.cloud.storage']
+REPEAT = 3
+
+# Heavy modules each entry point imports lazily on its first call. Keep in step with
+# the code: pricing.price_arrays (numpy), imports.iter_file_rows (pandas for CSV,
+# openpyxl for XLSX), write_export_workbook (openpyxl) and config.get_bucket (storage).
+LAZY_DEPENDENCIES = {
+    'export_inventory_excel': ['numpy', 'openpyxl', 'google.cloud.storage'],
+    'import_products_file': ['pandas', 'openpyxl', 'google.cloud.storage'],
+    'run_import_job': ['pandas', 'openpyxl', 'google.cloud.storage'],
+    'run_repricing': ['numpy'],
+    'delete_product': ['google.cloud.storage'],
+    'run_product_deletion': ['google.cloud.storage'],
+}
+
+ENV = {
+    **os.environ,
+    'FIRESTORE_EMULATOR_HOST': os.environ.get('FIRESTORE_EMULATOR_HOST', '127.0.0.1:8080'),
+    'GCLOUD_PROJECT': os.environ.get('GCLOUD_PROJECT', 'edievo-project'),
+}
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import main
+main_s = time.perf_counter() - start
+start = time.perf_counter()
+for name in {deps!r}: __import__(name)
+deps_s = time.perf_counter() - start
+print(json.dumps({{'main': main_s, 'deps': deps_s, 'loaded': [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+def probe(deps=()):
+    """Runs one cold interpreter; returns the best of REPEAT runs."""
+    runs = []
+    for _ in range(REPEAT):
+        code = PROBE.format(deps=list(deps), heavy=HEAVY_MODULES)
+        out = subprocess.run([sys.executable, '-c', code], env=ENV, capture_output=True, text=True, check=True)
+        runs.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    return min(runs, key=lambda r: r['main'] + r['deps'])
+
+def exported_functions():
+    import ast
+    tree = ast.parse(open('main.py').read())
+    return [alias.name for node in tree.body if isinstance(node, ast.ImportFrom) and node.module and node.module.startswith('src.') for alias in node.names]
+
+def check():
+    result = probe()
+    if result['loaded']:
+        print(f"FAIL: importing main.py loads {', '.join(result['loaded'])}; import them inside the functions that need them")
+        return 1
+    print(f"OK: main.py imports in {result['main'] * 1000:.0f} ms without {', '.join(HEAVY_MODULES)}")
+    return 0
+
+def bench():
+    base = probe()
+    print(f"main.py cold import: {base['main'] * 1000:.0f} ms (heavy modules loaded: {', '.join(base['loaded']) or 'none'})\n")
+    print(f"{'endpoint':<36}{'cold start':>12}{'first call +':>14}")
+    for name in exported_functions():
+        deps = LAZY_DEPENDENCIES.get(name, [])
+        extra = probe(deps)['deps'] if deps else 0.0
+        print(f"{name:<36}{base['main'] * 1000:>10.0f}ms{extra * 1000:>12.0f}ms")
+
+if __name__ == '__main__':
+    sys.exit(check() if '--check' in sys.argv else bench())
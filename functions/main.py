@@ -6,22 +6,69 @@ from firebase_admin import initialize_app
 
 from src.inventory import (
     get_all_products, 
+    get_products_since,
     get_product_inventory, 
+    get_item_history,
     manage_product, 
-    delete_product, 
+    get_unit_job,
+    run_unit_creation,
+    resume_stalled_unit_jobs,
     bulk_import_products, 
-    export_inventory_excel
+    export_inventory_excel,
+    reconcile_product_counters,
+    rebuild_location_summaries,
+    migrate_history_logs,
+    scheduled_counter_reconciliation
 )
 
 from src.bookings import (
     book_item, 
     release_item, 
-    check_expired_bookings
+    book_items,
+    release_items,
+    check_expired_bookings,
+    get_active_bookings,
+    resolve_qr_codes,
+    scheduled_expiry_sweep
+)
+
+from src.deletion import (
+    delete_product,
+    get_deletion_job,
+    run_product_deletion,
+    resume_stalled_deletions
+)
+
+from src.search import (
+    search_products,
+    rebuild_search_index
+)
+
+from src.facets import (
+    get_inventory_tree,
+    rebuild_inventory_tree,
+    on_product_written,
+    on_counter_shard_written,
+    scheduled_inventory_tree_rebuild
+)
+
+from src.imports import (
+    import_products_file,
+    get_import_status,
+    run_import_job,
+    resume_stalled_imports
 )
 
 from src.settings import (
     get_exchange_rates, 
     update_exchange_rates, 
+    get_repricing_job,
+    run_repricing,
+    resume_stalled_repricing_jobs,
     manage_discount, 
-    get_discounts
+    get_discounts,
+    get_discount_job,
+    run_discount_fanout,
+    resume_stalled_discount_jobs,
+    get_cache_stats
 )
\ No newline at end of file
@@ -6,6 +6,8 @@ import uuid
 import datetime
 import os
 
+from src.utils import build_search_keywords
+
 # --- CONFIGURATION ---
 CSV_FILENAME = 'ED-Stock master data - In Stock.csv'
 PROJECT_ID = 'edievo-project'
@@ -83,9 +85,6 @@ def seed_database():
         # Create Master Product
         product_ref = db.collection('products').document(sku_id)
         
-        search_text = f"{brand} {category} {collection} {code}".lower()
-        search_keywords = search_text.split()
-
         product_data = {
             'id': sku_id,
             'brand': brand,
@@ -99,7 +98,7 @@ def seed_database():
             'retail_price_idr': clean_price(row['retail price']),
             'total_stock': qty,
             'detail': detail_text, # <--- Added detail field
-            'search_keywords': search_keywords,
+            'search_keywords': build_search_keywords({'brand': brand, 'category': category, 'collection': collection, 'code': code}),
             'created_at': datetime.datetime.now()
         }
         batch.set(product_ref, product_data)
@@ -0,0 +1,96 @@
+import time
+import random
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from google.api_core import exceptions as gexc
+from .config import db
+from .metrics import in_context
+
+# Firestore allows 500 writes per commit; stay below it to leave room for
+# counter/version writes that callers may append.
+BATCH_LIMIT = 400
+MAX_WORKERS = 8
+MAX_ATTEMPTS = 5
+
+RETRYABLE_ERRORS = (
+    gexc.Aborted,
+    gexc.DeadlineExceeded,
+    gexc.ServiceUnavailable,
+    gexc.ResourceExhausted,
+    gexc.InternalServerError,
+)
+
+# --- WRITE OPS ---
+# A write op is a plain tuple so chunks can be rebuilt into a fresh WriteBatch on retry:
+#   ('set', ref, data) / ('set_merge', ref, data) / ('update', ref, data) / ('delete', ref, None)
+#   ('create', ref, data) fails the whole batch with AlreadyExists if the doc exists
+
+def apply_op(batch, op):
+    kind, ref, data = op
+    if kind == 'set': batch.set(ref, data)
+    elif kind == 'set_merge': batch.set(ref, data, merge=True)
+    elif kind == 'create': batch.create(ref, data)
+    elif kind == 'update': batch.update(ref, data)
+    elif kind == 'delete': batch.delete(ref)
+    else: raise ValueError(f"Unknown write op '{kind}'")
+
+def commit_with_retry(ops, max_attempts=MAX_ATTEMPTS):
+    """
+    Commits ops as one atomic WriteBatch, retrying transient errors with
+    exponential backoff and jitter. Returns the number of attempts used.
+    """
+    attempt = 0
+    while True:
+        attempt += 1
+        batch = db.batch()
+        for op in ops: apply_op(batch, op)
+        try:
+            batch.commit()
+            return attempt
+        except RETRYABLE_ERRORS:
+            if attempt >= max_attempts: raise
+            time.sleep(min(0.2 * (2 ** attempt), 8) + random.random() * 0.2)
+
+def pack_groups(groups, limit=BATCH_LIMIT):
+    """
+    Greedily packs groups of ops into chunks of at most `limit` ops without
+    splitting a group, so every group commits (or fails) atomically.
+    groups: list of (key, ops). Returns a list of {'keys': [...], 'ops': [...]}.
+    Groups larger than `limit` must be split by the caller.
+    """
+    chunks = []
+    current = {'keys': [], 'ops': []}
+    for key, ops in groups:
+        if len(ops) > limit: raise ValueError(f"Group '{key}' has {len(ops)} ops (limit {limit})")
+        if current['ops'] and len(current['ops']) + len(ops) > limit:
+            chunks.append(current)
+            current = {'keys': [], 'ops': []}
+        current['keys'].append(key)
+        current['ops'].extend(ops)
+    if current['ops']: chunks.append(current)
+    return chunks
+
+def split_ops(ops, limit=BATCH_LIMIT):
+    """Splits a flat op list into chunks of at most `limit` ops."""
+    return [ops[i:i + limit] for i in range(0, len(ops), limit)]
+
+def commit_chunks_parallel(chunks, max_workers=MAX_WORKERS):
+    """
+    Commits chunks concurrently with bounded parallelism.
+    chunks: list of {'keys': [...], 'ops': [...]}.
+    Returns one result per chunk (same order):
+    {'chunk', 'keys', 'ops', 'status': 'ok'|'failed', 'attempts', 'error'}.
+    """
+    results = [None] * len(chunks)
+    if not chunks: return results
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(chunks))) as executor:
+        futures = {executor.submit(in_context(commit_with_retry), c['ops']): i for i, c in enumerate(chunks)}
+        for future in as_completed(futures):
+            i = futures[future]
+            result = {'chunk': i, 'keys': chunks[i]['keys'], 'ops': len(chunks[i]['ops'])}
+            try:
+                result.update({'status': 'ok', 'attempts': future.result(), 'error': None})
+            except Exception as e:
+                result.update({'status': 'failed', 'attempts': None, 'error': str(e)})
+            results[i] = result
+    return results
@@ -1,145 +1,532 @@
-from firebase_functions import https_fn
+from firebase_functions import https_fn, scheduler_fn, logger
 from firebase_admin import firestore
 import json
 import datetime
+from concurrent.futures import ThreadPoolExecutor
 from .config import db
-from .utils import serialize_doc
-from .inventory import update_product_counters
+from .batching import MAX_WORKERS
+from .cache import invalidate as invalidate_cache
+from .responses import endpoint
+from .metrics import instrumented, in_context
+from .utils import dumps
+from .inventory import get_counter_deltas, apply_counter_deltas, get_counter_shard_count, get_location_deltas, apply_location_deltas, append_history, HISTORY_RECENT
+
+# --- HELPER: TRANSACTIONAL STATUS CHANGE ---
+# Each item costs an update plus a history doc, and each product group adds counter,
+# location and version writes; 150 items stays well inside the 500-write limit.
+TRANSITION_GROUP_LIMIT = 150
+
+@firestore.transactional
+def apply_item_transition(transaction, item_ref, shard_count, build_update, allowed_statuses=None):
+    """
+    Reads the item, checks its current status and writes the update together with
+    the product counter and location_counts increments in one transaction.
+    A 'history_event' key in the update is recorded via append_history.
+    Returns (item_data, error_message).
+    """
+    snap = item_ref.get(transaction=transaction)
+    if not snap.exists: return None, "Item not found"
+
+    item_data = snap.to_dict()
+    old_status = item_data.get('status', 'AVAILABLE')
+    if allowed_statuses and old_status not in allowed_statuses:
+        return item_data, f"Item cannot be changed from {old_status}"
+
+    update_data = build_update(item_data)
+    event = update_data.pop('history_event', None)
+    if event: update_data['history_log'] = append_history(transaction, item_ref, event, item_data.get('history_log'))
+    transaction.update(item_ref, update_data)
+    apply_counter_deltas(transaction, item_data['product_id'], get_counter_deltas(old_status, update_data['status']), shard_count)
+    new_location = update_data.get('current_location', item_data.get('current_location'))
+    apply_location_deltas(transaction, item_data['product_id'], get_location_deltas(old_status, item_data.get('current_location'), update_data['status'], new_location))
+    return item_data, None
+
+@firestore.transactional
+def apply_item_transitions(transaction, item_refs, product_id, shard_count, build_update, allowed_statuses=None):
+    """
+    Group version of apply_item_transition for items of one product: every item is
+    read and updated in one transaction and the product counters and location_counts
+    are incremented once with the summed deltas.
+    Returns {item_id: error_message or None}.
+    """
+    snaps = list(db.get_all(item_refs, transaction=transaction))
+    results = {}
+    counter_deltas = {}
+    location_deltas = {}
+    for snap in snaps:
+        if not snap.exists:
+            results[snap.id] = "Item not found"
+            continue
+        item_data = snap.to_dict()
+        old_status = item_data.get('status', 'AVAILABLE')
+        if item_data.get('product_id') != product_id:
+            results[snap.id] = "Item moved to another product"
+            continue
+        if allowed_statuses and old_status not in allowed_statuses:
+            results[snap.id] = f"Item cannot be changed from {old_status}"
+            continue
+
+        update_data = build_update(item_data)
+        event = update_data.pop('history_event', None)
+        if event: update_data['history_log'] = append_history(transaction, snap.reference, event, item_data.get('history_log'))
+        transaction.update(snap.reference, update_data)
+        new_location = update_data.get('current_location', item_data.get('current_location'))
+        for f, v in get_counter_deltas(old_status, update_data['status']).items():
+            counter_deltas[f] = counter_deltas.get(f, 0) + v
+        for loc, v in get_location_deltas(old_status, item_data.get('current_location'), update_data['status'], new_location).items():
+            location_deltas[loc] = location_deltas.get(loc, 0) + v
+        results[snap.id] = None
+
+    apply_counter_deltas(transaction, product_id, {f: v for f, v in counter_deltas.items() if v}, shard_count)
+    apply_location_deltas(transaction, product_id, {loc: v for loc, v in location_deltas.items() if v})
+    return results
+
+def transition_items(item_ids, build_update, allowed_statuses=None):
+    """
+    Applies one status transition to many items: items are grouped by product and
+    each group (split at TRANSITION_GROUP_LIMIT) runs as its own transaction, with
+    groups processed in parallel. Returns {item_id: error_message or None}.
+    """
+    refs = [db.collection('inventory_items').document(i) for i in dict.fromkeys(item_ids)]
+    results = {}
+    groups = {}
+    for snap in db.get_all(refs, field_paths=['product_id']):
+        if not snap.exists: results[snap.id] = "Item not found"
+        else: groups.setdefault(snap.to_dict().get('product_id'), []).append(snap.reference)
+
+    def run_group(product_id, group_refs):
+        shard_count = get_counter_shard_count(product_id)
+        group_results = {}
+        for i in range(0, len(group_refs), TRANSITION_GROUP_LIMIT):
+            chunk = group_refs[i:i + TRANSITION_GROUP_LIMIT]
+            try:
+                group_results.update(apply_item_transitions(db.transaction(), chunk, product_id, shard_count, build_update, allowed_statuses))
+            except Exception as e:
+                group_results.update({ref.id: str(e) for ref in chunk})
+        return group_results
+
+    if groups:
+        with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(groups))) as executor:
+            # One context copy per task: a Context can't be entered by two threads at once
+            futures = [executor.submit(in_context(run_group), product_id, group_refs) for product_id, group_refs in groups.items()]
+            for future in futures:
+                results.update(future.result())
+        invalidate_cache('catalog_version')
+    return results
+
+def get_item_shard_count(item_ref):
+    snap = item_ref.get(['product_id'])
+    if not snap.exists: return None
+    return get_counter_shard_count(snap.to_dict()['product_id'])
+
+# --- HELPER: EXPIRY WATERMARK ---
+EXPIRY_WATERMARK_REF = db.collection('settings').document('booking_expiry')
+
+@firestore.transactional
+def lower_expiry_watermark(transaction, expired_at):
+    """Moves the next-expiry watermark earlier if a new booking expires sooner."""
+    snap = EXPIRY_WATERMARK_REF.get(transaction=transaction)
+    current = snap.to_dict().get('next_expiry') if snap.exists else None
+    if current is None or expired_at < current:
+        transaction.set(EXPIRY_WATERMARK_REF, {'next_expiry': expired_at}, merge=True)
+
+@firestore.transactional
+def refresh_expiry_watermark(transaction):
+    """Stores the earliest expiry among the remaining BOOKED items (None when there are none)."""
+    # Reading the watermark here makes a concurrent lower_expiry_watermark conflict with this
+    # transaction, so a booking that lands between the query and the write is never overwritten
+    EXPIRY_WATERMARK_REF.get(transaction=transaction)
+    soonest = (db.collection('inventory_items')
+               .where('status', '==', 'BOOKED')
+               .order_by('booking.expired_at')
+               .select(['booking.expired_at'])
+               .limit(1).stream(transaction=transaction))
+    next_expiry = None
+    for doc in soonest:
+        next_expiry = doc.to_dict().get('booking', {}).get('expired_at')
+    transaction.set(EXPIRY_WATERMARK_REF, {'next_expiry': next_expiry, 'last_sweep': firestore.SERVER_TIMESTAMP}, merge=True)
+    return next_expiry
+
+def migrate_legacy_expiry_strings():
+    """
+    Bookings made before expired_at became a native timestamp store an ISO string.
+    Strings sort after timestamps, so '>= ""' selects exactly the legacy rows.
+    """
+    legacy = (db.collection('inventory_items')
+              .where('status', '==', 'BOOKED')
+              .where('booking.expired_at', '>=', '')
+              .stream())
+    batch = db.batch()
+    count = 0
+    for doc in legacy:
+        try:
+            exp_date = datetime.datetime.fromisoformat(doc.to_dict()['booking']['expired_at'])
+        except (KeyError, ValueError):
+            continue
+        if exp_date.tzinfo is None: exp_date = exp_date.replace(tzinfo=datetime.timezone.utc)
+        batch.update(doc.reference, {'booking.expired_at': exp_date})
+        count += 1
+        if count >= 400:
+            batch.commit(); batch = db.batch(); count = 0
+    if count > 0: batch.commit()
+
+def release_expired_bookings():
+    """
+    Releases every BOOKED item whose booking.expired_at has passed.
+    Only already-expired items are read, via the (status, booking.expired_at) index.
+    """
+    migrate_legacy_expiry_strings()
+    now = datetime.datetime.now(datetime.timezone.utc)
+    expired_items = (db.collection('inventory_items')
+                     .where('status', '==', 'BOOKED')
+                     .where('booking.expired_at', '<=', now)
+                     .stream())
+    released = 0
+    count = 0
+    batch = db.batch()
+    pending_deltas = {}
+
+    def flush(batch, pending_deltas):
+        # Counter increments ride in the same commit as the item updates
+        for pid, deltas in pending_deltas.items():
+            apply_counter_deltas(batch, pid, deltas, get_counter_shard_count(pid))
+        batch.commit()
+
+    for doc in expired_items:
+        data = doc.to_dict()
+        event = {
+            'action': 'AUTO_RELEASED',
+            'location': data.get('current_location', ''),
+            'date': now,
+            'note': "Global expiration check"
+        }
+        update_data = {
+            'status': 'AVAILABLE',
+            'booking': firestore.DELETE_FIELD,
+            'history_log': append_history(batch, doc.reference, event, data.get('history_log'))
+        }
+        # Precondition: the commit fails if the item changed since it was read; the next sweep retries
+        batch.update(doc.reference, update_data, option=db.write_option(last_update_time=doc.update_time))
+        pid = data.get('product_id')
+        if pid:
+            deltas = pending_deltas.setdefault(pid, {})
+            for f, v in get_counter_deltas('BOOKED', 'AVAILABLE').items():
+                deltas[f] = deltas.get(f, 0) + v
+        # Item update + history event, plus any backlog an unmigrated item's log still carries
+        count += 2 + max(0, len(data.get('history_log') or []) - HISTORY_RECENT)
+        released += 1
+
+        # Each product adds one counter update
+        if count + len(pending_deltas) >= 400:
+            flush(batch, pending_deltas)
+            batch = db.batch()
+            pending_deltas = {}
+            count = 0
+
+    if count > 0:
+        flush(batch, pending_deltas)
+
+    refresh_expiry_watermark(db.transaction())
+    return released
 
 # --- SYSTEM JOB FUNCTIONS ---
 
+@instrumented
+@endpoint('POST')
 def check_expired_bookings(req: https_fn.Request) -> https_fn.Response:
-    headers = {'Access-Control-Allow-Origin': '*', 'Access-Control-Allow-Methods': 'POST', 'Access-Control-Allow-Headers': 'Content-Type'}
-    if req.method == 'OPTIONS': return https_fn.Response('', status=204, headers=headers)
+    try:
+        # Cheap path: nothing can have expired before the watermark
+        watermark = EXPIRY_WATERMARK_REF.get()
+        if watermark.exists and 'next_expiry' in watermark.to_dict():
+            next_expiry = watermark.to_dict()['next_expiry']
+            if next_expiry is None or datetime.datetime.now(datetime.timezone.utc) < next_expiry:
+                return https_fn.Response(json.dumps({'success': True, 'released_count': 0}), status=200, mimetype='application/json')
 
+        released = release_expired_bookings()
+        return https_fn.Response(json.dumps({'success': True, 'released_count': released}), status=200, mimetype='application/json')
+    except Exception as e:
+        return https_fn.Response(str(e), status=500)
+
+@scheduler_fn.on_schedule(schedule="every 15 minutes", region="asia-southeast2")
+@instrumented
+def scheduled_expiry_sweep(event: scheduler_fn.ScheduledEvent) -> None:
+    released = release_expired_bookings()
+    if released: logger.info(f"Auto-released {released} expired bookings", released=released)
+
+# --- READ FUNCTIONS ---
+
+BOOKING_ITEM_FIELDS = ['product_id', 'product_name', 'qr_code', 'status', 'booking', 'current_location']
+BOOKING_PRODUCT_FIELDS = ['brand', 'category', 'collection', 'code', 'image_url']
+
+@instrumented
+@endpoint('GET')
+def get_active_bookings(req: https_fn.Request) -> https_fn.Response:
+    """
+    Lists every BOOKED item joined with its parent product.
+    One query on inventory_items plus one batched read of the distinct products.
+    Optional query params: order=asc|desc (by expiry), page_size, cursor (last item id).
+    """
     try:
-        booked_items = db.collection('inventory_items').where('status', '==', 'BOOKED').stream()
-        now = datetime.datetime.now()
-        updated_products = set()
-        count = 0
-        batch = db.batch()
-        
-        for doc in booked_items:
-            data = doc.to_dict()
-            booking = data.get('booking', {})
-            expired_str = booking.get('expired_at')
-            
-            if expired_str:
-                try:
-                    exp_date = datetime.datetime.fromisoformat(expired_str)
-                    if now > exp_date:
-                        update_data = {
-                            'status': 'AVAILABLE',
-                            'booking': firestore.DELETE_FIELD,
-                            'history_log': firestore.ArrayUnion([{
-                                'action': 'AUTO_RELEASED',
-                                'location': data.get('current_location', ''),
-                                'date': now,
-                                'note': "Global expiration check"
-                            }])
-                        }
-                        batch.update(doc.reference, update_data)
-                        updated_products.add(data.get('product_id'))
-                        count += 1
-                except:
-                    continue
-
-            if count >= 400:
-                batch.commit()
-                batch = db.batch()
-                count = 0
-        
-        if count > 0:
-            batch.commit()
+        direction = firestore.Query.DESCENDING if req.args.get('order') == 'desc' else firestore.Query.ASCENDING
+        page_size = int(req.args.get('page_size', 0))
+        cursor = req.args.get('cursor')
 
-        for pid in updated_products:
-            if pid: update_product_counters(pid)
+        query = (db.collection('inventory_items')
+                 .where('status', '==', 'BOOKED')
+                 .order_by('booking.expired_at', direction=direction)
+                 .select(BOOKING_ITEM_FIELDS))
+        if cursor:
+            cursor_snap = db.collection('inventory_items').document(cursor).get(['booking'])
+            if cursor_snap.exists: query = query.start_after(cursor_snap)
+        if page_size > 0: query = query.limit(page_size)
 
-        return https_fn.Response(json.dumps({'success': True, 'released_count': count}), status=200, headers=headers, mimetype='application/json')
+        items = []
+        for doc in query.stream():
+            d = doc.to_dict()
+            d['id'] = doc.id
+            items.append(d)
+
+        product_ids = {i['product_id'] for i in items if i.get('product_id')}
+        product_refs = [db.collection('products').document(pid) for pid in product_ids]
+        products = {}
+        if product_refs:
+            for snap in db.get_all(product_refs, field_paths=BOOKING_PRODUCT_FIELDS):
+                if snap.exists: products[snap.id] = snap.to_dict()
+
+        bookings = []
+        for item in items:
+            p = products.get(item.get('product_id'), {})
+            item['product_brand'] = p.get('brand')
+            item['product_category'] = p.get('category')
+            item['product_collection'] = p.get('collection')
+            item['product_code'] = p.get('code')
+            item['product_image_url'] = p.get('image_url')
+            bookings.append(item)
+
+        result = {'data': bookings}
+        if page_size > 0:
+            result['next_cursor'] = items[-1]['id'] if len(items) == page_size else None
+        return https_fn.Response(dumps(result), status=200, mimetype='application/json')
     except Exception as e:
-        return https_fn.Response(str(e), status=500, headers=headers)
+        return https_fn.Response(str(e), status=500)
 
-# --- ACTION FUNCTIONS ---
+# --- QR SCAN RESOLUTION ---
+# Stock-takes send scanned codes in bursts. Codes are looked up with 'in' queries on
+# the single-field qr_code index (QR_LOOKUP_CHUNK values per query, run in parallel),
+# then the distinct products are read in one batched get.
+SCAN_ITEM_FIELDS = ['product_id', 'product_name', 'qr_code', 'status', 'booking', 'current_location']
+SCAN_PRODUCT_FIELDS = ['brand', 'category', 'collection', 'code', 'image_url', 'is_not_for_sale']
+QR_LOOKUP_CHUNK = 30  # Firestore limit for 'in' filters
+QR_MAX_CODES = 5000
 
-def book_item(req: https_fn.Request) -> https_fn.Response:
-    headers = {'Access-Control-Allow-Origin': '*', 'Access-Control-Allow-Methods': 'POST', 'Access-Control-Allow-Headers': 'Content-Type'}
-    if req.method == 'OPTIONS': return https_fn.Response('', status=204, headers=headers)
+def lookup_qr_codes(codes):
+    """{qr_code: item dict (with 'id')} for the codes that exist."""
+    def lookup(chunk):
+        query = db.collection('inventory_items').where('qr_code', 'in', chunk).select(SCAN_ITEM_FIELDS)
+        return [{**doc.to_dict(), 'id': doc.id} for doc in query.stream()]
+
+    chunks = [codes[i:i + QR_LOOKUP_CHUNK] for i in range(0, len(codes), QR_LOOKUP_CHUNK)]
+    found = {}
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        # One context copy per task: a Context can't be entered by two threads at once
+        futures = [executor.submit(in_context(lookup), chunk) for chunk in chunks]
+        for future in futures:
+            for item in future.result(): found.setdefault(item['qr_code'], item)
+    return found
 
+@instrumented
+@endpoint('POST')
+def resolve_qr_codes(req: https_fn.Request) -> https_fn.Response:
+    """
+    Resolves a batch of scanned QR codes to their items, joined with the parent product.
+    Body: {codes: [...]} (up to QR_MAX_CODES). Results keep the scan order; repeated
+    scans are flagged 'duplicate' and codes with no item are listed in 'unknown'.
+    """
     try:
-        data = req.get_json()
-        item_id = data.get('item_id')
-        booked_by = data.get('booked_by', 'Unknown')
-        system_user = data.get('system_user', 'System')
-        notes = data.get('notes', '')
-        expired_at_str = data.get('expired_at')
-        
-        if not expired_at_str: return https_fn.Response("Missing expiration date", status=400, headers=headers)
+        data = req.get_json(silent=True) or {}
+        scanned = [str(c).strip() for c in (data.get('codes') or []) if str(c).strip()]
+        if not scanned: return https_fn.Response("Missing codes", status=400)
+        if len(scanned) > QR_MAX_CODES: return https_fn.Response(f"At most {QR_MAX_CODES} codes per request", status=400)
 
-        doc_ref = db.collection('inventory_items').document(item_id)
-        doc = doc_ref.get()
-        if not doc.exists: return https_fn.Response("Item not found", status=404, headers=headers)
-        
-        item_data = doc.to_dict()
-        if item_data.get('status') not in ['AVAILABLE', 'NOT_FOR_SALE']:
-            return https_fn.Response("Item cannot be booked", status=400, headers=headers)
+        unique_codes = list(dict.fromkeys(scanned))
+        items = lookup_qr_codes(unique_codes)
 
-        try:
-            exp_date = datetime.datetime.fromisoformat(expired_at_str).replace(hour=23, minute=59, second=59)
-        except ValueError:
-             return https_fn.Response("Invalid date format", status=400, headers=headers)
-             
-        now = datetime.datetime.now()
+        product_refs = [db.collection('products').document(pid) for pid in {i['product_id'] for i in items.values() if i.get('product_id')}]
+        products = {}
+        if product_refs:
+            for snap in db.get_all(product_refs, field_paths=SCAN_PRODUCT_FIELDS):
+                if snap.exists: products[snap.id] = snap.to_dict()
 
-        update_data = {
+        results = []
+        seen = set()
+        for code in scanned:
+            item = items.get(code)
+            entry = {'code': code, 'found': item is not None, 'duplicate': code in seen}
+            seen.add(code)
+            if item:
+                p = products.get(item.get('product_id'), {})
+                entry['item'] = {
+                    **item,
+                    'product_brand': p.get('brand'),
+                    'product_category': p.get('category'),
+                    'product_collection': p.get('collection'),
+                    'product_code': p.get('code'),
+                    'product_image_url': p.get('image_url'),
+                    'product_is_not_for_sale': p.get('is_not_for_sale', False),
+                }
+            results.append(entry)
+
+        unknown = [code for code in unique_codes if code not in items]
+        result = {
+            'data': results,
+            'unknown': unknown,
+            'summary': {'scanned': len(scanned), 'unique': len(unique_codes), 'found': len(unique_codes) - len(unknown), 'unknown': len(unknown)},
+        }
+        return https_fn.Response(dumps(result), status=200, mimetype='application/json')
+    except Exception as e:
+        return https_fn.Response(str(e), status=500)
+
+# --- ACTION FUNCTIONS ---
+
+def parse_booking_expiry(expired_at_str):
+    """Booking expiry date (YYYY-MM-DD or ISO) -> end of that day, tz-aware. Raises ValueError."""
+    exp_date = datetime.datetime.fromisoformat(expired_at_str).replace(hour=23, minute=59, second=59)
+    if exp_date.tzinfo is None: exp_date = exp_date.replace(tzinfo=datetime.timezone.utc)
+    return exp_date
+
+def booking_update_builder(booked_by, system_user, notes, exp_date):
+    now = datetime.datetime.now()
+
+    def build_update(item_data):
+        return {
             'status': 'BOOKED',
             'booking': {
                 'booked_by': booked_by,
                 'system_user': system_user,
                 'booked_at': now.isoformat(),
-                'expired_at': exp_date.isoformat(),
+                'expired_at': exp_date,
                 'notes': notes
             },
-            'history_log': firestore.ArrayUnion([{
+            'history_event': {
                 'action': 'BOOKED',
                 'location': item_data.get('current_location', ''),
                 'date': now,
                 'note': f"Booked for {booked_by} by {system_user}"
-            }])
+            }
+        }
+    return build_update
+
+def release_update_builder():
+    now = datetime.datetime.now()
+
+    def build_update(item_data):
+        return {
+            'status': 'AVAILABLE',
+            'booking': firestore.DELETE_FIELD,
+            'history_event': {
+                'action': 'RELEASED',
+                'location': item_data.get('current_location', ''),
+                'date': now,
+                'note': "Booking released manually"
+            }
         }
+    return build_update
+
+@instrumented
+@endpoint('POST')
+def book_item(req: https_fn.Request) -> https_fn.Response:
+    try:
+        data = req.get_json()
+        item_id = data.get('item_id')
+        booked_by = data.get('booked_by', 'Unknown')
+        system_user = data.get('system_user', 'System')
+        notes = data.get('notes', '')
+        expired_at_str = data.get('expired_at')
         
-        doc_ref.update(update_data)
-        update_product_counters(item_data['product_id'])
+        if not expired_at_str: return https_fn.Response("Missing expiration date", status=400)
+
+        try:
+            exp_date = parse_booking_expiry(expired_at_str)
+        except ValueError:
+             return https_fn.Response("Invalid date format", status=400)
+
+        doc_ref = db.collection('inventory_items').document(item_id)
+        shard_count = get_item_shard_count(doc_ref)
+        if shard_count is None: return https_fn.Response("Item not found", status=404)
+
+        build_update = booking_update_builder(booked_by, system_user, notes, exp_date)
+        item_data, error = apply_item_transition(db.transaction(), doc_ref, shard_count, build_update, ['AVAILABLE', 'NOT_FOR_SALE'])
+        if item_data is None: return https_fn.Response("Item not found", status=404)
+        if error: return https_fn.Response("Item cannot be booked", status=400)
+        lower_expiry_watermark(db.transaction(), exp_date)
         
-        return https_fn.Response(json.dumps({'success': True}), status=200, headers=headers, mimetype='application/json')
+        return https_fn.Response(json.dumps({'success': True}), status=200, mimetype='application/json')
     except Exception as e:
-        return https_fn.Response(str(e), status=500, headers=headers)
+        return https_fn.Response(str(e), status=500)
 
+@instrumented
+@endpoint('POST')
 def release_item(req: https_fn.Request) -> https_fn.Response:
-    headers = {'Access-Control-Allow-Origin': '*', 'Access-Control-Allow-Methods': 'POST', 'Access-Control-Allow-Headers': 'Content-Type'}
-    if req.method == 'OPTIONS': return https_fn.Response('', status=204, headers=headers)
-
     try:
         data = req.get_json()
         item_id = data.get('item_id')
         
         doc_ref = db.collection('inventory_items').document(item_id)
-        doc = doc_ref.get()
-        item_data = doc.to_dict()
-        
-        update_data = {
-            'status': 'AVAILABLE',
-            'booking': firestore.DELETE_FIELD,
-            'history_log': firestore.ArrayUnion([{
-                'action': 'RELEASED',
-                'location': item_data.get('current_location', ''),
-                'date': datetime.datetime.now(),
-                'note': "Booking released manually"
-            }])
-        }
-        
-        doc_ref.update(update_data)
-        update_product_counters(item_data['product_id'])
+        shard_count = get_item_shard_count(doc_ref)
+        if shard_count is None: return https_fn.Response("Item not found", status=404)
+
+        item_data, error = apply_item_transition(db.transaction(), doc_ref, shard_count, release_update_builder(), ['BOOKED'])
+        if item_data is None: return https_fn.Response("Item not found", status=404)
+        if error: return https_fn.Response("Item is not booked", status=400)
         
-        return https_fn.Response(json.dumps({'success': True}), status=200, headers=headers, mimetype='application/json')
+        return https_fn.Response(json.dumps({'success': True}), status=200, mimetype='application/json')
+    except Exception as e:
+        return https_fn.Response(str(e), status=500)
+
+# --- BATCH ACTION FUNCTIONS ---
+
+def transition_response(item_ids, results):
+    """Per-item results in request order: {success, succeeded, results: [{item_id, success, error}]}."""
+    rows = [{'item_id': i, 'success': results.get(i) is None, 'error': results.get(i)} for i in dict.fromkeys(item_ids)]
+    succeeded = sum(1 for r in rows if r['success'])
+    body = {'success': succeeded == len(rows), 'succeeded': succeeded, 'results': rows}
+    return https_fn.Response(json.dumps(body), status=200, mimetype='application/json')
+
+@instrumented
+@endpoint('POST')
+def book_items(req: https_fn.Request) -> https_fn.Response:
+    """
+    Books many items for one client. Body: item_ids plus the book_item fields.
+    Items of the same product are booked in one transaction; each item gets its own result.
+    """
+    try:
+        data = req.get_json()
+        item_ids = [i for i in data.get('item_ids', []) if i]
+        if not item_ids: return https_fn.Response("Missing item_ids", status=400)
+        if not data.get('expired_at'): return https_fn.Response("Missing expiration date", status=400)
+
+        try:
+            exp_date = parse_booking_expiry(data.get('expired_at'))
+        except ValueError:
+             return https_fn.Response("Invalid date format", status=400)
+
+        build_update = booking_update_builder(data.get('booked_by', 'Unknown'), data.get('system_user', 'System'), data.get('notes', ''), exp_date)
+        results = transition_items(item_ids, build_update, ['AVAILABLE', 'NOT_FOR_SALE'])
+        if any(error is None for error in results.values()): lower_expiry_watermark(db.transaction(), exp_date)
+        return transition_response(item_ids, results)
+    except Exception as e:
+        return https_fn.Response(str(e), status=500)
+
+@instrumented
+@endpoint('POST')
+def release_items(req: https_fn.Request) -> https_fn.Response:
+    """Releases many BOOKED items. Body: item_ids. Returns one result per item."""
+    try:
+        data = req.get_json()
+        item_ids = [i for i in data.get('item_ids', []) if i]
+        if not item_ids: return https_fn.Response("Missing item_ids", status=400)
+
+        results = transition_items(item_ids, release_update_builder(), ['BOOKED'])
+        return transition_response(item_ids, results)
     except Exception as e:
-        return https_fn.Response(str(e), status=500, headers=headers)
\ No newline at end of file
+        return https_fn.Response(str(e), status=500)
@@ -0,0 +1,122 @@
+import copy
+import time
+import threading
+from firebase_functions import logger
+from .config import db
+
+# --- READ-THROUGH CACHE ---
+# settings/global and the discounts collection are read on almost every request
+# but change rarely. A warm instance keeps them in memory: the first read loads
+# the data and attaches a snapshot listener that refreshes the entry whenever the
+# document/collection changes. Every entry also expires after CACHE_TTL, so a
+# listener that silently stops delivering can never keep stale data longer than that;
+# if no listener can be attached the TTL alone applies.
+# Writers on this instance also call invalidate() so their own reads are fresh.
+CACHE_TTL = 300  # seconds
+DEFAULT_SETTINGS = {'eur_rate': 17000, 'usd_rate': 15500}
+
+_lock = threading.Lock()
+_entries = {}      # key -> {'value': ..., 'loaded_at': float}
+_listeners = {}    # key -> watch handle
+_stats = {'hits': 0, 'misses': 0, 'refreshes': 0, 'invalidations': 0}
+
+def _store(key, value):
+    with _lock:
+        _entries[key] = {'value': value, 'loaded_at': time.monotonic()}
+
+def _get(key, loader, watcher=None, ttl=CACHE_TTL):
+    with _lock:
+        entry = _entries.get(key)
+        watch = _listeners.get(key)
+        if watch is not None and not getattr(watch, 'is_active', True):
+            # The listener stream died; forget it so the entry reloads and re-attaches
+            _listeners.pop(key)
+        fresh = entry is not None and time.monotonic() - entry['loaded_at'] < ttl
+        _stats['hits' if fresh else 'misses'] += 1
+    if fresh: return entry['value']
+
+    value = loader()
+    _store(key, value)
+    if watcher is not None and key not in _listeners:
+        try:
+            handle = watcher()
+            with _lock: _listeners[key] = handle
+        except Exception as e:
+            logger.warn(f"Cache listener for '{key}' unavailable, relying on the TTL", key=key, error=str(e))
+    return value
+
+# --- SETTINGS ---
+
+def _load_settings():
+    doc = db.collection('settings').document('global').get()
+    return doc.to_dict() if doc.exists else dict(DEFAULT_SETTINGS)
+
+def _watch_settings():
+    def on_change(doc_snapshot, changes, read_time):
+        for doc in doc_snapshot:
+            _store('settings', doc.to_dict() if doc.exists else dict(DEFAULT_SETTINGS))
+            with _lock: _stats['refreshes'] += 1
+    return db.collection('settings').document('global').on_snapshot(on_change)
+
+def get_settings():
+    """settings/global as a dict (defaults when missing). Returns a copy the caller may mutate."""
+    return copy.deepcopy(_get('settings', _load_settings, _watch_settings))
+
+def get_exchange_rates_cached():
+    """(eur_rate, usd_rate) from the cached settings."""
+    settings = _get('settings', _load_settings, _watch_settings)
+    return settings.get('eur_rate', DEFAULT_SETTINGS['eur_rate']), settings.get('usd_rate', DEFAULT_SETTINGS['usd_rate'])
+
+# --- DISCOUNTS ---
+
+def _build_discounts(docs):
+    rules = {}
+    for doc in docs:
+        d = doc.to_dict()
+        d['id'] = doc.id
+        rules[doc.id] = d
+    names = {d['name']: rid for rid, d in rules.items() if d.get('name')}
+    return {'rules': rules, 'names': names}
+
+def _load_discounts():
+    return _build_discounts(db.collection('discounts').stream())
+
+def _watch_discounts():
+    def on_change(col_snapshot, changes, read_time):
+        _store('discounts', _build_discounts(col_snapshot))
+        with _lock: _stats['refreshes'] += 1
+    return db.collection('discounts').on_snapshot(on_change)
+
+def get_discount_rules():
+    """All discount rules (each with 'id'), as copies the caller may mutate."""
+    cached = _get('discounts', _load_discounts, _watch_discounts)
+    return [copy.deepcopy(d) for d in cached['rules'].values()]
+
+def find_discount_by_name(name):
+    """Id of the rule named exactly `name`, or None."""
+    cached = _get('discounts', _load_discounts, _watch_discounts)
+    return cached['names'].get(name)
+
+# --- CATALOG VERSION ---
+# get_all_products builds its ETag from the catalog version, which costs three queries.
+# No single listener covers every product write, so the token is TTL-only and short:
+# interactive writers on this instance invalidate('catalog_version'), and any other
+# write (task queues, other instances) reaches the ETag within CATALOG_VERSION_TTL.
+CATALOG_VERSION_TTL = 5  # seconds
+
+def get_catalog_version_cached(loader):
+    """The catalog version token, reloaded through `loader` at most every CATALOG_VERSION_TTL."""
+    return _get('catalog_version', loader, ttl=CATALOG_VERSION_TTL)
+
+# --- CONTROL ---
+
+def invalidate(key=None):
+    """Drops one entry ('settings' / 'discounts' / 'catalog_version') or all of them; the next read reloads."""
+    with _lock:
+        if key is None: _entries.clear()
+        else: _entries.pop(key, None)
+        _stats['invalidations'] += 1
+
+def cache_stats():
+    with _lock:
+        return {**_stats, 'entries': sorted(_entries), 'listeners': sorted(_listeners)}
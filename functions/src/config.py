@@ -1,9 +1,17 @@
 import firebase_admin
-from firebase_admin import credentials, firestore, storage, initialize_app
+from firebase_admin import credentials, firestore, initialize_app
 
 # Initialize Firebase App
 if not firebase_admin._apps:
     initialize_app()
 
 # Export the DB client to be used elsewhere
-db = firestore.client()
\ No newline at end of file
+db = firestore.client()
+
+def get_bucket():
+    """
+    Default Storage bucket. Created on demand so functions that never touch
+    Storage don't pay for the client; honours STORAGE_EMULATOR_HOST locally.
+    """
+    from firebase_admin import storage  # pulls in google-cloud-storage; only export/import need it
+    return storage.bucket()
\ No newline at end of file
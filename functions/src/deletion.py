@@ -0,0 +1,226 @@
+from firebase_functions import https_fn, tasks_fn, scheduler_fn
+from firebase_functions.options import RetryConfig, RateLimits
+from firebase_admin import firestore, functions
+import json
+import time
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from .config import db, get_bucket
+from .responses import endpoint
+from .metrics import instrumented, in_context
+from .utils import dumps
+from .inventory import HISTORY_COLLECTION
+from .cache import invalidate as invalidate_cache
+from .batching import BATCH_LIMIT, MAX_WORKERS, commit_with_retry, commit_chunks_parallel, pack_groups, split_ops
+
+# --- CASCADE DELETE ---
+# delete_product marks the product pending_deletion (readers hide it and a tombstone
+# tells delta-sync clients right away), then a job removes, in order:
+#   items  - inventory_items pages, each item together with its history sub-collection
+#   storage - the product image, unless another product still uses it
+#   product - counter shards and finally the product doc itself
+# Progress is checkpointed on deletion_jobs/{product_id}. Every phase only deletes
+# what is still there, so a retried or resumed job rolls forward from wherever the
+# previous run stopped. Small products finish inside the request; larger ones continue
+# on the run_product_deletion task queue. The items phase only ends once no unit job
+# is writing for the product (it cancels itself when it sees pending_deletion).
+DELETION_PAGE_SIZE = 200
+DELETION_INLINE_BUDGET = 20  # seconds spent in the request before handing off to the queue
+DELETION_TASK_BUDGET = 240   # seconds per task, well below the task timeout
+DELETION_STALE_AFTER = datetime.timedelta(minutes=10)
+DELETION_PHASES = ('items', 'storage', 'product')
+DELETION_UNIT_WAIT = 5  # seconds between checks while a unit job is still writing items
+
+def enqueue_product_deletion(job_id):
+    queue = functions.task_queue("locations/asia-southeast2/functions/run_product_deletion")  # the task function is deployed in asia-southeast2, not the default us-central1
+    queue.enqueue({'job_id': job_id})
+
+def start_product_deletion(product_id):
+    """Marks the product pending deletion and creates its job; an unfinished job is resumed as is."""
+    job_ref = db.collection('deletion_jobs').document(product_id)
+    job_snap = job_ref.get()
+    if job_snap.exists and job_snap.to_dict().get('status') in ('PENDING', 'RUNNING'): return job_ref.id
+
+    product_ref = db.collection('products').document(product_id)
+    product_snap = product_ref.get(['image_url'])
+    batch = db.batch()
+    if product_snap.exists:
+        batch.update(product_ref, {'pending_deletion': True, 'updated_at': firestore.SERVER_TIMESTAMP})
+    # Tombstone so delta-sync clients learn about the deletion
+    batch.set(db.collection('deleted_products').document(product_id), {'id': product_id, 'updated_at': firestore.SERVER_TIMESTAMP})
+    # Also created when the product doc is already gone, to clean up orphaned items
+    batch.set(job_ref, {
+        'id': product_id,
+        'product_id': product_id,
+        'status': 'PENDING',
+        'phase': DELETION_PHASES[0],
+        'image_url': (product_snap.to_dict() or {}).get('image_url', '') if product_snap.exists else '',
+        'deleted_items': 0,
+        'deleted_history': 0,
+        'deleted_images': 0,
+        'created_at': firestore.SERVER_TIMESTAMP,
+        'updated_at': firestore.SERVER_TIMESTAMP
+    })
+    batch.commit()
+    invalidate_cache('catalog_version')
+    return job_ref.id
+
+def item_deletion_ops(item_ref):
+    """The item's history deletes followed by the item delete itself."""
+    history = [('delete', ref, None) for ref in item_ref.collection(HISTORY_COLLECTION).list_documents()]
+    return history + [('delete', item_ref, None)]
+
+def delete_item_page(product_id):
+    """
+    Deletes one page of the product's items with parallel bounded batches.
+    Returns (items_deleted, history_deleted, more_left). An item is only deleted in
+    the same batch as, or after, the last of its history docs, so nothing is orphaned.
+    """
+    query = db.collection('inventory_items').where('product_id', '==', product_id).select([]).limit(DELETION_PAGE_SIZE)
+    item_refs = [doc.reference for doc in query.stream()]
+    if not item_refs: return 0, 0, False
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        # One context copy per task: a Context can't be entered by two threads at once
+        futures = [executor.submit(in_context(item_deletion_ops), ref) for ref in item_refs]
+        item_ops = [future.result() for future in futures]
+
+    items_deleted, history_deleted = 0, 0
+    groups = []
+    for item_ref, ops in zip(item_refs, item_ops):
+        if len(ops) > BATCH_LIMIT:
+            for chunk in split_ops(ops[:-1]): commit_with_retry(chunk)
+            commit_with_retry(ops[-1:])
+            items_deleted += 1
+            history_deleted += len(ops) - 1
+        else:
+            groups.append((item_ref.id, ops))
+    sizes = dict(groups)
+    results = commit_chunks_parallel(pack_groups(groups))
+    for r in results:
+        if r['status'] != 'ok': continue
+        items_deleted += len(r['keys'])
+        history_deleted += sum(len(sizes[key]) - 1 for key in r['keys'])
+    failed = [r['error'] for r in results if r['status'] == 'failed']
+    if failed: raise RuntimeError(f"Deleting items failed for {len(failed)} chunk(s): {failed[0]}")
+    return items_deleted, history_deleted, len(item_refs) == DELETION_PAGE_SIZE
+
+def unit_job_running(product_id):
+    """True while a unit creation job still holds its mark on the product."""
+    snap = db.collection('products').document(product_id).get(['unit_job_id'])
+    return snap.exists and bool((snap.to_dict() or {}).get('unit_job_id'))
+
+def delete_product_image(product_id, image_url):
+    """Deletes the product's image object unless another product still references it. Returns 0 or 1."""
+    if not image_url: return 0
+    others = db.collection('products').where('image_url', '==', image_url).select([]).limit(2).stream()
+    if any(doc.id != product_id for doc in others): return 0
+    from google.api_core.exceptions import NotFound
+    try:
+        get_bucket().blob(image_url).delete()
+        return 1
+    except NotFound:
+        return 0
+
+def delete_product_doc(product_id):
+    product_ref = db.collection('products').document(product_id)
+    ops = [('delete', ref, None) for ref in product_ref.collection('counter_shards').list_documents()]
+    for chunk in split_ops(ops): commit_with_retry(chunk)
+    batch = db.batch()
+    batch.delete(product_ref)
+    batch.commit()
+
+def process_product_deletion(job_id, time_budget=DELETION_TASK_BUDGET):
+    """
+    Runs (or resumes) a deletion job from its checkpoint until done or out of time.
+    Returns True when the job finished.
+    """
+    job_ref = db.collection('deletion_jobs').document(job_id)
+    job_snap = job_ref.get()
+    if not job_snap.exists: return True
+    job = job_snap.to_dict()
+    if job.get('status') == 'DONE': return True
+
+    product_id = job['product_id']
+    phase = job.get('phase', DELETION_PHASES[0])
+    job_ref.update({'status': 'RUNNING', 'updated_at': firestore.SERVER_TIMESTAMP})
+    started = time.monotonic()
+
+    while time.monotonic() - started < time_budget:
+        progress = {}
+        if phase == 'items':
+            try:
+                items, history, more = delete_item_page(product_id)
+            except Exception as e:
+                job_ref.update({'error': str(e), 'updated_at': firestore.SERVER_TIMESTAMP})
+                raise
+            progress = {'deleted_items': firestore.Increment(items), 'deleted_history': firestore.Increment(history)}
+            if not more:
+                # Units written by a still running unit job would be orphaned; page again after it stopped
+                if unit_job_running(product_id): time.sleep(DELETION_UNIT_WAIT)
+                else: phase = 'storage'
+        elif phase == 'storage':
+            progress = {'deleted_images': delete_product_image(product_id, job.get('image_url'))}
+            phase = 'product'
+        else:
+            delete_product_doc(product_id)
+            job_ref.update({'status': 'DONE', 'phase': 'done', 'error': None, 'updated_at': firestore.SERVER_TIMESTAMP})
+            return True
+        job_ref.update({**progress, 'phase': phase, 'updated_at': firestore.SERVER_TIMESTAMP})
+    return False
+
+@instrumented
+@endpoint('DELETE')
+def delete_product(req: https_fn.Request) -> https_fn.Response:
+    """
+    Deletes a product with its items, their history and its image.
+    Answers 200 when everything was removed within the request, otherwise 202
+    with the job id to poll via get_deletion_job. Calling it again resumes the job.
+    """
+    try:
+        data = req.get_json()
+        product_id = data.get('product_id')
+        if not product_id: return https_fn.Response("Missing id", status=400)
+
+        job_id = start_product_deletion(product_id)
+        if process_product_deletion(job_id, DELETION_INLINE_BUDGET):
+            return https_fn.Response(json.dumps({'success': True, 'job_id': job_id, 'status': 'DONE'}), status=200, mimetype='application/json')
+        enqueue_product_deletion(job_id)
+        return https_fn.Response(json.dumps({'success': True, 'job_id': job_id, 'status': 'RUNNING'}), status=202, mimetype='application/json')
+    except Exception as e:
+        return https_fn.Response(str(e), status=500)
+
+@tasks_fn.on_task_dispatched(
+    retry_config=RetryConfig(max_attempts=5, min_backoff_seconds=30),
+    rate_limits=RateLimits(max_concurrent_dispatches=2),
+    region="asia-southeast2",
+    timeout_sec=300
+)
+@instrumented
+def run_product_deletion(req: tasks_fn.CallableRequest) -> None:
+    job_id = req.data.get('job_id')
+    if job_id and not process_product_deletion(job_id):
+        enqueue_product_deletion(job_id)
+
+@scheduler_fn.on_schedule(schedule="every 10 minutes", region="asia-southeast2")
+@instrumented
+def resume_stalled_deletions(event: scheduler_fn.ScheduledEvent) -> None:
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - DELETION_STALE_AFTER
+    for status in ('PENDING', 'RUNNING'):
+        for doc in db.collection('deletion_jobs').where('status', '==', status).stream():
+            if doc.to_dict().get('updated_at') and doc.to_dict()['updated_at'] < cutoff:
+                enqueue_product_deletion(doc.id)
+
+@instrumented
+@endpoint('GET')
+def get_deletion_job(req: https_fn.Request) -> https_fn.Response:
+    job_id = req.args.get('job_id')
+    if not job_id: return https_fn.Response("Missing job_id", status=400)
+
+    try:
+        doc = db.collection('deletion_jobs').document(job_id).get()
+        if not doc.exists: return https_fn.Response("Job not found", status=404)
+        return https_fn.Response(dumps({'data': doc.to_dict()}), status=200, mimetype='application/json')
+    except Exception as e:
+        return https_fn.Response(str(e), status=500)
@@ -0,0 +1,209 @@
+from firebase_functions import https_fn, firestore_fn, scheduler_fn, logger
+from firebase_admin import firestore
+import json
+import datetime
+import hashlib
+
+from .config import db
+from .responses import endpoint
+from .metrics import instrumented
+from .utils import dumps
+from .inventory import COUNTER_FIELDS, merge_counter_shards, sum_counter_shards
+from .batching import commit_chunks_parallel, pack_groups
+
+# --- FACET AGGREGATES ---
+# inventory_tree holds one document per brand with product counts, stock counters
+# and stock value for the brand, each of its categories and each collection:
+#   {brand, totals, categories: {category: {totals, collections: {collection: totals}}}}
+# Only products listed in the BRAND/CATEGORY tabs count (not NFS, not upcoming,
+# not pending deletion).
+# Firestore triggers on products and their counter shards apply the difference of
+# every write as increments; rebuild_inventory_tree recomputes everything from scratch.
+# Triggers can fire more than once, so each event id is recorded with its increments.
+FACET_COLLECTION = 'inventory_tree'
+FACET_EVENTS_COLLECTION = 'inventory_tree_events'
+FACET_EVENT_TTL_DAYS = 7  # expire_at carries the TTL policy declared in firestore.indexes.json
+FACET_FIELDS = ('products',) + COUNTER_FIELDS + ('stock_value_idr',)
+FACET_PRODUCT_FIELDS = ['brand', 'category', 'collection', 'retail_price_idr', 'is_not_for_sale', 'is_upcoming', 'pending_deletion', 'counter_shards'] + list(COUNTER_FIELDS)
+
+def facet_doc_id(brand):
+    # Brand names are free text; hashing keeps them valid as document ids
+    return hashlib.sha1(brand.encode()).hexdigest()[:20]
+
+def facet_node(product):
+    """(brand, category, collection) of a product, 'Unknown' for blanks like the client tree."""
+    return tuple((product.get(f) or '').strip() or 'Unknown' for f in ('brand', 'category', 'collection'))
+
+def facet_contribution(product, counters=None):
+    """What one product adds to its node; counters overrides the product's own (e.g. shard totals)."""
+    if not product or product.get('is_not_for_sale') or product.get('is_upcoming') or product.get('pending_deletion'): return {}
+    counters = counters if counters is not None else product
+    values = {f: int(counters.get(f, 0) or 0) for f in COUNTER_FIELDS}
+    values['products'] = 1 if counters is product else 0
+    values['stock_value_idr'] = values['total_stock'] * int(product.get('retail_price_idr', 0) or 0)
+    return {facet_node(product): values}
+
+def diff_contributions(before, after):
+    """after - before per node, dropping zero values and empty nodes."""
+    deltas = {}
+    for sign, contribution in ((-1, before), (1, after)):
+        for node, values in contribution.items():
+            node_delta = deltas.setdefault(node, {f: 0 for f in FACET_FIELDS})
+            for f, v in values.items(): node_delta[f] += sign * v
+    return {node: {f: v for f, v in d.items() if v} for node, d in deltas.items() if any(d.values())}
+
+def facet_updates(deltas, as_increments=True):
+    """Groups node deltas into one nested merge payload per brand document."""
+    wrap = firestore.Increment if as_increments else (lambda v: v)
+    docs = {}
+    for (brand, category, collection), values in deltas.items():
+        doc = docs.setdefault(brand, {'brand': brand, 'totals': {}, 'categories': {}})
+        cat = doc['categories'].setdefault(category, {'totals': {}, 'collections': {}})
+        coll = cat['collections'].setdefault(collection, {})
+        for f, v in values.items():
+            for target in (doc['totals'], cat['totals'], coll):
+                target[f] = target.get(f, 0) + v
+    for doc in docs.values():
+        for target in [doc['totals']] + [c['totals'] for c in doc['categories'].values()] + [t for c in doc['categories'].values() for t in c['collections'].values()]:
+            for f in target: target[f] = wrap(target[f])
+        doc['updated_at'] = firestore.SERVER_TIMESTAMP
+    return docs
+
+@firestore.transactional
+def apply_facet_deltas(transaction, event_id, deltas):
+    """Applies the increments once per trigger event; returns False for a redelivered event."""
+    marker = db.collection(FACET_EVENTS_COLLECTION).document(event_id)
+    if marker.get(transaction=transaction).exists: return False
+    for brand, update in facet_updates(deltas).items():
+        transaction.set(db.collection(FACET_COLLECTION).document(facet_doc_id(brand)), update, merge=True)
+    expire_at = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=FACET_EVENT_TTL_DAYS)
+    transaction.set(marker, {'applied_at': firestore.SERVER_TIMESTAMP, 'expire_at': expire_at})
+    return True
+
+def snapshot_dict(snap):
+    return snap.to_dict() if snap is not None and snap.exists else None
+
+# --- TRIGGERS ---
+
+@firestore_fn.on_document_written(document="products/{productId}", region="asia-southeast2")
+@instrumented
+def on_product_written(event: firestore_fn.Event[firestore_fn.Change[firestore_fn.DocumentSnapshot | None]]) -> None:
+    before, after = snapshot_dict(event.data.before), snapshot_dict(event.data.after)
+    shard_totals = None
+    if (after or before or {}).get('counter_shards'):
+        # Shard deltas are counted by their own trigger; only the value of those units re-prices here
+        shard_totals = sum_counter_shards(event.params['productId'])
+    contributions = []
+    for product in (before, after):
+        contribution = facet_contribution(product)
+        if shard_totals and contribution:
+            shard_value = facet_contribution(product, {'total_stock': shard_totals['total_stock']})
+            for node, values in shard_value.items(): contribution[node]['stock_value_idr'] += values['stock_value_idr']
+        contributions.append(contribution)
+    deltas = diff_contributions(*contributions)
+    if deltas: apply_facet_deltas(db.transaction(), event.id, deltas)
+
+@firestore_fn.on_document_written(document="products/{productId}/counter_shards/{shardId}", region="asia-southeast2")
+@instrumented
+def on_counter_shard_written(event: firestore_fn.Event[firestore_fn.Change[firestore_fn.DocumentSnapshot | None]]) -> None:
+    before, after = snapshot_dict(event.data.before) or {}, snapshot_dict(event.data.after) or {}
+    shard_delta = {f: int(after.get(f, 0) or 0) - int(before.get(f, 0) or 0) for f in COUNTER_FIELDS}
+    if not any(shard_delta.values()): return
+    product = snapshot_dict(db.collection('products').document(event.params['productId']).get(FACET_PRODUCT_FIELDS))
+    # A deleted product already left the tree; rebuild_inventory_tree settles any remainder
+    if not product: return
+    deltas = diff_contributions({}, facet_contribution(product, shard_delta))
+    if deltas: apply_facet_deltas(db.transaction(), event.id, deltas)
+
+# --- REBUILD ---
+
+def rebuild_facets():
+    """
+    Recomputes every brand document from the products (shards merged) and removes
+    brands that no longer have listed products. Returns the number of brands written.
+    """
+    contributions = {}
+    for doc in db.collection('products').select(FACET_PRODUCT_FIELDS).stream():
+        product = merge_counter_shards({**doc.to_dict(), 'id': doc.id})
+        for node, values in facet_contribution(product).items():
+            totals = contributions.setdefault(node, {f: 0 for f in FACET_FIELDS})
+            for f, v in values.items(): totals[f] += v
+
+    docs = facet_updates(contributions, as_increments=False)
+    groups = [(brand, [('set', db.collection(FACET_COLLECTION).document(facet_doc_id(brand)), doc)]) for brand, doc in docs.items()]
+    keep = {facet_doc_id(brand) for brand in docs}
+    groups += [(doc.id, [('delete', doc.reference, None)]) for doc in db.collection(FACET_COLLECTION).select([]).stream() if doc.id not in keep]
+    results = commit_chunks_parallel(pack_groups(groups))
+    failed = [r['error'] for r in results if r['status'] == 'failed']
+    if failed: raise RuntimeError(f"Inventory tree rebuild failed for {len(failed)} chunk(s): {failed[0]}")
+    return len(docs)
+
+# --- READ ---
+
+def facet_totals(values):
+    return {f: values.get(f, 0) for f in FACET_FIELDS}
+
+def build_tree(brand_docs, by='brand'):
+    """
+    Nested list of nodes {key, totals, subgroups}, sorted by key and skipping empty nodes.
+    by='brand': brand -> category -> collection; by='category': category -> brand -> collection.
+    """
+    def listed(values): return values.get('products', 0) > 0
+
+    if by == 'category':
+        pivot = {}
+        for doc in brand_docs:
+            for category, cat in (doc.get('categories') or {}).items():
+                node = pivot.setdefault(category, {'totals': {f: 0 for f in FACET_FIELDS}, 'brands': {}})
+                if not listed(cat.get('totals', {})): continue
+                for f in FACET_FIELDS: node['totals'][f] += cat['totals'].get(f, 0)
+                node['brands'][doc['brand']] = cat
+        return [
+            {'key': category, 'totals': node['totals'], 'subgroups': [
+                {'key': brand, 'totals': facet_totals(cat['totals']), 'subgroups': [
+                    {'key': coll, 'totals': facet_totals(values), 'subgroups': []}
+                    for coll, values in sorted(cat.get('collections', {}).items()) if listed(values)
+                ]} for brand, cat in sorted(node['brands'].items())
+            ]} for category, node in sorted(pivot.items()) if listed(node['totals'])
+        ]
+
+    return [
+        {'key': doc['brand'], 'totals': facet_totals(doc.get('totals', {})), 'subgroups': [
+            {'key': category, 'totals': facet_totals(cat.get('totals', {})), 'subgroups': [
+                {'key': coll, 'totals': facet_totals(values), 'subgroups': []}
+                for coll, values in sorted(cat.get('collections', {}).items()) if listed(values)
+            ]} for category, cat in sorted((doc.get('categories') or {}).items()) if listed(cat.get('totals', {}))
+        ]} for doc in sorted(brand_docs, key=lambda d: d.get('brand', '')) if listed(doc.get('totals', {}))
+    ]
+
+@instrumented
+@endpoint('GET', cache_control='no-cache')
+def get_inventory_tree(req: https_fn.Request) -> https_fn.Response:
+    """
+    Brand/category/collection tree with product counts, stock counters and stock value,
+    read from the materialized aggregates. Query param by=brand (default) or by=category.
+    """
+    try:
+        by = req.args.get('by', 'brand')
+        if by not in ('brand', 'category'): return https_fn.Response("by must be 'brand' or 'category'", status=400)
+        brand_docs = [doc.to_dict() for doc in db.collection(FACET_COLLECTION).stream()]
+        return https_fn.Response(dumps({'data': build_tree(brand_docs, by)}), status=200, mimetype='application/json')
+    except Exception as e:
+        return https_fn.Response(str(e), status=500)
+
+@instrumented
+@endpoint('POST')
+def rebuild_inventory_tree(req: https_fn.Request) -> https_fn.Response:
+    """Backfill / repair: recomputes all facet aggregates from the products."""
+    try:
+        brands = rebuild_facets()
+        return https_fn.Response(json.dumps({'success': True, 'brands': brands}), status=200, mimetype='application/json')
+    except Exception as e:
+        return https_fn.Response(str(e), status=500)
+
+@scheduler_fn.on_schedule(schedule="every day 03:30", timezone="Asia/Jakarta", region="asia-southeast2")
+@instrumented
+def scheduled_inventory_tree_rebuild(event: scheduler_fn.ScheduledEvent) -> None:
+    # Runs after the counter reconciliation so repaired counters are picked up
+    brands = rebuild_facets()
+    logger.info(f"Rebuilt inventory tree for {brands} brands", brands=brands)
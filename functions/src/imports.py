@@ -0,0 +1,433 @@
+from firebase_functions import https_fn, tasks_fn, scheduler_fn
+from firebase_functions.options import RetryConfig, RateLimits
+from firebase_admin import firestore, functions
+import uuid
+import math
+import datetime
+
+from .config import db, get_bucket
+from .responses import endpoint
+from .metrics import instrumented
+from .utils import dumps
+from .inventory import new_import_context, reserve_import_skus, build_import_product, commit_import_discounts, commit_import_groups
+
+IMPORT_CHUNK_ROWS = 200
+PREVIEW_LIMIT = 500
+ERROR_LIMIT = 200
+
+# --- FILE PARSING ---
+
+def file_extension(filename):
+    """Lower-cased extension of a supported import file; raises ValueError for anything else."""
+    ext = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+    if ext == 'xls': raise ValueError("Legacy .xls files are not supported, please save the file as .xlsx")
+    if ext not in ('csv', 'xlsx', 'xlsm'): raise ValueError("Please upload a .csv or .xlsx file")
+    return ext
+
+def iter_file_rows(fileobj, filename, chunk_rows=IMPORT_CHUNK_ROWS):
+    """
+    Yields the first sheet / CSV as lists of row dicts, chunk_rows at a time,
+    so only one chunk of the file is materialized at once.
+    """
+    ext = file_extension(filename)
+    if ext == 'csv':
+        import pandas as pd
+        for chunk in pd.read_csv(fileobj, chunksize=chunk_rows, dtype=str, keep_default_na=False, skip_blank_lines=True):
+            yield chunk.to_dict('records')
+    else:
+        from openpyxl import load_workbook
+        wb = load_workbook(fileobj, read_only=True, data_only=True)
+        try:
+            rows = wb.worksheets[0].iter_rows(values_only=True)
+            header = [str(h) if h is not None else '' for h in next(rows, [])]
+            chunk = []
+            for values in rows:
+                if all(v is None or str(v).strip() == '' for v in values): continue
+                chunk.append(dict(zip(header, values)))
+                if len(chunk) >= chunk_rows:
+                    yield chunk
+                    chunk = []
+            if chunk: yield chunk
+        finally:
+            wb.close()
+
+def normalize_row(row):
+    """Lower-cases/trims headers and turns empty cells (None/NaN) into ''."""
+    clean = {}
+    for key, value in row.items():
+        if value is None or (isinstance(value, float) and math.isnan(value)): value = ''
+        clean[str(key).strip().lower()] = value
+    return clean
+
+def get_value(row, *keys):
+    for key in keys:
+        value = row.get(key.strip().lower())
+        if value is not None: return value
+    return None
+
+def get_text(row, *keys):
+    value = get_value(row, *keys)
+    return str(value).strip() if value not in (None, '') else ''
+
+def clean_price(val):
+    if val in (None, ''): return 0
+    digits = ''.join(ch for ch in str(val) if ch.isdigit() or ch == '.')
+    try:
+        return int(float(digits)) if digits else 0
+    except ValueError:
+        return 0
+
+def parse_discounts(val):
+    if not val: return []
+    discounts = []
+    for part in str(val).replace('%', '').split('+'):
+        try:
+            value = float(part.strip())
+        except ValueError:
+            continue
+        if value > 0: discounts.append({'name': f"{part.strip()}%", 'value': value})
+    return discounts
+
+def parse_quantity(val):
+    """Returns (quantity, error)."""
+    if val in (None, ''): return 0, None
+    try:
+        qty = int(float(str(val).strip()))
+    except ValueError:
+        return 0, f"Invalid quantity '{val}'"
+    if qty < 0: return 0, f"Negative quantity '{val}'"
+    return qty, None
+
+def map_import_row(raw_row):
+    """
+    Maps a spreadsheet row to the bulk_import_products payload shape.
+    Supports the exported 'Inventory Master' schema and the legacy stock sheet.
+    Returns (p_data, errors); p_data is None for blank rows.
+    """
+    row = normalize_row(raw_row)
+    is_smart_schema = 'retail price (eur)' in row or 'not for sale' in row
+    errors = []
+
+    if is_smart_schema:
+        collection = get_text(row, 'collection name')
+        qty, qty_error = parse_quantity(get_value(row, 'total qty'))
+        nfs_val = get_text(row, 'not for sale').lower()
+        upcoming_val = get_text(row, 'upcoming').lower()
+        p_data = {
+            'id': get_text(row, 'system id'),
+            'code': get_text(row, 'manufacturer id'),
+            'retail_price_idr': clean_price(get_value(row, 'retail price (idr)')),
+            'retail_price_eur': clean_price(get_value(row, 'retail price (eur)')),
+            'retail_price_usd': clean_price(get_value(row, 'retail price (usd)')),
+            'nett_price_idr': clean_price(get_value(row, 'nett price (idr)')),
+            'is_not_for_sale': 'not for sale' in nfs_val or nfs_val == 'true',
+            'is_upcoming': 'upcoming' in upcoming_val or upcoming_val == 'true',
+            'upcoming_eta': get_text(row, 'eta'),
+            'discounts': parse_discounts(get_value(row, 'discounts')),
+            'image_url': get_text(row, 'image file'),
+            'detail': get_text(row, 'detail'),
+            'dimensions': get_text(row, 'dimensions'),
+            'finishing': get_text(row, 'finishing'),
+        }
+    else:
+        collection = get_text(row, 'collection')
+        qty, qty_error = parse_quantity(get_value(row, 'quantity', 'qty'))
+        raw_status = get_text(row, 'status').upper()
+        p_data = {
+            'id': '',
+            'code': get_text(row, 'code'),
+            'retail_price_idr': clean_price(get_value(row, 'retail price', 'retail_price_idr')),
+            'retail_price_eur': clean_price(get_value(row, 'retail price in euro', 'retail_price_eur')),
+            'retail_price_usd': clean_price(get_value(row, 'retail price in usd', 'retail_price_usd')),
+            'nett_price_idr': clean_price(get_value(row, 'nett price', 'nett_price_idr')),
+            'is_not_for_sale': 'NOT FOR SALE' in raw_status or 'NFS' in raw_status,
+            'is_upcoming': 'UPCOMING' in raw_status,
+            'upcoming_eta': get_text(row, 'eta', 'arriving_eta'),
+            'discounts': parse_discounts(get_value(row, 'discount')),
+            'image_url': get_text(row, 'image'),
+            'detail': get_text(row, 'detail', 'description'),
+            'dimensions': get_text(row, 'size', 'dimensions'),
+            'finishing': get_text(row, 'finishing'),
+        }
+
+    brand = get_text(row, 'brand')
+    if not brand and not collection: return None, []
+
+    if qty_error: errors.append(qty_error)
+    if not brand: errors.append("Missing brand")
+    if not collection: errors.append("Missing collection")
+
+    image_url = p_data['image_url']
+    p_data.update({
+        'brand': brand,
+        'category': get_text(row, 'category'),
+        'collection': collection,
+        'total_stock': qty,
+        'image_url': (image_url if 'products/' in image_url else f"products/{image_url}") if image_url else '',
+        'location': get_text(row, 'location') or 'Warehouse (Import)',
+    })
+    if not p_data['nett_price_idr']: p_data.pop('nett_price_idr')
+    return p_data, errors
+
+# --- IMPORT RUN ---
+
+def run_file_import(fileobj, filename, dry_run=False, on_progress=None, batch_name=None):
+    """
+    Parses and imports the file chunk by chunk. Each chunk is validated,
+    mapped to write ops and (unless dry_run) committed before the next chunk
+    is read. on_progress receives the progress fields after every chunk.
+    """
+    ctx = new_import_context(with_catalog_index=True, batch_name=batch_name)
+    stats = {'total_rows': 0, 'new_items': 0, 'updates': 0, 'duplicates': 0, 'invalid': 0, 'units': 0}
+    new_brands, new_categories = set(), set()
+    preview, errors, failed_products, rollback_failed = [], [], [], []
+    written = 0
+    row_no = 1  # Header row
+
+    for rows in iter_file_rows(fileobj, filename):
+        accepted = []
+        for raw_row in rows:
+            row_no += 1
+            p_data, row_errors = map_import_row(raw_row)
+            if p_data is None: continue
+            if row_errors:
+                stats['invalid'] += 1
+                if len(errors) < ERROR_LIMIT: errors.append({'row': row_no, 'errors': row_errors})
+                continue
+
+            is_update = bool(p_data['id']) and p_data['id'] in ctx['existing_ids']
+            name_key = f"{p_data['brand'].upper()}-{p_data['collection'].upper()}"
+            if not is_update:
+                p_data['id'] = ''
+                if name_key in ctx['existing_names']:
+                    stats['duplicates'] += 1
+                    continue
+                # Later rows of the same file with this name are duplicates too
+                ctx['existing_names'].add(name_key)
+
+            stats['total_rows'] += 1
+            stats['updates' if is_update else 'new_items'] += 1
+            if p_data['brand'].upper() not in ctx['existing_brands']: new_brands.add(p_data['brand'].upper())
+            if p_data['category'] and p_data['category'].upper() not in ctx['existing_categories']: new_categories.add(p_data['category'].upper())
+            accepted.append((row_no, p_data, is_update))
+
+        # One SKU counter transaction per prefix for the whole chunk
+        reserve_import_skus([p_data for _, p_data, _ in accepted], ctx, dry_run=dry_run)
+
+        groups = []
+        for row, p_data, is_update in accepted:
+            product_id, item_ops, product_op = build_import_product(p_data, ctx)
+            stats['units'] += product_op[2]['total_stock'] if not is_update else 0
+            if dry_run:
+                if len(preview) < PREVIEW_LIMIT:
+                    doc = product_op[2]
+                    preview.append({
+                        'row': row,
+                        'action': 'UPDATE' if is_update else 'INSERT',
+                        'id': product_id,
+                        'sku': doc.get('code', p_data.get('code')),
+                        'brand': doc['brand'],
+                        'collection': doc['collection'],
+                        'currency': doc['currency'],
+                        'retail_price_idr': doc['retail_price_idr'],
+                        'nett_price_idr': doc['nett_price_idr'],
+                        'total_stock': doc['total_stock'],
+                    })
+            else:
+                groups.append((product_id, item_ops, product_op))
+
+        if not dry_run and groups:
+            # Rules must exist before any product references them
+            commit_import_discounts(ctx)
+            report = commit_import_groups(groups)
+            failed_products.extend(report['failed_products'])
+            rollback_failed.extend(report['rollback_failed'])
+            written += len(groups) - len(report['failed_products'])
+
+        if on_progress is not None:
+            on_progress({
+                'rows_processed': row_no - 1,
+                'products_written': written,
+                'failed_products': failed_products,
+                'rollback_failed': rollback_failed,
+                'stats': stats,
+                'errors': errors,
+            })
+
+    stats['brands'] = len(new_brands)
+    stats['categories'] = len(new_categories)
+    return {
+        'success': not errors and not failed_products,
+        'dry_run': dry_run,
+        'batch_id': ctx['batch_name'],
+        'stats': stats,
+        'errors': errors,
+        'preview': preview,
+        'products_written': written,
+        'failed_products': failed_products,
+        'rollback_failed': rollback_failed,
+    }
+
+# --- IMPORT JOB ---
+# Only dry runs are answered inside the request. A real import runs as a job in
+# import_jobs/{job_id}: an uploaded file is first stored under IMPORT_UPLOAD_PREFIX,
+# then the run_import_job task reads it from Storage. A run claims the job with a
+# lease (owner + expiry) in a transaction and renews it with every progress write,
+# so a slow chunk never gets a second, concurrent run; a run that finds its lease
+# taken over stops. A re-run starts over from the first row: products it already
+# created are skipped as duplicates, updates are applied again, and discount rules
+# keep their ids because the job's batch id is fixed.
+IMPORT_UPLOAD_PREFIX = 'imports/'
+IMPORT_LEASE = datetime.timedelta(minutes=15)  # longest expected gap between progress writes
+
+class ImportLeaseLost(Exception):
+    pass
+
+def enqueue_file_import(job_id):
+    queue = functions.task_queue("locations/asia-southeast2/functions/run_import_job")  # the task function is deployed in asia-southeast2, not the default us-central1
+    queue.enqueue({'job_id': job_id})
+
+def lease_expiry():
+    return datetime.datetime.now(datetime.timezone.utc) + IMPORT_LEASE
+
+@firestore.transactional
+def claim_import_job(transaction, job_ref, owner):
+    """Takes the job's lease for owner; returns the job, or None when it is finished or leased by a live run."""
+    snap = job_ref.get(transaction=transaction)
+    if not snap.exists: return None
+    job = snap.to_dict()
+    if job.get('status') in ('DONE', 'FAILED'): return None
+    expires = job.get('lease_expires_at')
+    if job.get('lease_owner') and expires and expires > datetime.datetime.now(datetime.timezone.utc): return None
+    transaction.update(job_ref, {'status': 'RUNNING', 'lease_owner': owner, 'lease_expires_at': lease_expiry(), 'updated_at': firestore.SERVER_TIMESTAMP})
+    return job
+
+@firestore.transactional
+def renew_import_lease(transaction, job_ref, owner, fields):
+    """Writes fields and extends the lease, unless another run has taken the job over."""
+    snap = job_ref.get(['lease_owner'], transaction=transaction)
+    if not snap.exists or (snap.to_dict() or {}).get('lease_owner') != owner: raise ImportLeaseLost(owner)
+    transaction.update(job_ref, {**fields, 'lease_expires_at': lease_expiry(), 'updated_at': firestore.SERVER_TIMESTAMP})
+
+def process_file_import(job_id):
+    """Runs the import of a job's file and stores the result on the job doc."""
+    job_ref = db.collection('import_jobs').document(job_id)
+    owner = str(uuid.uuid4())
+    job = claim_import_job(db.transaction(), job_ref, owner)
+    if job is None: return
+
+    def on_progress(fields): renew_import_lease(db.transaction(), job_ref, owner, fields)
+
+    blob = get_bucket().blob(job['storage_path'])
+    fileobj = blob.open('rb')
+    try:
+        result = run_file_import(fileobj, job['filename'], on_progress=on_progress, batch_name=job.get('batch_id'))
+    except ImportLeaseLost:
+        return
+    except ValueError as e:
+        job_ref.update({'status': 'FAILED', 'error': str(e), 'lease_owner': None, 'updated_at': firestore.SERVER_TIMESTAMP})
+        return
+    except Exception as e:
+        # Give the lease back so the task retry can claim the job right away
+        job_ref.update({'error': str(e), 'lease_owner': None, 'updated_at': firestore.SERVER_TIMESTAMP})
+        raise
+    finally:
+        fileobj.close()
+
+    renew_import_lease(db.transaction(), job_ref, owner, {**result, 'status': 'DONE', 'error': None})
+    if job.get('uploaded'): blob.delete()
+
+@tasks_fn.on_task_dispatched(
+    retry_config=RetryConfig(max_attempts=3, min_backoff_seconds=60),
+    rate_limits=RateLimits(max_concurrent_dispatches=2),
+    region="asia-southeast2",
+    timeout_sec=1800
+)
+@instrumented
+def run_import_job(req: tasks_fn.CallableRequest) -> None:
+    job_id = req.data.get('job_id')
+    if job_id: process_file_import(job_id)
+
+@scheduler_fn.on_schedule(schedule="every 10 minutes", region="asia-southeast2")
+@instrumented
+def resume_stalled_imports(event: scheduler_fn.ScheduledEvent) -> None:
+    # Only jobs whose lease ran out (or that were never claimed) have lost their run
+    now = datetime.datetime.now(datetime.timezone.utc)
+    for status in ('PENDING', 'RUNNING'):
+        for doc in db.collection('import_jobs').where('status', '==', status).stream():
+            job = doc.to_dict()
+            # A job never claimed gets one lease period for its first task to arrive
+            expires = job.get('lease_expires_at') or (job['updated_at'] + IMPORT_LEASE if job.get('updated_at') else None)
+            if expires and expires < now: enqueue_file_import(doc.id)
+
+# --- ENDPOINTS ---
+
+@instrumented
+@endpoint('POST')
+def import_products_file(req: https_fn.Request) -> https_fn.Response:
+    """
+    Server-side import of a CSV/XLSX file.
+    Accepts multipart/form-data with 'file' or JSON {'storage_path': ...}.
+    Options (form field or JSON key): dry_run (validate and compute SKUs/prices
+    without writing), job_id (progress document in import_jobs/{job_id}).
+    A dry run answers with the full report. Otherwise the import is queued and the
+    answer is 202 with the job id; poll get_import_status until DONE or FAILED.
+    """
+    try:
+        options = req.form if req.files else (req.get_json(silent=True) or {})
+        dry_run = str(options.get('dry_run', '')).lower() in ('1', 'true', 'yes')
+        job_id = options.get('job_id') or str(uuid.uuid4())
+
+        if 'file' in req.files:
+            upload = req.files['file']
+            filename = upload.filename or ''
+        elif options.get('storage_path'):
+            filename = options['storage_path']
+        else:
+            return https_fn.Response("Missing file or storage_path", status=400)
+
+        try:
+            file_extension(filename)
+            if dry_run:
+                fileobj = upload.stream if 'file' in req.files else get_bucket().blob(filename).open('rb')
+                result = run_file_import(fileobj, filename, dry_run=True)
+                result['job_id'] = job_id
+                return https_fn.Response(dumps(result), status=200, mimetype='application/json')
+        except ValueError as e:
+            return https_fn.Response(str(e), status=400)
+
+        uploaded = 'file' in req.files
+        storage_path = f"{IMPORT_UPLOAD_PREFIX}{job_id}/{filename.rsplit('/', 1)[-1]}" if uploaded else filename
+        if uploaded: get_bucket().blob(storage_path).upload_from_file(upload.stream)
+
+        db.collection('import_jobs').document(job_id).set({
+            'id': job_id,
+            'status': 'PENDING',
+            'filename': filename,
+            'storage_path': storage_path,
+            'uploaded': uploaded,
+            'batch_id': f"IMPORT-{datetime.datetime.now().strftime('%Y%m%d-%H%M')}-{job_id[:4].upper()}",
+            'lease_owner': None,
+            'lease_expires_at': None,
+            'rows_processed': 0,
+            'products_written': 0,
+            'started_at': firestore.SERVER_TIMESTAMP,
+            'updated_at': firestore.SERVER_TIMESTAMP
+        })
+        enqueue_file_import(job_id)
+        return https_fn.Response(dumps({'success': True, 'job_id': job_id, 'status': 'PENDING'}), status=202, mimetype='application/json')
+    except Exception as e:
+        return https_fn.Response(str(e), status=500)
+
+@instrumented
+@endpoint('GET')
+def get_import_status(req: https_fn.Request) -> https_fn.Response:
+    job_id = req.args.get('job_id')
+    if not job_id: return https_fn.Response("Missing job_id", status=400)
+
+    try:
+        doc = db.collection('import_jobs').document(job_id).get()
+        if not doc.exists: return https_fn.Response("Job not found", status=404)
+        return https_fn.Response(dumps({'data': doc.to_dict()}), status=200, mimetype='application/json')
+    except Exception as e:
+        return https_fn.Response(str(e), status=500)
@@ -1,63 +1,425 @@
-from firebase_functions import https_fn
+from firebase_functions import https_fn, scheduler_fn, tasks_fn, logger
+from firebase_functions.options import RetryConfig, RateLimits
 from google.cloud.firestore_v1.base_query import FieldFilter
-from firebase_admin import firestore
+from google.cloud.firestore_v1.field_path import FieldPath
+from google.api_core import exceptions as gexc
+from firebase_admin import firestore, functions
 import json
+import time
 import uuid
 import datetime
-import io
-import pandas as pd
+import random
+import hashlib
+import tempfile
 
-from .config import db
-from .utils import serialize_doc, get_4char_segment, resolve_sku_collision
+from .config import db, get_bucket
+from .responses import endpoint
+from .metrics import instrumented
+from .utils import dumps, iter_json, build_search_keywords, SEARCH_INDEX_FIELD
+from .cache import get_catalog_version_cached, get_exchange_rates_cached, invalidate as invalidate_cache
+from .pricing import NETT_TOLERANCE, compute_retail_idr, compute_nett_price, price_arrays
+from .skus import build_base_sku, allocate_sku, reserve_skus, peek_skus
+from .batching import BATCH_LIMIT, MAX_WORKERS, commit_with_retry, commit_chunks_parallel, pack_groups, split_ops
+
+# --- HELPER: CATALOG VERSION ---
+# The version is derived from data instead of a marker doc that every write would
+# have to bump: every write that changes what get_all_products returns stamps
+# updated_at on a product, a counter shard or a deletion tombstone, so the newest
+# of those three stamps changes exactly when the catalog does. Reading it costs
+# three single-document queries; item transitions write nothing extra. Requests
+# read it through the cache (see cache.py), so a warm instance pays that at most
+# once per CATALOG_VERSION_TTL.
+CATALOG_VERSION_SOURCES = (
+    lambda: db.collection('products'),
+    lambda: db.collection_group('counter_shards'),
+    lambda: db.collection('deleted_products'),
+)
+
+def load_catalog_version():
+    """Opaque token (newest updated_at, as digits) that changes with every catalog write."""
+    stamps = []
+    for source in CATALOG_VERSION_SOURCES:
+        query = source().order_by('updated_at', direction=firestore.Query.DESCENDING).select(['updated_at']).limit(1)
+        for doc in query.stream():
+            if doc.to_dict().get('updated_at'): stamps.append(doc.to_dict()['updated_at'])
+    return max(stamps).strftime('%Y%m%d%H%M%S%f') if stamps else '0'
+
+def get_catalog_version():
+    """Cached load_catalog_version(); may lag a write on another instance by a few seconds."""
+    return get_catalog_version_cached(load_catalog_version)
 
 # --- HELPER: SYNC COUNTERS ---
+COUNTER_FIELDS = ('total_stock', 'booked_stock', 'sold_stock')
+
+def count_status(status):
+    """
+    Maps a single item status to its contribution to the product counters.
+    SOLD items leave total stock; BOOKED items stay in total and add to booked.
+    """
+    status = status or 'AVAILABLE'
+    return {
+        'total_stock': 0 if status == 'SOLD' else 1,
+        'booked_stock': 1 if status == 'BOOKED' else 0,
+        'sold_stock': 1 if status == 'SOLD' else 0,
+    }
+
+def get_counter_deltas(old_status, new_status):
+    """
+    Returns the non-zero counter changes caused by moving one item
+    from old_status to new_status (e.g. AVAILABLE -> BOOKED = booked_stock +1).
+    """
+    before = count_status(old_status)
+    after = count_status(new_status)
+    return {f: after[f] - before[f] for f in COUNTER_FIELDS if after[f] != before[f]}
+
+def get_counter_shard_count(product_id):
+    """
+    Hot products can opt into sharded counters by setting 'counter_shards' on the product doc.
+    Read outside of transactions so the product doc itself is not contended.
+    """
+    snap = db.collection('products').document(product_id).get(['counter_shards'])
+    if not snap.exists: return 0
+    return int(snap.to_dict().get('counter_shards') or 0)
+
+def apply_counter_deltas(writer, product_id, deltas, shard_count=0):
+    """
+    Queues Increment updates for the product counters on a transaction or batch,
+    so the counters change atomically with the item status update.
+    """
+    if not deltas: return
+    increments = {f: firestore.Increment(v) for f, v in deltas.items()}
+    increments['updated_at'] = firestore.SERVER_TIMESTAMP
+    product_ref = db.collection('products').document(product_id)
+    if shard_count > 0:
+        shard_ref = product_ref.collection('counter_shards').document(str(random.randrange(shard_count)))
+        writer.set(shard_ref, increments, merge=True)
+    else:
+        writer.update(product_ref, increments)
+
+# --- HELPER: LOCATION SUMMARY ---
+def get_location_deltas(old_status, old_location, new_status, new_location):
+    """
+    Returns the location_counts changes for one item moving between
+    statuses/locations. Only units that are not SOLD are counted.
+    """
+    deltas = {}
+    old_location = (old_location or '').strip()
+    new_location = (new_location or '').strip()
+    if old_status != 'SOLD' and old_location:
+        deltas[old_location] = deltas.get(old_location, 0) - 1
+    if new_status != 'SOLD' and new_location:
+        deltas[new_location] = deltas.get(new_location, 0) + 1
+    return {loc: d for loc, d in deltas.items() if d != 0}
+
+def apply_location_deltas(writer, product_id, location_deltas):
+    """Queues Increment updates on the product's location_counts map."""
+    if not location_deltas: return
+    # Location names are free text, so each key is quoted as a single path segment
+    update = {FieldPath('location_counts', loc).to_api_repr(): firestore.Increment(d) for loc, d in location_deltas.items()}
+    update['updated_at'] = firestore.SERVER_TIMESTAMP
+    writer.update(db.collection('products').document(product_id), update)
+
+def count_item_locations(items):
+    """Builds {product_id: {location: count}} from item dicts, skipping SOLD units."""
+    loc_map = {}
+    for i_data in items:
+        pid = i_data.get('product_id')
+        loc = (i_data.get('current_location') or '').strip()
+        if pid and loc and i_data.get('status') != 'SOLD':
+            counts = loc_map.setdefault(pid, {})
+            counts[loc] = counts.get(loc, 0) + 1
+    return loc_map
+
+def rebuild_location_counts(product_id=None):
+    """
+    Recomputes location_counts from inventory_items, for one product or the whole catalog.
+    Returns the number of products written.
+    """
+    query = db.collection('inventory_items')
+    if product_id: query = query.where('product_id', '==', product_id)
+    items = query.select(['product_id', 'status', 'current_location']).stream()
+    loc_map = count_item_locations(item.to_dict() for item in items)
+
+    if product_id:
+        product_ids = [product_id]
+    else:
+        product_ids = [doc.id for doc in db.collection('products').select([]).stream()]
+
+    batch = db.batch()
+    count = 0
+    for pid in product_ids:
+        # update() replaces the whole map, dropping locations that are now empty
+        batch.update(db.collection('products').document(pid), {'location_counts': loc_map.get(pid, {}), 'updated_at': firestore.SERVER_TIMESTAMP})
+        count += 1
+        if count % 400 == 0:
+            batch.commit(); batch = db.batch()
+    if count % 400: batch.commit()
+    return count
+
+def sum_counter_shards(product_id):
+    """Adds up the pending deltas held in a product's counter shards."""
+    totals = {f: 0 for f in COUNTER_FIELDS}
+    shards = db.collection('products').document(product_id).collection('counter_shards').stream()
+    for shard in shards:
+        data = shard.to_dict()
+        for f in COUNTER_FIELDS:
+            totals[f] += int(data.get(f, 0))
+    return totals
+
+def merge_counter_shards(product):
+    """Folds shard deltas into a product dict for products using sharded counters."""
+    if not product.get('counter_shards'): return product
+    shard_totals = sum_counter_shards(product['id'])
+    for f in COUNTER_FIELDS:
+        product[f] = int(product.get(f, 0)) + shard_totals[f]
+    return product
+
+def count_product_items(product_id):
+    """Full recount of a product's counters from its inventory items."""
+    totals = {f: 0 for f in COUNTER_FIELDS}
+    items = db.collection('inventory_items').where('product_id', '==', product_id).select(['status']).stream()
+    for item in items:
+        for f, v in count_status(item.to_dict().get('status')).items():
+            totals[f] += v
+    return totals
+
 def update_product_counters(product_id):
     """
     Recalculates stock levels (Total, Booked, Sold) for a product 
     by counting its inventory items.
+    Status transitions keep counters in sync incrementally; this full recount
+    is only used by the reconciliation job to repair drift.
     """
-    items = db.collection('inventory_items').where('product_id', '==', product_id).stream()
-    total = 0
-    booked = 0
-    sold = 0
-    
+    totals = count_product_items(product_id)
+    shard_count = get_counter_shard_count(product_id)
+    if shard_count > 0:
+        # Shards keep their pending deltas, so the base value absorbs the difference
+        shard_totals = sum_counter_shards(product_id)
+        totals = {f: totals[f] - shard_totals[f] for f in COUNTER_FIELDS}
+
+    batch = db.batch()
+    batch.update(db.collection('products').document(product_id), {**totals, 'updated_at': firestore.SERVER_TIMESTAMP})
+    batch.commit()
+    return totals
+
+def find_counter_drift():
+    """
+    Recounts every product from a single projected scan of inventory_items
+    and returns the products whose stored counters differ from the items.
+    Products whose units are still being written by a unit job are skipped.
+    """
+    actual = {}
+    items = db.collection('inventory_items').select(['product_id', 'status']).stream()
     for item in items:
         data = item.to_dict()
-        status = data.get('status', 'AVAILABLE')
-        
-        if status == 'SOLD':
-            sold += 1
+        pid = data.get('product_id')
+        if not pid: continue
+        if pid not in actual: actual[pid] = {f: 0 for f in COUNTER_FIELDS}
+        for f, v in count_status(data.get('status')).items():
+            actual[pid][f] += v
+
+    drift = []
+    products = db.collection('products').select(list(COUNTER_FIELDS) + ['counter_shards', 'unit_job_id']).stream()
+    for doc in products:
+        stored = doc.to_dict()
+        # The counters already include the units the job hasn't written yet
+        if stored.get('unit_job_id'): continue
+        stored['id'] = doc.id
+        merge_counter_shards(stored)
+        expected = actual.get(doc.id, {f: 0 for f in COUNTER_FIELDS})
+        diff = {f: expected[f] - int(stored.get(f, 0)) for f in COUNTER_FIELDS if expected[f] != int(stored.get(f, 0))}
+        if diff:
+            drift.append({'product_id': doc.id, 'expected': expected, 'diff': diff})
+    return drift
+
+def reconcile_counters(repair=True):
+    """Finds counter drift and (optionally) repairs it with a targeted recount."""
+    drift = find_counter_drift()
+    if repair:
+        for entry in drift:
+            update_product_counters(entry['product_id'])
+    return drift
+
+# --- HELPER: ITEM HISTORY ---
+# The full event log lives in inventory_items/{id}/history/{event_id}. The item doc
+# only keeps the last HISTORY_RECENT events in history_log, so item scans stay the
+# same size however old the item gets. Event ids are derived from the event itself,
+# so writing the same event twice (e.g. re-running the migration) never duplicates it.
+# Run migrate_history_logs once after deploying to move existing embedded logs.
+HISTORY_COLLECTION = 'history'
+HISTORY_RECENT = 10
+
+def history_event_id(event):
+    date = event.get('date')
+    stamp = date.strftime('%Y%m%d%H%M%S%f') if hasattr(date, 'strftime') else str(date or '')
+    digest = hashlib.md5(f"{event.get('action')}|{stamp}|{event.get('note')}".encode()).hexdigest()[:8]
+    return f"{stamp}-{digest}"
+
+def history_op(item_ref, event):
+    return ('set', item_ref.collection(HISTORY_COLLECTION).document(history_event_id(event)), event)
+
+def append_history(writer, item_ref, event, recent_log=None):
+    """Writes the event doc and returns the capped history_log to store on the item."""
+    log = list(recent_log or []) + [event]
+    # Items not migrated yet still carry their full log: keep whatever is about to be
+    # trimmed. Event ids are deterministic, so rewriting an already stored event is harmless.
+    overflow = log[:-HISTORY_RECENT]
+    for e in overflow + [event]:
+        _, ref, data = history_op(item_ref, e)
+        writer.set(ref, data)
+    return log[-HISTORY_RECENT:]
+
+def migrate_item_history(cursor=None, page_size=BATCH_LIMIT):
+    """
+    Copies embedded history_log events of one page of items into their history
+    sub-collection and trims the embedded log. Idempotent; returns (migrated, next_cursor),
+    next_cursor being None after the last page.
+    """
+    query = db.collection('inventory_items').order_by('__name__').select(['history_log']).limit(page_size)
+    if cursor: query = query.start_after({'__name__': db.collection('inventory_items').document(cursor)})
+    groups = []
+    last_id = None
+    scanned = 0
+    for doc in query.stream():
+        last_id = doc.id
+        scanned += 1
+        log = doc.to_dict().get('history_log') or []
+        if not log: continue
+        # An item's events and its trimmed log commit together, so nothing is lost on failure
+        ops = [history_op(doc.reference, event) for event in log]
+        if len(log) > HISTORY_RECENT: ops.append(('update', doc.reference, {'history_log': log[-HISTORY_RECENT:]}))
+        if len(ops) > BATCH_LIMIT:
+            for chunk in split_ops(ops[:-1]): commit_with_retry(chunk)
+            commit_with_retry(ops[-1:])
         else:
-            total += 1 
-        
-        if status == 'BOOKED':
-            booked += 1
-            
-    db.collection('products').document(product_id).update({
-        'total_stock': total,
-        'booked_stock': booked,
-        'sold_stock': sold
-    })
+            groups.append((doc.id, ops))
+    results = commit_chunks_parallel(pack_groups(groups))
+    failed = [r['error'] for r in results if r['status'] == 'failed']
+    if failed: raise RuntimeError(f"History migration failed for {len(failed)} chunk(s): {failed[0]}")
+    return len(groups), (last_id if scanned == page_size else None)
 
 # --- READ FUNCTIONS ---
 
+@instrumented
+@endpoint('GET', allow_headers='If-None-Match', expose_headers='ETag')
 def get_all_products(req: https_fn.Request) -> https_fn.Response:
-    headers = {'Access-Control-Allow-Origin': '*', 'Access-Control-Allow-Methods': 'GET', 'Access-Control-Allow-Headers': 'Content-Type'}
-    if req.method == 'OPTIONS': return https_fn.Response('', status=204, headers=headers)
-    
+    """
+    Returns the product catalog.
+    Optional query params:
+      - page_size / cursor: paginate by document id (cursor = last id of the previous page)
+      - fields: comma separated projection (e.g. fields=brand,category,total_stock)
+    Responses carry a strong ETag derived from the catalog version (newest
+    updated_at), so an unchanged refresh answers 304 without reading the catalog.
+    """
+    try:
+        page_size = int(req.args.get('page_size', 0))
+    except ValueError:
+        return https_fn.Response("Invalid page_size", status=400)
+
     try:
-        docs = db.collection('products').stream()
-        products = [serialize_doc(doc.to_dict()) for doc in docs]
-        return https_fn.Response(json.dumps({'data': products}), status=200, headers=headers, mimetype='application/json')
+        cursor = req.args.get('cursor')
+        fields = [f.strip() for f in req.args.get('fields', '').split(',') if f.strip()]
+
+        query_key = f"{page_size}|{cursor or ''}|{','.join(sorted(fields))}"
+        etag = f'"{get_catalog_version()}-{hashlib.sha1(query_key.encode()).hexdigest()[:12]}"'
+        headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+        if etag in [t.strip() for t in req.headers.get('If-None-Match', '').split(',')]:
+            return https_fn.Response('', status=304, headers=headers)
+
+        query = db.collection('products')
+        if fields:
+            # 'id', 'counter_shards' and 'pending_deletion' key rows, merge sharded counters and hide deletions
+            query = query.select(sorted(set(fields) | {'id', 'counter_shards', 'pending_deletion'}))
+        if page_size > 0:
+            query = query.order_by('__name__')
+            if cursor: query = query.start_after(db.collection('products').document(cursor))
+            query = query.limit(page_size)
+
+        # Taken before the read so delta-sync clients never skip a concurrent write
+        sync_ts = datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+        scanned = {'count': 0, 'last_id': None}
+
+        def rows():
+            for doc in query.stream():
+                scanned['count'] += 1
+                scanned['last_id'] = doc.id
+                p = doc.to_dict()
+                if p.get('pending_deletion'): continue
+                p['id'] = doc.id
+                p.pop(SEARCH_INDEX_FIELD, None)
+                merge_counter_shards(p)
+                if fields: p = {k: v for k, v in p.items() if k in fields or k == 'id'}
+                yield p
+
+        if page_size <= 0:
+            # Full catalog: encode while reading instead of building the whole list first
+            return https_fn.Response(iter_json({'data': rows(), 'sync_ts': sync_ts}), status=200, headers=headers, mimetype='application/json')
+
+        products = list(rows())
+        result = {'data': products, 'sync_ts': sync_ts}
+        result['next_cursor'] = scanned['last_id'] if scanned['count'] == page_size else None
+        return https_fn.Response(dumps(result), status=200, headers=headers, mimetype='application/json')
+    except Exception as e:
+        return https_fn.Response(str(e), status=500)
+
+@instrumented
+@endpoint('GET')
+def get_products_since(req: https_fn.Request) -> https_fn.Response:
+    """
+    Delta sync: returns products whose updated_at is at/after ?ts= (ISO timestamp)
+    plus the ids of products deleted since then. Clients pass the returned
+    sync_ts on the next call.
+    """
+    ts_str = req.args.get('ts')
+    if not ts_str: return https_fn.Response("Missing ts", status=400)
+
+    try:
+        try:
+            since = datetime.datetime.fromisoformat(ts_str)
+        except ValueError:
+            return https_fn.Response("Invalid ts format", status=400)
+        if since.tzinfo is None: since = since.replace(tzinfo=datetime.timezone.utc)
+
+        latest = since
+        changed = {}
+        for doc in db.collection('products').where('updated_at', '>=', since).stream():
+            p = doc.to_dict()
+            p['id'] = doc.id
+            p.pop(SEARCH_INDEX_FIELD, None)
+            changed[doc.id] = p
+            latest = max(latest, p['updated_at'])
+
+        # Sharded counters change without touching the product doc
+        for shard in db.collection_group('counter_shards').where('updated_at', '>=', since).stream():
+            latest = max(latest, shard.to_dict()['updated_at'])
+            pid = shard.reference.parent.parent.id
+            if pid not in changed:
+                snap = db.collection('products').document(pid).get()
+                if snap.exists: changed[pid] = {k: v for k, v in snap.to_dict().items() if k != SEARCH_INDEX_FIELD} | {'id': pid}
+
+        deleted = []
+        for doc in db.collection('deleted_products').where('updated_at', '>=', since).stream():
+            deleted.append(doc.id)
+            latest = max(latest, doc.to_dict()['updated_at'])
+            changed.pop(doc.id, None)
+
+        # Products being cascade-deleted are reported as deleted even after their tombstone
+        for pid in [pid for pid, p in changed.items() if p.get('pending_deletion')]:
+            changed.pop(pid)
+            if pid not in deleted: deleted.append(pid)
+
+        products = [merge_counter_shards(p) for p in changed.values()]
+        result = {'data': products, 'deleted': deleted, 'sync_ts': latest.isoformat()}
+        return https_fn.Response(dumps(result), status=200, mimetype='application/json')
     except Exception as e:
-        return https_fn.Response(str(e), status=500, headers=headers)
+        return https_fn.Response(str(e), status=500)
 
+@instrumented
+@endpoint('GET')
 def get_product_inventory(req: https_fn.Request) -> https_fn.Response:
-    headers = {'Access-Control-Allow-Origin': '*', 'Access-Control-Allow-Methods': 'GET', 'Access-Control-Allow-Headers': 'Content-Type'}
-    if req.method == 'OPTIONS': return https_fn.Response('', status=204, headers=headers)
-    
     product_id = req.args.get('product_id')
-    if not product_id: return https_fn.Response("Missing product_id", status=400, headers=headers)
+    if not product_id: return https_fn.Response("Missing product_id", status=400)
 
     try:
         query = db.collection('inventory_items').where('product_id', '==', product_id).stream()
@@ -65,23 +427,195 @@ def get_product_inventory(req: https_fn.Request) -> https_fn.Response:
         for doc in query:
             d = doc.to_dict()
             d['id'] = doc.id
-            inventory.append(serialize_doc(d))
-        return https_fn.Response(json.dumps({'data': inventory}), status=200, headers=headers, mimetype='application/json')
+            inventory.append(d)
+        return https_fn.Response(dumps({'data': inventory}), status=200, mimetype='application/json')
+    except Exception as e:
+        return https_fn.Response(str(e), status=500)
+
+@instrumented
+@endpoint('GET')
+def get_item_history(req: https_fn.Request) -> https_fn.Response:
+    """
+    Full event log of one item, newest first.
+    Query params: item_id, page_size (default 50), cursor (last event id of the previous page).
+    """
+    item_id = req.args.get('item_id')
+    if not item_id: return https_fn.Response("Missing item_id", status=400)
+
+    try:
+        page_size = int(req.args.get('page_size', 50))
+        cursor = req.args.get('cursor')
+        history = db.collection('inventory_items').document(item_id).collection(HISTORY_COLLECTION)
+
+        query = history.order_by('date', direction=firestore.Query.DESCENDING).limit(page_size)
+        if cursor:
+            cursor_snap = history.document(cursor).get()
+            if cursor_snap.exists: query = query.start_after(cursor_snap)
+
+        events = []
+        for doc in query.stream():
+            d = doc.to_dict()
+            d['id'] = doc.id
+            events.append(d)
+        next_cursor = events[-1]['id'] if len(events) == page_size else None
+        return https_fn.Response(dumps({'data': events, 'next_cursor': next_cursor}), status=200, mimetype='application/json')
     except Exception as e:
-        return https_fn.Response(str(e), status=500, headers=headers)
+        return https_fn.Response(str(e), status=500)
+
+# --- HELPER: UNIT CREATION ---
+# New units get QR sequence numbers from a range reserved in a transaction on the
+# product's last_sequence, so concurrent adds never hand out the same code. Item ids
+# ({product_id}-{seq}) and the event date are fixed up front, so rewriting a range
+# after a failure produces the same docs instead of duplicates.
+# Up to UNIT_INLINE_LIMIT units are written inside the request with parallel batches;
+# larger quantities become a unit_jobs/{id} job on the run_unit_creation task queue
+# that checkpoints next_seq after every window of units. While it runs the product
+# carries unit_job_id, so counter reconciliation leaves its counters alone.
+UNIT_INLINE_LIMIT = 400
+UNIT_JOB_WINDOW = BATCH_LIMIT // 2 * MAX_WORKERS  # one parallel round of full batches (2 writes per unit)
+UNIT_JOB_BUDGET = 240  # seconds per task, well below the task timeout
+UNIT_STALE_AFTER = datetime.timedelta(minutes=10)
+
+@firestore.transactional
+def reserve_unit_sequence(transaction, product_ref, count):
+    """Atomically advances the product's last_sequence by count; returns the first reserved number."""
+    snap = product_ref.get(['last_sequence'], transaction=transaction)
+    last = int((snap.to_dict() or {}).get('last_sequence') or 0) if snap.exists else 0
+    transaction.update(product_ref, {'last_sequence': last + count, 'updated_at': firestore.SERVER_TIMESTAMP})
+    return last + 1
+
+def unit_ops(spec, first_seq, last_seq):
+    """Write ops for units first_seq..last_seq (inclusive), grouped per unit: [(seq, [item op, history op])]."""
+    groups = []
+    for seq in range(first_seq, last_seq + 1):
+        seq_str = str(seq).zfill(4)
+        item_ref = db.collection('inventory_items').document(f"{spec['product_id']}-{seq_str}")
+        event = {'action': spec['action'], 'location': spec['location'], 'date': spec['date'], 'note': spec['note']}
+        item_data = {
+            'product_id': spec['product_id'],
+            'product_name': spec['product_name'],
+            'qr_code': f"{spec['sku']}-{seq_str}",
+            'status': spec['unit_status'],
+            'current_location': spec['location'],
+            'created_at': spec['date'],
+            'history_log': [event]
+        }
+        # create, not set: a rewritten window must not reset a unit booked or moved since
+        groups.append((seq, [('create', item_ref, item_data), history_op(item_ref, event)]))
+    return groups
+
+def commit_unit_range(spec, first_seq, last_seq):
+    groups = unit_ops(spec, first_seq, last_seq)
+    results = commit_chunks_parallel(pack_groups(groups))
+    # One existing unit fails its whole chunk; redo those chunks unit by unit and skip the existing ones
+    by_seq = dict(groups)
+    for r in results:
+        if r['status'] != 'failed': continue
+        for seq in r['keys']:
+            try:
+                commit_with_retry(by_seq[seq])
+            except gexc.AlreadyExists:
+                pass  # Written by an earlier run
+
+def enqueue_unit_creation(job_id):
+    queue = functions.task_queue("locations/asia-southeast2/functions/run_unit_creation")  # the task function is deployed in asia-southeast2, not the default us-central1
+    queue.enqueue({'job_id': job_id})
+
+def create_units(spec, count):
+    """
+    Reserves count QR sequence numbers and writes the units. Returns the job id when
+    the quantity was handed to a background job, None when everything was written.
+    """
+    if count <= 0: return None
+    first_seq = reserve_unit_sequence(db.transaction(), db.collection('products').document(spec['product_id']), count)
+    if count <= UNIT_INLINE_LIMIT:
+        commit_unit_range(spec, first_seq, first_seq + count - 1)
+        return None
+
+    job_ref = db.collection('unit_jobs').document()
+    batch = db.batch()
+    batch.update(db.collection('products').document(spec['product_id']), {'unit_job_id': job_ref.id})
+    batch.set(job_ref, {
+        'id': job_ref.id,
+        **spec,
+        'first_seq': first_seq,
+        'last_seq': first_seq + count - 1,
+        'next_seq': first_seq,
+        'count': count,
+        'created': 0,
+        'status': 'PENDING',
+        'created_at': firestore.SERVER_TIMESTAMP,
+        'updated_at': firestore.SERVER_TIMESTAMP
+    })
+    batch.commit()
+    enqueue_unit_creation(job_ref.id)
+    return job_ref.id
+
+@firestore.transactional
+def clear_unit_job_mark(transaction, product_ref, job_id):
+    """Drops unit_job_id from the product if it still points at this job (and the product still exists)."""
+    snap = product_ref.get(['unit_job_id'], transaction=transaction)
+    if snap.exists and (snap.to_dict() or {}).get('unit_job_id') == job_id:
+        transaction.update(product_ref, {'unit_job_id': firestore.DELETE_FIELD})
+
+def process_unit_job(job_id):
+    """
+    Runs (or resumes) a unit creation job from next_seq until done or out of time.
+    Returns True when the job finished. A window that fails is simply rewritten.
+    The job is cancelled as soon as its product is gone or pending deletion.
+    """
+    job_ref = db.collection('unit_jobs').document(job_id)
+    job_snap = job_ref.get()
+    if not job_snap.exists: return True
+    job = job_snap.to_dict()
+    if job.get('status') in ('DONE', 'CANCELLED'):
+        # A run that stopped between the last checkpoint and clearing the mark
+        clear_unit_job_mark(db.transaction(), db.collection('products').document(job['product_id']), job_id)
+        return True
+
+    job_ref.update({'status': 'RUNNING', 'updated_at': firestore.SERVER_TIMESTAMP})
+    started = time.monotonic()
+    next_seq, last_seq = job['next_seq'], job['last_seq']
+
+    product_ref = db.collection('products').document(job['product_id'])
+    while time.monotonic() - started < UNIT_JOB_BUDGET:
+        # The deletion job waits for the mark to clear, so no unit lands after it finished
+        product_snap = product_ref.get(['pending_deletion'])
+        if not product_snap.exists or (product_snap.to_dict() or {}).get('pending_deletion'):
+            job_ref.update({'status': 'CANCELLED', 'note': 'Product deleted', 'updated_at': firestore.SERVER_TIMESTAMP})
+            clear_unit_job_mark(db.transaction(), product_ref, job_id)
+            return True
+        window_end = min(next_seq + UNIT_JOB_WINDOW - 1, last_seq)
+        try:
+            commit_unit_range(job, next_seq, window_end)
+        except Exception as e:
+            job_ref.update({'error': str(e), 'updated_at': firestore.SERVER_TIMESTAMP})
+            raise
+        next_seq = window_end + 1
+        done = next_seq > last_seq
+        job_ref.update({
+            'next_seq': next_seq,
+            'created': next_seq - job['first_seq'],
+            'status': 'DONE' if done else 'RUNNING',
+            'error': None,
+            'updated_at': firestore.SERVER_TIMESTAMP
+        })
+        if done:
+            clear_unit_job_mark(db.transaction(), product_ref, job_id)
+            return True
+    return False
 
 # --- WRITE FUNCTIONS ---
 
+@instrumented
+@endpoint('POST')
 def manage_product(req: https_fn.Request) -> https_fn.Response:
-    headers = {'Access-Control-Allow-Origin': '*', 'Access-Control-Allow-Methods': 'POST', 'Access-Control-Allow-Headers': 'Content-Type'}
-    if req.method == 'OPTIONS': return https_fn.Response('', status=204, headers=headers)
-
     try:
         data = req.get_json()
         mode = data.get('mode')
         product_data = data.get('product')
         
-        if not product_data: return https_fn.Response("Missing data", status=400, headers=headers)
+        if not product_data: return https_fn.Response("Missing data", status=400)
 
         product_id = product_data.get('id')
         if not product_id:
@@ -91,20 +625,12 @@ def manage_product(req: https_fn.Request) -> https_fn.Response:
         if product_data.get('brand'): product_data['brand'] = product_data['brand'].strip().upper()
         if product_data.get('category'): product_data['category'] = product_data['category'].strip().title()
         
-        # SKU Logic
-        c1 = get_4char_segment(product_data.get('brand', ''))
-        c2 = get_4char_segment(product_data.get('category', ''))
-        c3 = get_4char_segment(product_data.get('collection', ''))
-        base_sku = f"{c1}-{c2}-{c3}"
-
+        # SKU Logic: only allocate for new products or products that never got a code
         current_code = product_data.get('code')
-        existing_with_sku = db.collection('products').where('code', '>=', base_sku).where('code', '<=', base_sku + '\uf8ff').stream()
-        existing_skus = {doc.to_dict().get('code') for doc in existing_with_sku}
-        
-        # Only generate new SKU if ADD or if we are editing and want to change it (logic here preserves existing if match)
         final_sku = current_code
-        if mode == 'ADD' or (mode == 'EDIT' and current_code not in existing_skus and not current_code):
-             final_sku = resolve_sku_collision(base_sku, existing_skus)
+        if mode == 'ADD' or (mode == 'EDIT' and not current_code):
+             base_sku = build_base_sku(product_data.get('brand', ''), product_data.get('category', ''), product_data.get('collection', ''))
+             final_sku = allocate_sku(base_sku)
         
         product_data['code'] = final_sku
         product_data['retail_price_idr'] = int(product_data.get('retail_price_idr', 0))
@@ -115,364 +641,658 @@ def manage_product(req: https_fn.Request) -> https_fn.Response:
             product_data['retail_price_usd'] = int(product_data.get('retail_price_usd', 0))
         
         product_data['currency'] = product_data.get('currency', 'IDR')
-        product_data['total_stock'] = int(product_data.get('total_stock', 0))
+        if mode == 'ADD':
+            product_data['total_stock'] = int(product_data.get('total_stock', 0))
+            # The export orders by brand and collection, which skips docs missing either field
+            for field in ('brand', 'collection'): product_data.setdefault(field, '')
+        else:
+            # Counters are owned by item transitions; a stale form value must not overwrite them
+            for field in COUNTER_FIELDS + ('location_counts',): product_data.pop(field, None)
 
         discount_ids = []
         for d in product_data.get('discounts', []):
             if d.get('id'): discount_ids.append(d.get('id'))
         product_data['discount_ids'] = discount_ids
+        # The form has no nett field: nett always follows retail and discounts
+        product_data['nett_price_idr'] = compute_nett_price(product_data['retail_price_idr'], product_data.get('discounts', []))
+        product_data['nett_price_manual'] = False
+        product_data['updated_at'] = firestore.SERVER_TIMESTAMP
+        if mode == 'ADD':
+            product_data['location_counts'] = {'Warehouse (New)': product_data['total_stock']} if product_data['total_stock'] > 0 else {}
 
         doc_ref = db.collection('products').document(product_id)
         doc_snap = doc_ref.get()
         current_data = doc_snap.to_dict() if doc_snap.exists else {}
+        if current_data.get('pending_deletion'): return https_fn.Response("Product is being deleted", status=409)
         
-        last_seq = current_data.get('last_sequence', 0)
-        product_data['last_sequence'] = last_seq
+        # last_sequence is only advanced by reserve_unit_sequence
+        product_data.pop('last_sequence', None)
+        product_data[SEARCH_INDEX_FIELD] = build_search_keywords({**current_data, **product_data})
         
         doc_ref.set(product_data, merge=True)
+        invalidate_cache('catalog_version')
 
+        job_id = None
         if mode == 'ADD':
-            initial_qty = product_data.get('total_stock', 0)
-            batch = db.batch()
-            
-            for i in range(initial_qty):
-                last_seq += 1
-                seq_str = str(last_seq).zfill(4)
-                qr_content = f"{final_sku}-{seq_str}"
-                
-                new_item_ref = db.collection('inventory_items').document()
-                status = 'AVAILABLE'
-                if product_data.get('is_not_for_sale'): status = 'NOT_FOR_SALE'
-
-                item_data = {
-                    'product_id': product_id,
-                    'product_name': f"{product_data.get('brand')} - {product_data.get('collection')}",
-                    'qr_code': qr_content,
-                    'status': status,
-                    'current_location': 'Warehouse (New)',
-                    'created_at': datetime.datetime.now(),
-                    'history_log': [{
-                        'action': 'ITEM_CREATED',
-                        'location': 'Warehouse (New)',
-                        'date': datetime.datetime.now(),
-                        'note': 'Initial Stock Creation'
-                    }]
-                }
-                batch.set(new_item_ref, item_data)
-            
-            doc_ref.update({'last_sequence': last_seq})
-            batch.commit()
-
-        return https_fn.Response(json.dumps({'success': True, 'id': product_id, 'sku': final_sku}), status=200, headers=headers, mimetype='application/json')
+            spec = {
+                'product_id': product_id,
+                'product_name': f"{product_data.get('brand')} - {product_data.get('collection')}",
+                'sku': final_sku,
+                'unit_status': 'NOT_FOR_SALE' if product_data.get('is_not_for_sale') else 'AVAILABLE',
+                'location': 'Warehouse (New)',
+                'action': 'ITEM_CREATED',
+                'note': 'Initial Stock Creation',
+                'date': datetime.datetime.now(datetime.timezone.utc),
+            }
+            job_id = create_units(spec, product_data.get('total_stock', 0))
+
+        if job_id:
+            result = {'success': True, 'id': product_id, 'sku': final_sku, 'job_id': job_id}
+            return https_fn.Response(json.dumps(result), status=202, mimetype='application/json')
+        return https_fn.Response(json.dumps({'success': True, 'id': product_id, 'sku': final_sku}), status=200, mimetype='application/json')
     except Exception as e:
-        return https_fn.Response(str(e), status=500, headers=headers)
+        return https_fn.Response(str(e), status=500)
+
+@tasks_fn.on_task_dispatched(
+    retry_config=RetryConfig(max_attempts=5, min_backoff_seconds=30),
+    rate_limits=RateLimits(max_concurrent_dispatches=2),
+    region="asia-southeast2",
+    timeout_sec=300
+)
+@instrumented
+def run_unit_creation(req: tasks_fn.CallableRequest) -> None:
+    job_id = req.data.get('job_id')
+    if job_id and not process_unit_job(job_id):
+        enqueue_unit_creation(job_id)
 
-def delete_product(req: https_fn.Request) -> https_fn.Response:
-    headers = {'Access-Control-Allow-Origin': '*', 'Access-Control-Allow-Methods': 'DELETE', 'Access-Control-Allow-Headers': 'Content-Type'}
-    if req.method == 'OPTIONS': return https_fn.Response('', status=204, headers=headers)
+@scheduler_fn.on_schedule(schedule="every 10 minutes", region="asia-southeast2")
+@instrumented
+def resume_stalled_unit_jobs(event: scheduler_fn.ScheduledEvent) -> None:
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - UNIT_STALE_AFTER
+    for status in ('PENDING', 'RUNNING'):
+        for doc in db.collection('unit_jobs').where('status', '==', status).stream():
+            if doc.to_dict().get('updated_at') and doc.to_dict()['updated_at'] < cutoff:
+                enqueue_unit_creation(doc.id)
+
+@instrumented
+@endpoint('GET')
+def get_unit_job(req: https_fn.Request) -> https_fn.Response:
+    """Progress of a background unit creation: created of count, status and the last error."""
+    job_id = req.args.get('job_id')
+    if not job_id: return https_fn.Response("Missing job_id", status=400)
 
     try:
-        data = req.get_json()
-        product_id = data.get('product_id')
-        if not product_id: return https_fn.Response("Missing id", status=400, headers=headers)
+        doc = db.collection('unit_jobs').document(job_id).get()
+        if not doc.exists: return https_fn.Response("Job not found", status=404)
+        return https_fn.Response(dumps({'data': doc.to_dict()}), status=200, mimetype='application/json')
+    except Exception as e:
+        return https_fn.Response(str(e), status=500)
 
-        db.collection('products').document(product_id).delete()
-        
-        items = db.collection('inventory_items').where('product_id', '==', product_id).stream()
-        batch = db.batch()
-        count = 0
-        for item in items:
-            batch.delete(item.reference)
-            count += 1
-            if count >= 400:
-                batch.commit(); batch = db.batch(); count = 0
-        if count > 0: batch.commit()
-
-        return https_fn.Response(json.dumps({'success': True}), status=200, headers=headers, mimetype='application/json')
+@instrumented
+@endpoint('POST')
+def reconcile_product_counters(req: https_fn.Request) -> https_fn.Response:
+    try:
+        data = req.get_json(silent=True) or {}
+        repair = not data.get('dry_run', False)
+        drift = reconcile_counters(repair=repair)
+        return https_fn.Response(json.dumps({'success': True, 'repaired': repair, 'drift': drift}), status=200, mimetype='application/json')
+    except Exception as e:
+        return https_fn.Response(str(e), status=500)
+
+@instrumented
+@endpoint('POST')
+def rebuild_location_summaries(req: https_fn.Request) -> https_fn.Response:
+    try:
+        data = req.get_json(silent=True) or {}
+        count = rebuild_location_counts(data.get('product_id'))
+        return https_fn.Response(json.dumps({'success': True, 'count': count}), status=200, mimetype='application/json')
+    except Exception as e:
+        return https_fn.Response(str(e), status=500)
+
+@instrumented
+@endpoint('POST')
+def migrate_history_logs(req: https_fn.Request) -> https_fn.Response:
+    """One page of the history_log -> history sub-collection migration. Call again with next_cursor until it is null."""
+    try:
+        data = req.get_json(silent=True) or {}
+        migrated, next_cursor = migrate_item_history(data.get('cursor'), int(data.get('page_size', BATCH_LIMIT)))
+        return https_fn.Response(json.dumps({'success': True, 'migrated': migrated, 'next_cursor': next_cursor}), status=200, mimetype='application/json')
     except Exception as e:
-        return https_fn.Response(str(e), status=500, headers=headers)
+        return https_fn.Response(str(e), status=500)
+
+@scheduler_fn.on_schedule(schedule="every day 03:00", timezone="Asia/Jakarta", region="asia-southeast2")
+@instrumented
+def scheduled_counter_reconciliation(event: scheduler_fn.ScheduledEvent) -> None:
+    drift = reconcile_counters(repair=True)
+    if drift: logger.info(f"Repaired counter drift on {len(drift)} products", repaired=len(drift), product_ids=[d['product_id'] for d in drift])
 
 # --- BULK OPERATIONS ---
 
-def bulk_import_products(req: https_fn.Request) -> https_fn.Response:
-    headers = {'Access-Control-Allow-Origin': '*', 'Access-Control-Allow-Methods': 'POST', 'Access-Control-Allow-Headers': 'Content-Type'}
-    if req.method == 'OPTIONS': return https_fn.Response('', status=204, headers=headers)
+def new_import_context(batch_prefix='IMPORT', with_catalog_index=False, batch_name=None):
+    """
+    Shared state for one import run: exchange rates, reserved SKUs, the discount
+    rules created so far and the discount writes that must land before products.
+    with_catalog_index also collects ids, brand-collection names, brands and
+    categories for duplicate/update detection (used by file imports).
+    A fixed batch_name (e.g. per import job) makes re-runs reuse the same rule ids.
+    """
+    eur_rate, usd_rate = get_exchange_rates_cached()
+
+    now = datetime.datetime.now()
+    ctx = {
+        'eur_rate': eur_rate,
+        'usd_rate': usd_rate,
+        'sku_pools': {},
+        'session_discounts': {},
+        'discount_ops': [],
+        'now': now,
+        'batch_name': batch_name or f"{batch_prefix}-{now.strftime('%Y%m%d-%H%M')}-{uuid.uuid4().hex[:4].upper()}",
+    }
+    if with_catalog_index:
+        catalog = [(doc.id, doc.to_dict()) for doc in db.collection('products').select(['brand', 'collection', 'category']).stream()]
+        ctx['existing_ids'] = {pid for pid, _ in catalog}
+        ctx['existing_names'] = {f"{(p.get('brand') or '').strip().upper()}-{(p.get('collection') or '').strip().upper()}" for _, p in catalog}
+        ctx['existing_brands'] = {(p.get('brand') or '').strip().upper() for _, p in catalog}
+        ctx['existing_categories'] = {(p.get('category') or '').strip().upper() for _, p in catalog}
+    return ctx
+
+def is_import_update(p_data):
+    """Rows carrying a full system id update that product instead of creating one."""
+    provided_id = p_data.get('id')
+    return bool(provided_id and len(provided_id) > 10)
+
+def reserve_import_skus(new_products, ctx, dry_run=False):
+    """
+    Reserves SKU ranges for every new product up front: one counter
+    transaction per prefix instead of one per product. dry_run only peeks.
+    Also reads the current SKU of every product being updated (for its search keywords).
+    """
+    counts = {}
+    update_refs = []
+    for p_data in new_products:
+        if is_import_update(p_data):
+            update_refs.append(db.collection('products').document(p_data['id']))
+            continue
+        base_sku = build_base_sku(p_data.get('brand', '').strip().upper(), p_data.get('category', '').strip().title(), p_data.get('collection', '').strip())
+        counts[base_sku] = counts.get(base_sku, 0) + 1
+    if dry_run:
+        # Nothing is written, so later chunks must skip the SKUs already previewed
+        peeked = ctx.setdefault('sku_peeked', {})
+        preview = peek_skus({b: peeked.get(b, 0) + n for b, n in counts.items()})
+        reserved = {b: skus[peeked.get(b, 0):] for b, skus in preview.items()}
+        for b, n in counts.items(): peeked[b] = peeked.get(b, 0) + n
+    else:
+        reserved = reserve_skus(counts)
+    for base_sku, skus in reserved.items():
+        ctx['sku_pools'].setdefault(base_sku, []).extend(skus)
+    if update_refs:
+        codes = ctx.setdefault('existing_codes', {})
+        for snap in db.get_all(update_refs, field_paths=['code']):
+            if snap.exists: codes[snap.id] = snap.to_dict().get('code')
+
+def commit_import_discounts(ctx):
+    """Writes the discount rules queued so far and drops the cached rule list."""
+    if not ctx['discount_ops']: return
+    for ops in split_ops(ctx['discount_ops']): commit_with_retry(ops)
+    ctx['discount_ops'].clear()
+    invalidate_cache('discounts')
+
+def build_import_product(p_data, ctx):
+    """
+    Turns one import row (client payload shape) into write ops.
+    Returns (product_id, item_ops, product_op); item_ops holds each new unit and its history event.
+    New discount rules are queued on ctx['discount_ops'].
+    """
+    eur_rate, usd_rate = ctx['eur_rate'], ctx['usd_rate']
+    session_discounts, discount_ops = ctx['session_discounts'], ctx['discount_ops']
+    now, batch_name = ctx['now'], ctx['batch_name']
+
+    # 1. Discounts
+    raw_discounts = p_data.get('discounts', [])
+    processed_discounts = []
+    discount_ids = []
+    for d in raw_discounts:
+        try:
+            val = float(d.get('value', 0))
+            if val > 0:
+                if val in session_discounts:
+                    rule = session_discounts[val]
+                    rule_id, rule_name = rule
+                else:
+                    # One rule per value and batch; the id is derived so a re-run overwrites it
+                    new_rule_id = hashlib.sha1(f"{batch_name}|{val}".encode()).hexdigest()[:20]
+                    display_val = int(val) if val.is_integer() else val
+                    rule_name = f"Imported {display_val}% [{batch_name}]"
+                    rule_doc = {'id': new_rule_id, 'name': rule_name, 'value': val, 'is_active': True, 'created_at': now}
+                    discount_ops.append(('set', db.collection('discounts').document(new_rule_id), rule_doc))
+                    session_discounts[val] = (new_rule_id, rule_name)
+                    rule_id = new_rule_id
+                processed_discounts.append({'id': rule_id, 'name': rule_name, 'value': val})
+                discount_ids.append(rule_id)
+        except: pass
+
+    p_data['discounts'] = processed_discounts
+    p_data['discount_ids'] = discount_ids
+
+    # 2. Check for ID (UPDATE MODE)
+    provided_id = p_data.get('id')
+    is_update = False
+
+    if is_import_update(p_data): 
+        product_id = provided_id
+        is_update = True
+    else:
+        product_id = str(uuid.uuid4())
+
+    # 3. SKU Logic
+    brand_clean = p_data.get('brand', '').strip().upper()
+    category_clean = p_data.get('category', '').strip().title()
+    collection_clean = p_data.get('collection', '').strip()
+    manufacturer_code = p_data.get('code', '').strip()
+
+    if not is_update:
+        base_sku = build_base_sku(brand_clean, category_clean, collection_clean)
+        pool = ctx['sku_pools'].get(base_sku)
+        final_sku = pool.pop(0) if pool else allocate_sku(base_sku)
+    else:
+        final_sku = p_data.get('code') 
+
+    # 4. Pricing
+    total_stock = int(p_data.get('total_stock', 0))
+    raw_eur = p_data.get('retail_price_eur')
+    raw_usd = p_data.get('retail_price_usd')
+    raw_idr = int(p_data.get('retail_price_idr', 0))
+
+    final_idr = raw_idr
+    currency = 'IDR'
+    retail_eur = 0
+    retail_usd = 0
+
+    if raw_eur:
+        try:
+            retail_eur = int(raw_eur)
+            if retail_eur > 0: currency = 'EUR'
+        except: pass
+    elif raw_usd:
+        try:
+            retail_usd = int(raw_usd)
+            if retail_usd > 0: currency = 'USD'
+        except: pass
+    final_idr = compute_retail_idr(currency, retail_eur, retail_usd, raw_idr, eur_rate, usd_rate)
+    # A nett column that only differs by rounding from the discounted retail (e.g. a
+    # re-imported export) is not an override; anything else is kept as entered
+    derived_nett = compute_nett_price(final_idr, processed_discounts)
+    nett_manual = 'nett_price_idr' in p_data and abs(int(p_data['nett_price_idr']) - derived_nett) > NETT_TOLERANCE
+
+    product_doc = {
+        'id': product_id,
+        'brand': brand_clean,
+        'category': category_clean,
+        'collection': collection_clean,
+        'manufacturer_code': manufacturer_code,
+        'image_url': p_data.get('image_url', ''), 
+        'detail': p_data.get('detail', ''),
+        'dimensions': p_data.get('dimensions', ''),
+        'finishing': p_data.get('finishing', ''),
+        'currency': currency,
+        'retail_price_idr': final_idr,
+        'retail_price_eur': retail_eur,
+        'retail_price_usd': retail_usd,
+        'total_stock': total_stock,
+        'nett_price_idr': int(p_data['nett_price_idr']) if nett_manual else derived_nett,
+        'nett_price_manual': nett_manual,
+        'discounts': processed_discounts,
+        'discount_ids': discount_ids,
+        'is_not_for_sale': p_data.get('is_not_for_sale', False),
+        'is_upcoming': p_data.get('is_upcoming', False),
+        'upcoming_eta': p_data.get('upcoming_eta', ''),
+        'updated_at': firestore.SERVER_TIMESTAMP,
+    }
+
+    # Updates don't carry the system SKU; reserve_import_skus looked it up
+    code = final_sku if not is_update else ctx.get('existing_codes', {}).get(product_id)
+    product_doc[SEARCH_INDEX_FIELD] = build_search_keywords({**product_doc, 'code': code})
+
+    # One normalized location for the counter, the units and their events, so they always agree
+    import_location = (p_data.get('location') or 'Warehouse (Import)').strip()
+    if not is_update:
+        product_doc['code'] = final_sku
+        product_doc['booked_stock'] = 0
+        product_doc['sold_stock'] = 0
+        product_doc['created_at'] = now
+        product_doc['last_sequence'] = total_stock
+        product_doc['location_counts'] = {import_location: total_stock} if total_stock > 0 else {}
+
+    item_ops = []
+    if not is_update:
+        for i in range(total_stock):
+            seq_num = i + 1
+            seq_str = str(seq_num).zfill(4)
+            qr_content = f"{final_sku}-{seq_str}"
+
+            item_ref = db.collection('inventory_items').document()
+            status = 'AVAILABLE'
+            if product_doc['is_not_for_sale']: status = 'NOT_FOR_SALE'
+
+            event = {'action': 'BULK_IMPORT', 'batch_id': batch_name, 'location': import_location, 'date': now, 'note': f'Imported via Batch {batch_name}'}
+            item_data = {
+                'product_id': product_id,
+                'product_name': f"{product_doc['brand']} - {product_doc['collection']}",
+                'qr_code': qr_content,
+                'status': status,
+                'current_location': import_location,
+                'created_at': now,
+                'history_log': [event]
+            }
+            item_ops.append(('set', item_ref, item_data))
+            item_ops.append(history_op(item_ref, event))
+
+    product_op = ('set_merge', db.collection('products').document(product_id), product_doc)
+    return product_id, item_ops, product_op
+
+def commit_import_groups(product_groups):
+    """
+    Writes imported products with bounded parallel batch commits.
+    Each product (its doc plus its units) is all-or-nothing:
+      - products that fit in one batch are packed whole into shared chunks;
+      - larger products commit their units first, then the product doc once
+        every unit chunk succeeded; if a unit chunk or the product doc fails,
+        the units already written are deleted (failures reported in rollback_failed).
+    product_groups: list of (product_id, item_ops, product_op).
+    """
+    small_groups = []
+    large_products = {}
+    chunks = []
+    for product_id, item_ops, product_op in product_groups:
+        if len(item_ops) + 1 <= BATCH_LIMIT:
+            small_groups.append((product_id, item_ops + [product_op]))
+        else:
+            large_products[product_id] = (item_ops, product_op)
+    chunks.extend(pack_groups(small_groups))
+    for product_id, (item_ops, _) in large_products.items():
+        chunks.extend({'keys': [product_id], 'ops': ops} for ops in split_ops(item_ops))
+
+    results = commit_chunks_parallel(chunks)
+    failed = {key for r in results if r['status'] == 'failed' for key in r['keys']}
 
+    # Second phase for products whose units spanned several chunks: the product doc
+    # only goes in once every unit chunk landed
+    finish_chunks = [{'keys': [pid], 'ops': [product_op]} for pid, (_, product_op) in large_products.items() if pid not in failed]
+    finish_results = commit_chunks_parallel(finish_chunks)
+    failed |= {key for r in finish_results if r['status'] == 'failed' for key in r['keys']}
+
+    # Units already written for a failed large product (unit chunk or product doc) are deleted again
+    rollback_chunks = []
+    for product_id in large_products:
+        if product_id not in failed: continue
+        written = [op for c, r in zip(chunks, results) if r['status'] == 'ok' and c['keys'] == [product_id] for op in c['ops']]
+        rollback = [('delete', ref, None) for _, ref, _ in written]
+        rollback_chunks.extend({'keys': [product_id], 'ops': ops} for ops in split_ops(rollback))
+    rollback_results = commit_chunks_parallel(rollback_chunks)
+    rollback_failed = {key for r in rollback_results if r['status'] == 'failed' for key in r['keys']}
+
+    return {
+        'failed_products': sorted(failed),
+        # Products whose partial units could not be removed; they need a manual cleanup
+        'rollback_failed': sorted(rollback_failed),
+        'chunks': [{k: r[k] for k in ('chunk', 'ops', 'status', 'attempts', 'error')} for r in results + finish_results],
+        'rollback_chunks': [{k: r[k] for k in ('chunk', 'ops', 'status', 'attempts', 'error')} for r in rollback_results]
+    }
+
+@instrumented
+@endpoint('POST')
+def bulk_import_products(req: https_fn.Request) -> https_fn.Response:
     try:
         data = req.get_json()
         new_products = data.get('products', [])
-        if not new_products: return https_fn.Response("No products", status=400, headers=headers)
+        if not new_products: return https_fn.Response("No products", status=400)
 
-        settings_doc = db.collection('settings').document('global').get()
-        settings = settings_doc.to_dict() if settings_doc.exists else {'eur_rate': 17000, 'usd_rate': 15500}
-        eur_rate = settings.get('eur_rate', 17000)
-        usd_rate = settings.get('usd_rate', 15500)
+        ctx = new_import_context()
+        reserve_import_skus(new_products, ctx)
+        product_groups = []
 
-        all_products_ref = db.collection('products').select(['code']).stream()
-        existing_skus = {doc.to_dict().get('code') for doc in all_products_ref}
+        for p_data in new_products:
+            product_groups.append(build_import_product(p_data, ctx))
 
-        batch = db.batch()
-        count = 0
-        now = datetime.datetime.now()
-        batch_name = f"IMPORT-{now.strftime('%Y%m%d-%H%M')}-{uuid.uuid4().hex[:4].upper()}"
-        session_discounts = {} 
+        # Rules must exist before any product references them
+        commit_import_discounts(ctx)
 
-        for p_data in new_products:
-            # 1. Discounts
-            raw_discounts = p_data.get('discounts', [])
-            processed_discounts = []
-            discount_ids = []
-            for d in raw_discounts:
-                try:
-                    val = float(d.get('value', 0))
-                    if val > 0:
-                        if val in session_discounts:
-                            rule = session_discounts[val]
-                            rule_id, rule_name = rule
-                        else:
-                            new_rule_id = str(uuid.uuid4())
-                            display_val = int(val) if val.is_integer() else val
-                            rule_name = f"Imported {display_val}% [{batch_name}]"
-                            rule_doc = {'id': new_rule_id, 'name': rule_name, 'value': val, 'is_active': True, 'created_at': now}
-                            batch.set(db.collection('discounts').document(new_rule_id), rule_doc)
-                            count += 1
-                            session_discounts[val] = (new_rule_id, rule_name)
-                            rule_id = new_rule_id
-                        processed_discounts.append({'id': rule_id, 'name': rule_name, 'value': val})
-                        discount_ids.append(rule_id)
-                except: pass
-            
-            p_data['discounts'] = processed_discounts
-            p_data['discount_ids'] = discount_ids
-            
-            # 2. Check for ID (UPDATE MODE)
-            provided_id = p_data.get('id')
-            is_update = False
-            
-            if provided_id and len(provided_id) > 10: 
-                product_id = provided_id
-                is_update = True
-            else:
-                product_id = str(uuid.uuid4())
-
-            # 3. SKU Logic
-            brand_clean = p_data.get('brand', '').strip().upper()
-            category_clean = p_data.get('category', '').strip().title()
-            collection_clean = p_data.get('collection', '').strip()
-            manufacturer_code = p_data.get('code', '').strip()
-
-            if not is_update:
-                c1 = get_4char_segment(brand_clean)
-                c2 = get_4char_segment(category_clean)
-                c3 = get_4char_segment(collection_clean)
-                base_sku = f"{c1}-{c2}-{c3}"
-                final_sku = resolve_sku_collision(base_sku, existing_skus)
-                existing_skus.add(final_sku)
-            else:
-                final_sku = p_data.get('code') 
-
-            # 4. Pricing
-            total_stock = int(p_data.get('total_stock', 0))
-            raw_eur = p_data.get('retail_price_eur')
-            raw_usd = p_data.get('retail_price_usd')
-            raw_idr = int(p_data.get('retail_price_idr', 0))
-
-            final_idr = raw_idr
-            currency = 'IDR'
-            retail_eur = 0
-            retail_usd = 0
-
-            if raw_eur:
-                try:
-                    retail_eur = int(raw_eur)
-                    if retail_eur > 0:
-                        currency = 'EUR'
-                        final_idr = retail_eur * eur_rate
-                except: pass
-            elif raw_usd:
-                try:
-                    retail_usd = int(raw_usd)
-                    if retail_usd > 0:
-                        currency = 'USD'
-                        final_idr = retail_usd * usd_rate
-                except: pass
-
-            product_doc = {
-                'id': product_id,
-                'brand': brand_clean,
-                'category': category_clean,
-                'collection': collection_clean,
-                'manufacturer_code': manufacturer_code,
-                'image_url': p_data.get('image_url', ''), 
-                'detail': p_data.get('detail', ''),
-                'dimensions': p_data.get('dimensions', ''),
-                'finishing': p_data.get('finishing', ''),
-                'currency': currency,
-                'retail_price_idr': final_idr,
-                'retail_price_eur': retail_eur,
-                'retail_price_usd': retail_usd,
-                'total_stock': total_stock,
-                'nett_price_idr': int(p_data.get('nett_price_idr', final_idr)),
-                'discounts': processed_discounts,
-                'discount_ids': discount_ids,
-                'is_not_for_sale': p_data.get('is_not_for_sale', False),
-                'is_upcoming': p_data.get('is_upcoming', False),
-                'upcoming_eta': p_data.get('upcoming_eta', ''),
-            }
-            
-            if not is_update:
-                product_doc['code'] = final_sku
-                product_doc['booked_stock'] = 0
-                product_doc['sold_stock'] = 0
-                product_doc['created_at'] = now
-                product_doc['last_sequence'] = total_stock
-            
-            batch.set(db.collection('products').document(product_id), product_doc, merge=True)
-            count += 1
-
-            if not is_update:
-                for i in range(total_stock):
-                    seq_num = i + 1
-                    seq_str = str(seq_num).zfill(4)
-                    qr_content = f"{final_sku}-{seq_str}"
-
-                    item_ref = db.collection('inventory_items').document()
-                    status = 'AVAILABLE'
-                    if product_doc['is_not_for_sale']: status = 'NOT_FOR_SALE'
-                    
-                    item_data = {
-                        'product_id': product_id,
-                        'product_name': f"{product_doc['brand']} - {product_doc['collection']}",
-                        'qr_code': qr_content,
-                        'status': status,
-                        'current_location': p_data.get('location', 'Warehouse (Import)'),
-                        'created_at': now,
-                        'history_log': [{'action': 'BULK_IMPORT', 'batch_id': batch_name, 'location': p_data.get('location', 'Warehouse (Import)'), 'date': now, 'note': f'Imported via Batch {batch_name}'}]
-                    }
-                    batch.set(item_ref, item_data)
-                    count += 1
-
-            if count >= 400: batch.commit(); batch = db.batch(); count = 0
-        if count > 0: batch.commit()
-
-        return https_fn.Response(json.dumps({'success': True, 'count': len(new_products), 'batch_id': batch_name}), status=200, headers=headers, mimetype='application/json')
+        report = commit_import_groups(product_groups)
+        invalidate_cache('catalog_version')
+
+        result = {
+            'success': not report['failed_products'],
+            'count': len(new_products) - len(report['failed_products']),
+            'batch_id': ctx['batch_name'],
+            'failed_products': report['failed_products'],
+            'rollback_failed': report['rollback_failed'],
+            'chunks': report['chunks'],
+            'rollback_chunks': report['rollback_chunks']
+        }
+        return https_fn.Response(json.dumps(result), status=200, mimetype='application/json')
     except Exception as e:
-        return https_fn.Response(str(e), status=500, headers=headers)
+        return https_fn.Response(str(e), status=500)
 
-def export_inventory_excel(req: https_fn.Request) -> https_fn.Response:
-    headers = {
-        'Access-Control-Allow-Origin': '*', 
-        'Access-Control-Allow-Methods': 'GET', 
-        'Access-Control-Allow-Headers': 'Content-Type',
-        'Access-Control-Expose-Headers': 'Content-Disposition' 
-    }
-    if req.method == 'OPTIONS': return https_fn.Response('', status=204, headers=headers)
+EXPORT_COLUMNS = [
+    'system sku', 'brand', 'category', 'collection name', 'manufacturer id',
+    'dimensions', 'finishing', 'detail',
+    'retail price (eur)', 'retail price (usd)', 'retail price (idr)',
+    'discounts', 'nett price (idr)',
+    'not for sale', 'upcoming', 'eta',
+    'total qty', 'booked qty', 'available qty',
+    'location', 'system id', 'image file'
+]
+EXPORT_PRODUCT_FIELDS = [
+    'id', 'code', 'brand', 'category', 'collection', 'manufacturer_code', 'dimensions', 'finishing', 'detail',
+    'currency', 'retail_price_eur', 'retail_price_usd', 'retail_price_idr', 'nett_price_idr', 'nett_price_manual', 'discounts',
+    'is_not_for_sale', 'is_upcoming', 'upcoming_eta', 'total_stock', 'booked_stock', 'image_url', 'counter_shards', 'location_counts',
+    'pending_deletion'
+]
+EXPORT_MAX_WIDTH = 40
+EXPORT_PAGE_SIZE = 500
+EXPORT_CHUNK_SIZE = 64 * 1024
+XLSX_CONTENT_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
 
-    try:
-        settings_doc = db.collection('settings').document('global').get()
-        settings = settings_doc.to_dict() if settings_doc.exists else {'eur_rate': 17000, 'usd_rate': 15500}
-        eur_rate = settings.get('eur_rate', 17000)
-        usd_rate = settings.get('usd_rate', 15500)
-
-        all_items = db.collection('inventory_items').stream()
-        loc_map = {} 
-        for item in all_items:
-            i_data = item.to_dict()
-            pid = i_data.get('product_id')
-            status = i_data.get('status')
-            loc = i_data.get('current_location', '').strip()
-            if pid and loc and status != 'SOLD':
-                if pid not in loc_map: loc_map[pid] = set()
-                loc_map[pid].add(loc)
-
-        docs = db.collection('products').stream()
-        export_data = []
-        
-        for doc in docs:
-            p = doc.to_dict()
-            pid = p.get('id')
-            
-            currency = p.get('currency', 'IDR')
-            retail_eur = p.get('retail_price_eur', 0)
-            retail_usd = p.get('retail_price_usd', 0)
-            current_idr = p.get('retail_price_idr', 0)
-
-            if currency == 'EUR' and retail_eur > 0:
-                current_idr = retail_eur * eur_rate
-            elif currency == 'USD' and retail_usd > 0:
-                current_idr = retail_usd * usd_rate
-            
-            discounts = p.get('discounts', [])
-            discount_str = " + ".join([f"{d['value']}%" for d in discounts if d.get('value')])
-            if not discount_str: discount_str = None
-            
-            current_nett = current_idr
-            for d in discounts:
-                val = float(d.get('value', 0))
-                current_nett = current_nett * ((100 - val) / 100)
-            current_nett = int(current_nett)
-
-            locations = sorted(list(loc_map.get(pid, [])))
-            location_str = " | ".join(locations) if locations else None
-
-            nfs_str = "Not For Sale" if p.get('is_not_for_sale') else None
-            upcoming_str = "Upcoming" if p.get('is_upcoming') else None
-            
-            image_val = p.get('image_url', '').replace('products/', '')
-            if not image_val: image_val = None
-
-            row = {
-                'system sku': p.get('code') or None,
-                'brand': p.get('brand') or None,
-                'category': p.get('category') or None,
-                'collection name': p.get('collection') or None,
-                'manufacturer id': p.get('manufacturer_code') or None,
-                'dimensions': p.get('dimensions') or None,
-                'finishing': p.get('finishing') or None,
-                'detail': p.get('detail') or None,
-                
-                'retail price (eur)': retail_eur,
-                'retail price (usd)': retail_usd,
-                'retail price (idr)': current_idr,
-                
-                'discounts': discount_str,
-                'nett price (idr)': current_nett,
-                
-                'not for sale': nfs_str,
-                'upcoming': upcoming_str,
-                'eta': p.get('upcoming_eta') or None,
-                
-                'total qty': p.get('total_stock', 0),
-                'booked qty': p.get('booked_stock', 0),
-                'available qty': int(p.get('total_stock', 0)) - int(p.get('booked_stock', 0)),
-                
-                'location': location_str,
-                'system id': p.get('id') or None,
-                'image file': image_val
-            }
-            export_data.append(row)
+def build_export_row(p, current_idr, current_nett):
+    """Builds one worksheet row (in EXPORT_COLUMNS order) for a product dict and its live prices."""
+    retail_eur = p.get('retail_price_eur', 0)
+    retail_usd = p.get('retail_price_usd', 0)
+    
+    discounts = p.get('discounts', [])
+    discount_str = " + ".join([f"{d['value']}%" for d in discounts if d.get('value')])
+    if not discount_str: discount_str = None
 
-        export_data.sort(key=lambda x: (x['brand'] or '', x['collection name'] or ''))
+    # Maintained on write, so the export never scans inventory_items
+    locations = sorted(loc for loc, qty in p.get('location_counts', {}).items() if qty > 0)
+    location_str = " | ".join(locations) if locations else None
 
-        df = pd.DataFrame(export_data)
+    nfs_str = "Not For Sale" if p.get('is_not_for_sale') else None
+    upcoming_str = "Upcoming" if p.get('is_upcoming') else None
+    
+    image_val = p.get('image_url', '').replace('products/', '')
+    if not image_val: image_val = None
+
+    return (
+        p.get('code') or None,
+        p.get('brand') or None,
+        p.get('category') or None,
+        p.get('collection') or None,
+        p.get('manufacturer_code') or None,
+        p.get('dimensions') or None,
+        p.get('finishing') or None,
+        p.get('detail') or None,
+        
+        retail_eur,
+        retail_usd,
+        current_idr,
         
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df.to_excel(writer, index=False, sheet_name='Inventory Master')
-            worksheet = writer.sheets['Inventory Master']
-            for column_cells in worksheet.columns:
-                length = max(len(str(cell.value)) for cell in column_cells)
-                worksheet.column_dimensions[column_cells[0].column_letter].width = min(length + 2, 40)
-
-        output.seek(0)
+        discount_str,
+        current_nett,
+        
+        nfs_str,
+        upcoming_str,
+        p.get('upcoming_eta') or None,
+        
+        p.get('total_stock', 0),
+        p.get('booked_stock', 0),
+        int(p.get('total_stock', 0)) - int(p.get('booked_stock', 0)),
+        
+        location_str,
+        p.get('id') or None,
+        image_val
+    )
+
+def write_export_workbook(rows, widths, output):
+    """
+    Writes the rows with openpyxl's write-only mode, which streams rows to disk
+    instead of keeping a cell object per value in memory.
+    Column widths must be set before the first row is appended.
+    """
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Font
+    from openpyxl.utils import get_column_letter
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet('Inventory Master')
+    for idx, width in enumerate(widths, start=1):
+        ws.column_dimensions[get_column_letter(idx)].width = min(width + 2, EXPORT_MAX_WIDTH)
+
+    header_font = Font(bold=True)
+    header = []
+    for title in EXPORT_COLUMNS:
+        cell = WriteOnlyCell(ws, value=title)
+        cell.font = header_font
+        header.append(cell)
+    ws.append(header)
+
+    for row in rows:
+        ws.append(row)
+    wb.save(output)
+
+def iter_export_pages(query):
+    """Yields the docs of query one page of EXPORT_PAGE_SIZE at a time."""
+    query = query.limit(EXPORT_PAGE_SIZE)
+    last = None
+    while True:
+        docs = list((query.start_after(last) if last else query).stream())
+        if docs: yield docs
+        if len(docs) < EXPORT_PAGE_SIZE: return
+        last = docs[-1]
+
+def export_rows(docs, eur_rate, usd_rate):
+    """Worksheet rows for one page of product snapshots, priced at the current rates in one go."""
+    products = []
+    for doc in docs:
+        p = doc.to_dict() if doc.exists else None
+        if not p or p.get('pending_deletion'): continue
+        p.setdefault('id', doc.id)
+        products.append(merge_counter_shards(p))
+    if not products: return []
+    prices = price_arrays(products, eur_rate, usd_rate)
+    return [build_export_row(p, current_idr, current_nett)
+            for p, current_idr, current_nett in zip(products, prices['retail_price_idr'].tolist(), prices['nett_price_idr'].tolist())]
+
+def iter_export_rows(eur_rate, usd_rate):
+    """
+    Yields worksheet rows sorted by brand and collection, read from Firestore in that
+    order one page at a time. Products lacking either field drop out of an ordered
+    query; when the product count shows some are missing, a projected scan finds
+    them and their rows follow at the end.
+    """
+    products = db.collection('products')
+    ordered = products.order_by('brand').order_by('collection').order_by('__name__').select(EXPORT_PRODUCT_FIELDS)
+    seen = 0
+    for docs in iter_export_pages(ordered):
+        seen += len(docs)
+        yield from export_rows(docs, eur_rate, usd_rate)
+
+    if products.count().get()[0][0].value <= seen: return
+    for docs in iter_export_pages(products.order_by('__name__').select(['brand', 'collection'])):
+        refs = [doc.reference for doc in docs if not {'brand', 'collection'} <= set(doc.to_dict())]
+        if refs: yield from export_rows(list(db.get_all(refs, field_paths=EXPORT_PRODUCT_FIELDS)), eur_rate, usd_rate)
+
+def generate_export_file(eur_rate, usd_rate):
+    """Builds the Inventory Master workbook into a spooled temp file (rewound, ready to read)."""
+    # A write-only sheet needs its column widths before the first row, so the single
+    # pass over the catalog measures the rows while spooling them to disk as JSON lines
+    widths = [len(title) for title in EXPORT_COLUMNS]
+    with tempfile.TemporaryFile('w+') as spool:
+        for row in iter_export_rows(eur_rate, usd_rate):
+            for idx, value in enumerate(row):
+                if value is not None: widths[idx] = max(widths[idx], len(str(value)))
+            spool.write(json.dumps(row) + '\n')
+        spool.seek(0)
+
+        # Spills to disk past 8MB so large workbooks don't sit in memory
+        output = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+        write_export_workbook((json.loads(line) for line in spool), widths, output)
+    output.seek(0)
+    return output
+
+def stream_file(fileobj):
+    """Yields a file in EXPORT_CHUNK_SIZE chunks and closes it afterwards."""
+    try:
+        while True:
+            chunk = fileobj.read(EXPORT_CHUNK_SIZE)
+            if not chunk: break
+            yield chunk
+    finally:
+        fileobj.close()
+
+# --- EXPORT CACHE (Cloud Storage) ---
+EXPORT_CACHE_PREFIX = 'exports/inventory_master/'
+EXPORT_CACHE_KEEP = 5
+
+def get_export_cache_key(eur_rate, usd_rate):
+    """
+    Cache key = catalog version + exchange rates. Any product write moves the
+    version and any rate change alters the hash, so a stale file is never served.
+    """
+    rates_hash = hashlib.sha1(f"{eur_rate}|{usd_rate}".encode()).hexdigest()[:10]
+    return f"{EXPORT_CACHE_PREFIX}v{load_catalog_version()}-{rates_hash}.xlsx"
+
+def evict_export_cache(bucket, keep=EXPORT_CACHE_KEEP):
+    """Deletes all but the newest `keep` cached exports."""
+    blobs = sorted(bucket.list_blobs(prefix=EXPORT_CACHE_PREFIX), key=lambda b: b.time_created, reverse=True)
+    for blob in blobs[keep:]:
+        try:
+            blob.delete()
+        except Exception:
+            pass  # Another instance may have evicted it already
+
+@instrumented
+@endpoint('GET', expose_headers='Content-Disposition, X-Export-Cache')
+def export_inventory_excel(req: https_fn.Request) -> https_fn.Response:
+    """
+    Streams the Inventory Master workbook. Generated files are cached in Storage
+    under a key derived from the catalog version and exchange rates; repeated
+    downloads of unchanged data stream the cached file. Pass ?refresh=1 to bypass.
+    Locally, set STORAGE_EMULATOR_HOST to run against the Storage emulator.
+    """
+    try:
+        eur_rate, usd_rate = get_exchange_rates_cached()
+
+        bucket = get_bucket()
+        blob = bucket.blob(get_export_cache_key(eur_rate, usd_rate))
+
+        if blob.exists() and req.args.get('refresh') != '1':
+            cache_status = 'HIT'
+            output = blob.open('rb')
+        else:
+            cache_status = 'MISS'
+            output = generate_export_file(eur_rate, usd_rate)
+            blob.upload_from_file(output, rewind=True, content_type=XLSX_CONTENT_TYPE)
+            evict_export_cache(bucket)
+            output.seek(0)
         
         filename = f"EDSIS_Inventory_Master_{datetime.datetime.now().strftime('%Y-%m-%d_%H%M')}.xlsx"
         file_headers = {
-            **headers,
-            'Content-Type': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            'Content-Disposition': f'attachment; filename="{filename}"'
+            'Content-Type': XLSX_CONTENT_TYPE,
+            'Content-Disposition': f'attachment; filename="{filename}"',
+            'X-Export-Cache': cache_status
         }
-        return https_fn.Response(output.read(), status=200, headers=file_headers)
+        return https_fn.Response(stream_file(output), status=200, headers=file_headers, direct_passthrough=True)
 
     except Exception as e:
-        return https_fn.Response(str(e), status=500, headers=headers)
\ No newline at end of file
+        return https_fn.Response(str(e), status=500)
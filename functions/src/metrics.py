@@ -0,0 +1,208 @@
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from firebase_functions import https_fn, logger
+
+# --- REQUEST INSTRUMENTATION ---
+# @instrumented wraps every exported function and emits one structured log line per
+# invocation: wall time, cumulative phase timings (query / serialize / commit),
+# Firestore document reads, writes and deletes, and request/response bytes.
+# Firestore calls are counted by hooks on the client library, so endpoint code only
+# has to use phase() for anything beyond those three phases.
+# Send 'X-Debug-Metrics: 1' (or set METRICS_DEBUG_HEADERS=1) to get the same numbers
+# back in Server-Timing and X-Debug-Metrics response headers.
+DEBUG_HEADER = 'X-Debug-Metrics'
+DEBUG_ALWAYS = os.environ.get('METRICS_DEBUG_HEADERS') == '1'
+
+_current = contextvars.ContextVar('request_metrics', default=None)
+
+class RequestMetrics:
+    def __init__(self, name):
+        self.name = name
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+        self.phases = {}
+        self.ops = {'reads': 0, 'writes': 0, 'deletes': 0}
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.status = None
+
+    def add_time(self, phase_name, seconds):
+        with self.lock: self.phases[phase_name] = self.phases.get(phase_name, 0.0) + seconds
+
+    def add_ops(self, **counts):
+        with self.lock:
+            for kind, n in counts.items(): self.ops[kind] = self.ops.get(kind, 0) + n
+
+    def summary(self):
+        return {
+            'function': self.name,
+            'status': self.status,
+            'wall_ms': round((time.perf_counter() - self.started) * 1000, 1),
+            # Phases are summed across worker threads, so they can exceed wall time
+            'phases_ms': {k: round(v * 1000, 1) for k, v in self.phases.items()},
+            **self.ops,
+            'request_bytes': self.request_bytes,
+            'response_bytes': self.response_bytes,
+        }
+
+    def log(self):
+        logger.info(f"metrics {self.name}", metrics=self.summary())
+
+def current_metrics():
+    return _current.get()
+
+def record_ops(**counts):
+    metrics = _current.get()
+    if metrics is not None: metrics.add_ops(**counts)
+
+@contextmanager
+def phase(name):
+    """Adds the time spent in the block to the current request's `name` phase."""
+    metrics = _current.get()
+    if metrics is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.add_time(name, time.perf_counter() - start)
+
+def in_context(fn):
+    """Binds fn to the caller's context so work submitted to a thread pool is still counted."""
+    ctx = contextvars.copy_context()
+    return functools.partial(ctx.run, fn)
+
+# --- FIRESTORE HOOKS ---
+
+def _count_stream(stream, phase_name='query'):
+    """Wraps a document iterator: one read per document, time spent fetching goes to the phase."""
+    metrics = _current.get()
+    iterator = iter(stream)
+    while True:
+        start = time.perf_counter()
+        try:
+            doc = next(iterator)
+        except StopIteration:
+            if metrics is not None: metrics.add_time(phase_name, time.perf_counter() - start)
+            return
+        if metrics is not None:
+            metrics.add_time(phase_name, time.perf_counter() - start)
+            metrics.add_ops(reads=1)
+        yield doc
+
+def _count_writes(write_pbs):
+    deletes = sum(1 for pb in write_pbs if getattr(pb, 'delete', ''))
+    record_ops(writes=len(write_pbs) - deletes, deletes=deletes)
+
+_hooks_installed = False
+
+def install_firestore_hooks():
+    """Patches the Firestore client once so reads/writes are attributed to the current request."""
+    global _hooks_installed
+    if _hooks_installed: return
+    _hooks_installed = True
+    from google.cloud.firestore_v1.query import Query
+    from google.cloud.firestore_v1.client import Client
+    from google.cloud.firestore_v1.document import DocumentReference
+    from google.cloud.firestore_v1.batch import WriteBatch
+    from google.cloud.firestore_v1.transaction import Transaction
+
+    query_stream = Query.stream
+    def stream(self, *args, **kwargs):
+        return _count_stream(query_stream(self, *args, **kwargs))
+    Query.stream = stream
+
+    client_get_all = Client.get_all
+    def get_all(self, *args, **kwargs):
+        return _count_stream(client_get_all(self, *args, **kwargs))
+    Client.get_all = get_all
+
+    document_get = DocumentReference.get
+    def get(self, *args, **kwargs):
+        with phase('query'):
+            snap = document_get(self, *args, **kwargs)
+        record_ops(reads=1)
+        return snap
+    DocumentReference.get = get
+
+    batch_commit = WriteBatch.commit
+    def commit(self, *args, **kwargs):
+        write_pbs = list(self._write_pbs)  # commit() clears them
+        with phase('commit'):
+            result = batch_commit(self, *args, **kwargs)
+        _count_writes(write_pbs)
+        return result
+    WriteBatch.commit = commit
+
+    transaction_commit = Transaction._commit
+    def transaction_commit_hook(self, *args, **kwargs):
+        write_pbs = list(self._write_pbs)
+        with phase('commit'):
+            result = transaction_commit(self, *args, **kwargs)
+        _count_writes(write_pbs)
+        return result
+    Transaction._commit = transaction_commit_hook
+
+# --- DECORATOR ---
+
+def _debug_headers(metrics):
+    summary = metrics.summary()
+    timing = [f"{name};dur={ms}" for name, ms in summary['phases_ms'].items()] + [f"total;dur={summary['wall_ms']}"]
+    return {'Server-Timing': ', '.join(timing), DEBUG_HEADER: json.dumps(summary)}
+
+def _finish_stream(metrics, body):
+    """Streams the body under the request's metrics and logs once the last chunk is sent."""
+    token = _current.set(metrics)
+    try:
+        for chunk in body:
+            metrics.response_bytes += len(chunk)
+            yield chunk
+    finally:
+        try: _current.reset(token)
+        except ValueError: pass  # closed from another context; nothing left to attribute
+        metrics.log()
+
+def instrumented(fn):
+    """
+    Wraps an exported function (HTTP, scheduled or task) with request metrics.
+    Goes above @endpoint so response sizes are measured after compression.
+    """
+    install_firestore_hooks()
+
+    @functools.wraps(fn)
+    def wrapper(req, *args, **kwargs):
+        if getattr(req, 'method', None) == 'OPTIONS': return fn(req, *args, **kwargs)
+        metrics = RequestMetrics(fn.__name__)
+        token = _current.set(metrics)
+        try:
+            result = fn(req, *args, **kwargs)
+        except Exception:
+            metrics.status = 'exception'
+            metrics.log()
+            raise
+        finally:
+            _current.reset(token)
+
+        if not isinstance(result, https_fn.Response):
+            metrics.status = 'ok'
+            metrics.log()
+            return result
+
+        metrics.status = result.status_code
+        metrics.request_bytes = req.content_length or 0
+        if result.is_streamed:
+            # Headers go out before the body is produced, so streamed replies only get the log line
+            result.response = _finish_stream(metrics, result.response)
+            return result
+        metrics.response_bytes = len(result.get_data())
+        if DEBUG_ALWAYS or req.headers.get(DEBUG_HEADER) == '1':
+            result.headers.update(_debug_headers(metrics))
+        metrics.log()
+        return result
+    return wrapper
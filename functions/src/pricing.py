@@ -0,0 +1,90 @@
+from firebase_admin import firestore
+
+DEFAULT_RATES = {'eur_rate': 17000, 'usd_rate': 15500}
+
+# Fields the repricing job needs from each product
+PRICING_FIELDS = ['currency', 'retail_price_eur', 'retail_price_usd', 'retail_price_idr', 'nett_price_idr', 'nett_price_manual', 'discounts']
+# Nett prices are truncated to whole rupiah; a given nett within this of the computed one is not an override
+NETT_TOLERANCE = 1
+
+# --- SCALAR (single product) ---
+
+def compute_retail_idr(currency, retail_eur, retail_usd, retail_idr, eur_rate, usd_rate):
+    """IDR retail price: converted from the base currency when it is EUR/USD, otherwise the stored IDR."""
+    if currency == 'EUR' and (retail_eur or 0) > 0: return retail_eur * eur_rate
+    if currency == 'USD' and (retail_usd or 0) > 0: return retail_usd * usd_rate
+    return retail_idr or 0
+
+def compute_nett_price(retail_idr, discounts):
+    """Applies discounts compounded in order (20% + 10% = 72% of retail), truncated to int."""
+    current = retail_idr
+    for d in discounts or []:
+        current = current * ((100 - float(d.get('value', 0))) / 100)
+    return int(current)
+
+# --- VECTORIZED (whole catalog) ---
+# numpy is imported inside these functions: it costs most of a cold start, and only
+# catalog-wide jobs (repricing, export) need it.
+
+def discount_factor_matrix(discount_lists):
+    """
+    Pads the ragged discount lists into an (n_products, max_discounts) matrix of
+    multipliers. Missing slots are 1.0, which leaves the product unchanged.
+    """
+    import numpy as np
+    width = max((len(d or []) for d in discount_lists), default=0)
+    factors = np.ones((len(discount_lists), width))
+    for row, discounts in enumerate(discount_lists):
+        for col, d in enumerate(discounts or []):
+            factors[row, col] = (100 - float(d.get('value', 0))) / 100
+    return factors
+
+def apply_discount_factors(retail, factors):
+    """Nett prices for a retail array, applying the discount columns one after another like compute_nett_price."""
+    import numpy as np
+    nett = retail.astype(float)
+    for col in range(factors.shape[1]):
+        nett = nett * factors[:, col]
+    return np.trunc(nett).astype(np.int64)
+
+def price_arrays(products, eur_rate, usd_rate):
+    """
+    Computes retail_price_idr and nett_price_idr for a list of product dicts at once.
+    Returns {'retail_price_idr': array, 'nett_price_idr': array} of int64 in the order
+    of `products`. A nett flagged nett_price_manual was entered by hand and is kept as is.
+    """
+    import numpy as np
+    currency = np.array([p.get('currency') or 'IDR' for p in products])
+    eur = np.array([p.get('retail_price_eur') or 0 for p in products], dtype=float)
+    usd = np.array([p.get('retail_price_usd') or 0 for p in products], dtype=float)
+    idr = np.array([p.get('retail_price_idr') or 0 for p in products], dtype=np.int64)
+    stored_nett = np.array([p.get('nett_price_idr') or 0 for p in products], dtype=np.int64)
+    manual = np.array([bool(p.get('nett_price_manual')) for p in products], dtype=bool)
+
+    retail = np.where((currency == 'EUR') & (eur > 0), eur * eur_rate,
+             np.where((currency == 'USD') & (usd > 0), usd * usd_rate, idr)).astype(np.int64)
+    factors = discount_factor_matrix([p.get('discounts') for p in products])
+    nett = np.where(manual, stored_nett, apply_discount_factors(retail, factors))
+    return {'retail_price_idr': retail, 'nett_price_idr': nett}
+
+# --- REPRICING ---
+# Only EUR/USD products follow the exchange rates; IDR prices are stored as entered.
+REPRICED_CURRENCIES = ['EUR', 'USD']
+
+def reprice_page(docs, eur_rate, usd_rate):
+    """
+    Update ops for the products in `docs` (snapshots projected to PRICING_FIELDS)
+    whose retail or nett price changes at the given rates.
+    """
+    import numpy as np
+    if not docs: return []
+    products = [doc.to_dict() for doc in docs]
+    prices = price_arrays(products, eur_rate, usd_rate)
+    old_retail = np.array([p.get('retail_price_idr') or 0 for p in products], dtype=np.int64)
+    old_nett = np.array([p.get('nett_price_idr') or 0 for p in products], dtype=np.int64)
+    changed = np.flatnonzero((prices['retail_price_idr'] != old_retail) | (prices['nett_price_idr'] != old_nett))
+    return [('update', docs[i].reference, {
+        'retail_price_idr': int(prices['retail_price_idr'][i]),
+        'nett_price_idr': int(prices['nett_price_idr'][i]),
+        'updated_at': firestore.SERVER_TIMESTAMP
+    }) for i in changed]
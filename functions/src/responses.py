@@ -0,0 +1,120 @@
+from firebase_functions import https_fn
+import functools
+import gzip
+import hashlib
+import zlib
+from .metrics import DEBUG_HEADER
+
+try:
+    import brotli
+except ImportError:  # optional; gzip is used when brotli isn't installed
+    brotli = None
+
+# --- SHARED RESPONSE LAYER ---
+# @endpoint wraps every HTTP function: it answers CORS preflights, adds the CORS
+# headers to whatever the function returns, and compresses JSON/text bodies
+# according to Accept-Encoding. Endpoints only build their payload.
+COMPRESS_MIN_BYTES = 1024
+COMPRESSIBLE_TYPES = ('application/json', 'text/')
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5  # fast enough for per-request compression, still well ahead of gzip
+
+def cors_headers(methods, allow_headers='', expose_headers=''):
+    # The metrics debug headers (see metrics.py) are allowed/exposed everywhere
+    return {
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Allow-Methods': methods,
+        'Access-Control-Allow-Headers': ', '.join(h for h in ('Content-Type', allow_headers, DEBUG_HEADER) if h),
+        'Access-Control-Expose-Headers': ', '.join(h for h in (expose_headers, 'Server-Timing', DEBUG_HEADER) if h),
+    }
+
+def choose_encoding(req):
+    """'br', 'gzip' or None from Accept-Encoding, honouring q=0."""
+    accepted = {}
+    for part in req.headers.get('Accept-Encoding', '').split(','):
+        name, _, params = part.strip().partition(';')
+        q = 1.0
+        if params.strip().startswith('q='):
+            try: q = float(params.strip()[2:])
+            except ValueError: q = 0.0
+        if name: accepted[name.lower()] = q
+    if brotli is not None and accepted.get('br', 0) > 0: return 'br'
+    if accepted.get('gzip', 0) > 0: return 'gzip'
+    return None
+
+def compress_bytes(body, encoding):
+    if encoding == 'br': return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+def compress_stream(chunks, encoding):
+    """Compresses a streamed body chunk by chunk, flushing so the client can start parsing early."""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        process, flush, finish = compressor.process, compressor.flush, compressor.finish
+    else:
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)  # wbits 31 = gzip container
+        process, finish = compressor.compress, compressor.flush
+        flush = lambda: compressor.flush(zlib.Z_SYNC_FLUSH)
+    for chunk in chunks:
+        if isinstance(chunk, str): chunk = chunk.encode()
+        data = process(chunk) + flush()
+        if data: yield data
+    yield finish()
+
+def compress_response(req, response):
+    mimetype = response.mimetype or ''
+    if response.status_code in (204, 304) or 'Content-Encoding' in response.headers: return response
+    if not mimetype.startswith(COMPRESSIBLE_TYPES): return response
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding(req)
+    if encoding is None: return response
+
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        body = response.get_data()
+        if len(body) < COMPRESS_MIN_BYTES: return response
+        response.set_data(compress_bytes(body, encoding))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+def apply_http_cache(req, response, cache_control):
+    """
+    Sets Cache-Control and, when the endpoint didn't set its own, a weak ETag over
+    the uncompressed body. A matching If-None-Match turns the reply into a 304.
+    """
+    response.headers.setdefault('Cache-Control', cache_control)
+    if response.status_code != 200 or response.is_streamed: return response
+    if 'ETag' not in response.headers:
+        response.headers['ETag'] = f'W/"{hashlib.sha1(response.get_data()).hexdigest()[:16]}"'
+    if response.headers['ETag'] in [t.strip() for t in req.headers.get('If-None-Match', '').split(',')]:
+        return https_fn.Response('', status=304, headers={k: v for k, v in response.headers.items() if k in ('ETag', 'Cache-Control', 'Vary')})
+    return response
+
+def endpoint(methods, allow_headers='', expose_headers='', cache_control=None):
+    """
+    Decorator for HTTP functions.
+      methods: value for Access-Control-Allow-Methods (e.g. 'GET')
+      allow_headers / expose_headers: extra CORS request/response headers
+      cache_control: e.g. 'no-cache' (revalidate every time) or 'public, max-age=60';
+                     adds an ETag and answers a matching If-None-Match with 304
+    """
+    if cache_control:
+        allow_headers = ', '.join(h for h in (allow_headers, 'If-None-Match') if h)
+        expose_headers = ', '.join(h for h in (expose_headers, 'ETag') if h)
+    headers = cors_headers(methods, allow_headers, expose_headers)
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(req: https_fn.Request) -> https_fn.Response:
+            if req.method == 'OPTIONS': return https_fn.Response('', status=204, headers=headers)
+            try:
+                response = fn(req)
+            except Exception as e:
+                response = https_fn.Response(str(e), status=500)
+            if cache_control: response = apply_http_cache(req, response, cache_control)
+            for key, value in headers.items(): response.headers.setdefault(key, value)
+            return compress_response(req, response)
+        return wrapper
+    return decorator
@@ -0,0 +1,131 @@
+from firebase_functions import https_fn
+import json
+
+from .config import db
+from .responses import endpoint
+from .metrics import instrumented
+from .utils import dumps, search_text, build_search_keywords, SEARCH_FIELDS, SEARCH_INDEX_FIELD
+from .inventory import merge_counter_shards
+from .batching import BATCH_LIMIT, commit_chunks_parallel, pack_groups
+
+# --- PRODUCT SEARCH ---
+# Same matching rules as the client filter: the query is split on commas and every
+# term must appear in "brand category collection code manufacturer_code".
+# One array-contains query on search_keywords (see utils.build_search_keywords)
+# narrows the catalog to candidates; only their searchable fields are read, then
+# the current page of matches is fetched in full.
+SEARCH_PAGE_SIZE = 50
+SEARCH_MAX_PAGE_SIZE = 500
+SEARCH_CANDIDATE_LIMIT = 5000
+
+def parse_terms(q):
+    return [t.strip() for t in (q or '').lower().split(',') if t.strip()]
+
+def index_key(terms):
+    """The most selective keyword every match must carry: first trigram of the longest word, else its prefix."""
+    word = max((w for t in terms for w in t.split()), key=len)
+    return word[:3] if len(word) >= 3 else word
+
+def match_rank(product, terms):
+    """0 = a term equals the SKU or manufacturer code, 1 = every term starts a token, 2 = substring match."""
+    codes = {str(product.get(f) or '').lower() for f in ('code', 'manufacturer_code')}
+    if any(t in codes for t in terms): return 0
+    text = ' ' + search_text(product)
+    if all(f" {t}" in text for t in terms): return 1
+    return 2
+
+def find_matches(terms):
+    """
+    (ids, truncated): ids of the products matching every term, best matches first.
+    truncated is True when SEARCH_CANDIDATE_LIMIT cut the candidates short, so
+    matches beyond the limit are missing.
+    """
+    query = db.collection('products').where(SEARCH_INDEX_FIELD, 'array_contains', index_key(terms))
+    query = query.select(list(SEARCH_FIELDS) + ['pending_deletion']).limit(SEARCH_CANDIDATE_LIMIT)
+    matches = []
+    candidates = 0
+    for doc in query.stream():
+        candidates += 1
+        p = doc.to_dict()
+        if p.get('pending_deletion'): continue
+        text = search_text(p)
+        if not all(t in text for t in terms): continue
+        sort_key = (match_rank(p, terms), (p.get('brand') or '').lower(), (p.get('collection') or '').lower(), doc.id)
+        matches.append((sort_key, doc.id))
+    matches.sort()
+    return [pid for _, pid in matches], candidates >= SEARCH_CANDIDATE_LIMIT
+
+@instrumented
+@endpoint('GET')
+def search_products(req: https_fn.Request) -> https_fn.Response:
+    """
+    Ranked product search.
+    Query params: q (comma separated terms), page_size (default 50), cursor (offset from the previous page).
+    Returns {data, total, next_cursor, truncated}; next_cursor is null on the last page.
+    truncated means the query was too broad to scan every candidate: refine it.
+    """
+    terms = parse_terms(req.args.get('q'))
+    if not terms: return https_fn.Response("Missing q", status=400)
+
+    try:
+        page_size = min(max(int(req.args.get('page_size', SEARCH_PAGE_SIZE)), 1), SEARCH_MAX_PAGE_SIZE)
+        offset = int(req.args.get('cursor') or 0)
+
+        ids, truncated = find_matches(terms)
+        page_ids = ids[offset:offset + page_size]
+        docs = {}
+        if page_ids:
+            for snap in db.get_all([db.collection('products').document(pid) for pid in page_ids]):
+                if not snap.exists: continue
+                p = snap.to_dict()
+                p['id'] = snap.id
+                p.pop(SEARCH_INDEX_FIELD, None)
+                docs[snap.id] = merge_counter_shards(p)
+
+        next_offset = offset + page_size
+        result = {
+            'data': [docs[pid] for pid in page_ids if pid in docs],
+            'total': len(ids),
+            'next_cursor': str(next_offset) if next_offset < len(ids) else None,
+            'truncated': truncated,
+        }
+        return https_fn.Response(dumps(result), status=200, mimetype='application/json')
+    except ValueError:
+        return https_fn.Response("Invalid page_size or cursor", status=400)
+    except Exception as e:
+        return https_fn.Response(str(e), status=500)
+
+# --- INDEX MAINTENANCE ---
+
+def rebuild_search_keywords(cursor=None, page_size=BATCH_LIMIT):
+    """
+    Recomputes search_keywords for one page of products, writing only those that
+    changed. Returns (updated, next_cursor), next_cursor being None after the last page.
+    """
+    query = db.collection('products').order_by('__name__').select(list(SEARCH_FIELDS) + [SEARCH_INDEX_FIELD]).limit(page_size)
+    if cursor: query = query.start_after({'__name__': db.collection('products').document(cursor)})
+    groups = []
+    last_id = None
+    scanned = 0
+    for doc in query.stream():
+        last_id = doc.id
+        scanned += 1
+        p = doc.to_dict()
+        keywords = build_search_keywords(p)
+        if p.get(SEARCH_INDEX_FIELD) != keywords:
+            groups.append((doc.id, [('update', doc.reference, {SEARCH_INDEX_FIELD: keywords})]))
+    results = commit_chunks_parallel(pack_groups(groups))
+    failed = [r['error'] for r in results if r['status'] == 'failed']
+    if failed: raise RuntimeError(f"Search index rebuild failed for {len(failed)} chunk(s): {failed[0]}")
+    return len(groups), (last_id if scanned == page_size else None)
+
+@instrumented
+@endpoint('POST')
+def rebuild_search_index(req: https_fn.Request) -> https_fn.Response:
+    """One page of the search_keywords backfill. Call again with next_cursor until it is null."""
+    try:
+        data = req.get_json(silent=True) or {}
+        updated, next_cursor = rebuild_search_keywords(data.get('cursor'), int(data.get('page_size', BATCH_LIMIT)))
+        return https_fn.Response(json.dumps({'success': True, 'updated': updated, 'next_cursor': next_cursor}), status=200, mimetype='application/json')
+    except Exception as e:
+        return https_fn.Response(str(e), status=500)
@@ -1,31 +1,33 @@
-from firebase_functions import https_fn
-from firebase_admin import firestore
+from firebase_functions import https_fn, tasks_fn, scheduler_fn
+from firebase_functions.options import RetryConfig, RateLimits
+from firebase_admin import firestore, functions
 import json
+import time
 import datetime
 import uuid
 from .config import db
-from .utils import serialize_doc
+from .batching import split_ops, commit_chunks_parallel
+from .responses import endpoint
+from .metrics import instrumented
+from .utils import dumps
+from .cache import cache_stats, get_settings, get_discount_rules, find_discount_by_name, invalidate as invalidate_cache
+from .pricing import PRICING_FIELDS, REPRICED_CURRENCIES, compute_nett_price, reprice_page
 
 # --- EXCHANGE RATES ---
 
 @https_fn.on_request(region="asia-southeast2")
+@instrumented
+@endpoint('GET', cache_control='no-cache')
 def get_exchange_rates(req: https_fn.Request) -> https_fn.Response:
-    headers = {'Access-Control-Allow-Origin': '*', 'Access-Control-Allow-Methods': 'GET', 'Access-Control-Allow-Headers': 'Content-Type'}
-    if req.method == 'OPTIONS': return https_fn.Response('', status=204, headers=headers)
-    
     try:
-        doc = db.collection('settings').document('global').get()
-        data = doc.to_dict() if doc.exists else {'eur_rate': 17000, 'usd_rate': 15500} 
-        serialized_data = serialize_doc(data)
-        return https_fn.Response(json.dumps({'data': serialized_data}), status=200, headers=headers, mimetype='application/json')
+        return https_fn.Response(dumps({'data': get_settings()}), status=200, mimetype='application/json')
     except Exception as e:
-        return https_fn.Response(str(e), status=500, headers=headers)
+        return https_fn.Response(str(e), status=500)
 
 @https_fn.on_request(region="asia-southeast2")
+@instrumented
+@endpoint('POST')
 def update_exchange_rates(req: https_fn.Request) -> https_fn.Response:
-    headers = {'Access-Control-Allow-Origin': '*', 'Access-Control-Allow-Methods': 'POST', 'Access-Control-Allow-Headers': 'Content-Type'}
-    if req.method == 'OPTIONS': return https_fn.Response('', status=204, headers=headers)
-
     try:
         data = req.get_json()
         rates = {
@@ -34,44 +36,295 @@ def update_exchange_rates(req: https_fn.Request) -> https_fn.Response:
             'last_updated': datetime.datetime.now()
         }
         db.collection('settings').document('global').set(rates, merge=True)
-        return https_fn.Response(json.dumps({'success': True}), status=200, headers=headers, mimetype='application/json')
+        invalidate_cache('settings')
+
+        # Stored IDR prices follow the new rates in a background job; poll get_repricing_job
+        job_id = start_repricing()
+        return https_fn.Response(json.dumps({'success': True, 'job_id': job_id}), status=200, mimetype='application/json')
     except Exception as e:
-        return https_fn.Response(str(e), status=500, headers=headers)
+        return https_fn.Response(str(e), status=500)
 
-# --- DISCOUNTS ---
+@https_fn.on_request(region="asia-southeast2")
+@instrumented
+@endpoint('GET')
+def get_cache_stats(req: https_fn.Request) -> https_fn.Response:
+    """Hit/miss counters of the settings/discounts cache on the instance serving this request."""
+    return https_fn.Response(json.dumps({'data': cache_stats()}), status=200, mimetype='application/json')
+
+# --- REPRICING JOB ---
+# A rate change rewrites the stored IDR prices of every EUR/USD product. Like the
+# discount fan-out it runs in repricing_jobs/{job_id}: a Cloud Task reprices pages
+# of products, checkpointing the last product id, and re-enqueues itself when its
+# time budget runs out. A scheduled sweep resumes jobs whose task was lost.
+REPRICE_PAGE_SIZE = 1600
+REPRICE_TIME_BUDGET = 240  # seconds per task, well below the task timeout
+REPRICE_STALE_AFTER = datetime.timedelta(minutes=10)
+
+def enqueue_repricing(job_id):
+    queue = functions.task_queue("locations/asia-southeast2/functions/run_repricing")  # the task function is deployed in asia-southeast2, not the default us-central1
+    queue.enqueue({'job_id': job_id})
+
+def start_repricing():
+    job_ref = db.collection('repricing_jobs').document()
+    job_ref.set({
+        'id': job_ref.id,
+        'status': 'PENDING',
+        'cursor': None,
+        'processed': 0,
+        'updated': 0,
+        'created_at': firestore.SERVER_TIMESTAMP,
+        'updated_at': firestore.SERVER_TIMESTAMP
+    })
+    enqueue_repricing(job_ref.id)
+    return job_ref.id
+
+def process_repricing(job_id):
+    """
+    Runs (or resumes) a repricing job from its checkpoint until done or out of time.
+    Returns True when the job finished. Repricing a page again is harmless.
+    """
+    job_ref = db.collection('repricing_jobs').document(job_id)
+    job_snap = job_ref.get()
+    if not job_snap.exists: return True
+    job = job_snap.to_dict()
+    if job.get('status') in ('DONE', 'FAILED'): return True
+
+    # Always apply the current rates, so an older job can't overwrite a newer change
+    settings_snap = db.collection('settings').document('global').get()
+    settings = settings_snap.to_dict() if settings_snap.exists else {}
+    eur_rate, usd_rate = settings.get('eur_rate', 0), settings.get('usd_rate', 0)
+
+    job_ref.update({'status': 'RUNNING', 'eur_rate': eur_rate, 'usd_rate': usd_rate, 'updated_at': firestore.SERVER_TIMESTAMP})
+    started = time.monotonic()
+    cursor = job.get('cursor')
+    processed, updated = job.get('processed', 0), job.get('updated', 0)
+
+    while time.monotonic() - started < REPRICE_TIME_BUDGET:
+        query = (db.collection('products')
+                 .where('currency', 'in', REPRICED_CURRENCIES)
+                 .order_by('__name__')
+                 .select(PRICING_FIELDS)
+                 .limit(REPRICE_PAGE_SIZE))
+        if cursor: query = query.start_after(db.collection('products').document(cursor))
+        docs = list(query.stream())
+
+        ops = reprice_page(docs, eur_rate, usd_rate)
+        results = commit_chunks_parallel([{'keys': [], 'ops': chunk} for chunk in split_ops(ops)])
+        failed = [r['error'] for r in results if r['status'] == 'failed']
+        if failed:
+            job_ref.update({'status': 'FAILED', 'error': failed[0], 'updated_at': firestore.SERVER_TIMESTAMP})
+            return True
+
+        processed += len(docs)
+        updated += len(ops)
+        if docs: cursor = docs[-1].id
+        done = len(docs) < REPRICE_PAGE_SIZE
+        job_ref.update({
+            'cursor': cursor,
+            'processed': processed,
+            'updated': updated,
+            'status': 'DONE' if done else 'RUNNING',
+            'updated_at': firestore.SERVER_TIMESTAMP
+        })
+        if done: return True
+    return False
+
+@tasks_fn.on_task_dispatched(
+    retry_config=RetryConfig(max_attempts=5, min_backoff_seconds=30),
+    rate_limits=RateLimits(max_concurrent_dispatches=2),
+    region="asia-southeast2",
+    timeout_sec=300
+)
+@instrumented
+def run_repricing(req: tasks_fn.CallableRequest) -> None:
+    job_id = req.data.get('job_id')
+    if job_id and not process_repricing(job_id):
+        enqueue_repricing(job_id)
+
+@scheduler_fn.on_schedule(schedule="every 10 minutes", region="asia-southeast2")
+@instrumented
+def resume_stalled_repricing_jobs(event: scheduler_fn.ScheduledEvent) -> None:
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - REPRICE_STALE_AFTER
+    for status in ('PENDING', 'RUNNING'):
+        for doc in db.collection('repricing_jobs').where('status', '==', status).stream():
+            if doc.to_dict().get('updated_at') and doc.to_dict()['updated_at'] < cutoff:
+                enqueue_repricing(doc.id)
 
 @https_fn.on_request(region="asia-southeast2")
-def get_discounts(req: https_fn.Request) -> https_fn.Response:
-    headers = {'Access-Control-Allow-Origin': '*', 'Access-Control-Allow-Methods': 'GET', 'Access-Control-Allow-Headers': 'Content-Type'}
-    if req.method == 'OPTIONS': return https_fn.Response('', status=204, headers=headers)
+@instrumented
+@endpoint('GET')
+def get_repricing_job(req: https_fn.Request) -> https_fn.Response:
+    job_id = req.args.get('job_id')
+    if not job_id: return https_fn.Response("Missing job_id", status=400)
 
     try:
-        docs = db.collection('discounts').stream()
-        discounts = []
+        doc = db.collection('repricing_jobs').document(job_id).get()
+        if not doc.exists: return https_fn.Response("Job not found", status=404)
+        return https_fn.Response(dumps({'data': doc.to_dict()}), status=200, mimetype='application/json')
+    except Exception as e:
+        return https_fn.Response(str(e), status=500)
+
+# --- DISCOUNT FAN-OUT JOB ---
+# Editing a rule rewrites the embedded copy on every product using it. That runs
+# as a background job in discount_jobs/{job_id}: a Cloud Task processes pages of
+# products, checkpointing the last product id, and re-enqueues itself when its
+# time budget runs out. A scheduled sweep resumes jobs whose task was lost.
+FANOUT_PAGE_SIZE = 1600
+FANOUT_TIME_BUDGET = 240  # seconds per task, well below the task timeout
+FANOUT_STALE_AFTER = datetime.timedelta(minutes=10)
+
+def enqueue_discount_fanout(job_id):
+    queue = functions.task_queue("locations/asia-southeast2/functions/run_discount_fanout")  # the task function is deployed in asia-southeast2, not the default us-central1
+    queue.enqueue({'job_id': job_id})
+
+def start_discount_fanout(discount_id):
+    job_ref = db.collection('discount_jobs').document()
+    job_ref.set({
+        'id': job_ref.id,
+        'discount_id': discount_id,
+        'status': 'PENDING',
+        'cursor': None,
+        'processed': 0,
+        'updated': 0,
+        'created_at': firestore.SERVER_TIMESTAMP,
+        'updated_at': firestore.SERVER_TIMESTAMP
+    })
+    enqueue_discount_fanout(job_ref.id)
+    return job_ref.id
+
+def process_discount_fanout(job_id):
+    """
+    Runs (or resumes) a fan-out job from its checkpoint until done or out of time.
+    Returns True when the job finished. Re-applying a page is harmless, so a crash
+    between a commit and its checkpoint only repeats that page.
+    """
+    job_ref = db.collection('discount_jobs').document(job_id)
+    job_snap = job_ref.get()
+    if not job_snap.exists: return True
+    job = job_snap.to_dict()
+    if job.get('status') in ('DONE', 'FAILED'): return True
+
+    discount_id = job['discount_id']
+    rule_snap = db.collection('discounts').document(discount_id).get()
+    if not rule_snap.exists:
+        job_ref.update({'status': 'DONE', 'note': 'Discount deleted', 'updated_at': firestore.SERVER_TIMESTAMP})
+        return True
+    # Always apply the rule's current name/value, so an older job can't overwrite a newer edit
+    rule = rule_snap.to_dict()
+
+    job_ref.update({'status': 'RUNNING', 'updated_at': firestore.SERVER_TIMESTAMP})
+    started = time.monotonic()
+    cursor = job.get('cursor')
+    processed, updated = job.get('processed', 0), job.get('updated', 0)
+
+    while time.monotonic() - started < FANOUT_TIME_BUDGET:
+        query = (db.collection('products')
+                 .where('discount_ids', 'array_contains', discount_id)
+                 .order_by('__name__')
+                 .select(['discounts', 'retail_price_idr', 'nett_price_manual'])
+                 .limit(FANOUT_PAGE_SIZE))
+        if cursor: query = query.start_after(db.collection('products').document(cursor))
+        docs = list(query.stream())
+
+        ops = []
         for doc in docs:
-            d = doc.to_dict()
-            d['id'] = doc.id
-            discounts.append(serialize_doc(d))
-        return https_fn.Response(json.dumps({'data': discounts}), status=200, headers=headers, mimetype='application/json')
+            prod = doc.to_dict()
+            discounts = prod.get('discounts', [])
+            changed = False
+            for d in discounts:
+                if d.get('id') == discount_id and (d.get('name') != rule.get('name') or d.get('value') != rule.get('value')):
+                    d['name'] = rule.get('name')
+                    d['value'] = rule.get('value')
+                    changed = True
+            if changed:
+                update = {'discounts': discounts, 'updated_at': firestore.SERVER_TIMESTAMP}
+                # A hand-entered nett stays as entered
+                if not prod.get('nett_price_manual'): update['nett_price_idr'] = compute_nett_price(prod.get('retail_price_idr', 0), discounts)
+                ops.append(('update', doc.reference, update))
+
+        results = commit_chunks_parallel([{'keys': [], 'ops': chunk} for chunk in split_ops(ops)])
+        failed = [r['error'] for r in results if r['status'] == 'failed']
+        if failed:
+            job_ref.update({'status': 'FAILED', 'error': failed[0], 'updated_at': firestore.SERVER_TIMESTAMP})
+            return True
+
+        processed += len(docs)
+        updated += len(ops)
+        if docs: cursor = docs[-1].id
+        done = len(docs) < FANOUT_PAGE_SIZE
+        job_ref.update({
+            'cursor': cursor,
+            'processed': processed,
+            'updated': updated,
+            'status': 'DONE' if done else 'RUNNING',
+            'updated_at': firestore.SERVER_TIMESTAMP
+        })
+        if done: return True
+    return False
+
+@tasks_fn.on_task_dispatched(
+    retry_config=RetryConfig(max_attempts=5, min_backoff_seconds=30),
+    rate_limits=RateLimits(max_concurrent_dispatches=2),
+    region="asia-southeast2",
+    timeout_sec=300
+)
+@instrumented
+def run_discount_fanout(req: tasks_fn.CallableRequest) -> None:
+    job_id = req.data.get('job_id')
+    if job_id and not process_discount_fanout(job_id):
+        enqueue_discount_fanout(job_id)
+
+@scheduler_fn.on_schedule(schedule="every 10 minutes", region="asia-southeast2")
+@instrumented
+def resume_stalled_discount_jobs(event: scheduler_fn.ScheduledEvent) -> None:
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - FANOUT_STALE_AFTER
+    for status in ('PENDING', 'RUNNING'):
+        for doc in db.collection('discount_jobs').where('status', '==', status).stream():
+            if doc.to_dict().get('updated_at') and doc.to_dict()['updated_at'] < cutoff:
+                enqueue_discount_fanout(doc.id)
+
+@https_fn.on_request(region="asia-southeast2")
+@instrumented
+@endpoint('GET')
+def get_discount_job(req: https_fn.Request) -> https_fn.Response:
+    job_id = req.args.get('job_id')
+    if not job_id: return https_fn.Response("Missing job_id", status=400)
+
+    try:
+        doc = db.collection('discount_jobs').document(job_id).get()
+        if not doc.exists: return https_fn.Response("Job not found", status=404)
+        return https_fn.Response(dumps({'data': doc.to_dict()}), status=200, mimetype='application/json')
     except Exception as e:
-        return https_fn.Response(str(e), status=500, headers=headers)
+        return https_fn.Response(str(e), status=500)
+
+# --- DISCOUNTS ---
 
 @https_fn.on_request(region="asia-southeast2")
-def manage_discount(req: https_fn.Request) -> https_fn.Response:
-    headers = {'Access-Control-Allow-Origin': '*', 'Access-Control-Allow-Methods': 'POST', 'Access-Control-Allow-Headers': 'Content-Type'}
-    if req.method == 'OPTIONS': return https_fn.Response('', status=204, headers=headers)
+@instrumented
+@endpoint('GET', cache_control='no-cache')
+def get_discounts(req: https_fn.Request) -> https_fn.Response:
+    try:
+        return https_fn.Response(dumps({'data': get_discount_rules()}), status=200, mimetype='application/json')
+    except Exception as e:
+        return https_fn.Response(str(e), status=500)
 
+@https_fn.on_request(region="asia-southeast2")
+@instrumented
+@endpoint('POST')
+def manage_discount(req: https_fn.Request) -> https_fn.Response:
     try:
         data = req.get_json()
         mode = data.get('mode')
         discount_data = data.get('discount')
         
-        if not discount_data: return https_fn.Response("Missing data", status=400, headers=headers)
+        if not discount_data: return https_fn.Response("Missing data", status=400)
         discount_id = discount_data.get('id')
 
         if mode == 'DELETE':
-            if discount_id: db.collection('discounts').document(discount_id).delete()
-            return https_fn.Response(json.dumps({'success': True}), status=200, headers=headers, mimetype='application/json')
+            if discount_id:
+                db.collection('discounts').document(discount_id).delete()
+                invalidate_cache('discounts')
+            return https_fn.Response(json.dumps({'success': True}), status=200, mimetype='application/json')
 
         if not discount_id:
              discount_id = str(uuid.uuid4())
@@ -79,45 +332,25 @@ def manage_discount(req: https_fn.Request) -> https_fn.Response:
         
         target_name = discount_data.get('name', '').strip()
         if target_name:
-            existing = db.collection('discounts').where('name', '==', target_name).stream()
-            for doc in existing:
-                if doc.id != discount_id:
-                    return https_fn.Response(f"Error: Discount name '{target_name}' already exists.", status=400, headers=headers)
+            existing_id = find_discount_by_name(target_name)
+            if existing_id and existing_id != discount_id:
+                return https_fn.Response(f"Error: Discount name '{target_name}' already exists.", status=400)
 
         discount_data['value'] = float(discount_data.get('value', 0))
         discount_data['is_active'] = bool(discount_data.get('is_active', True))
 
-        db.collection('discounts').document(discount_id).set(discount_data, merge=True)
-
-        if mode == 'EDIT':
-            # Update all products using this discount (Batch Operation)
-            affected_products = db.collection('products').where('discount_ids', 'array_contains', discount_id).stream()
-            batch = db.batch()
-            batch_count = 0
-            for doc in affected_products:
-                prod = doc.to_dict()
-                discounts = prod.get('discounts', [])
-                updated = False
-                for d in discounts:
-                    if d.get('id') == discount_id:
-                        d['name'] = discount_data['name']
-                        d['value'] = discount_data['value']
-                        updated = True
-                
-                if updated:
-                    retail = prod.get('retail_price_idr', 0)
-                    current_price = retail
-                    for d in discounts:
-                        val = float(d.get('value', 0))
-                        current_price = current_price * ((100 - val) / 100)
-                    
-                    batch.update(doc.reference, {'discounts': discounts, 'nett_price_idr': int(current_price)})
-                    batch_count += 1
-                
-                if batch_count >= 400:
-                    batch.commit(); batch = db.batch(); batch_count = 0
-            if batch_count > 0: batch.commit()
-
-        return https_fn.Response(json.dumps({'success': True, 'id': discount_id}), status=200, headers=headers, mimetype='application/json')
+        discount_ref = db.collection('discounts').document(discount_id)
+        previous = discount_ref.get()
+        discount_ref.set(discount_data, merge=True)
+        invalidate_cache('discounts')
+
+        job_id = None
+        if mode == 'EDIT' and previous.exists:
+            # Products only embed name/value, so other edits need no fan-out
+            before = previous.to_dict()
+            if before.get('name') != discount_data.get('name') or float(before.get('value', 0)) != discount_data['value']:
+                job_id = start_discount_fanout(discount_id)
+
+        return https_fn.Response(json.dumps({'success': True, 'id': discount_id, 'job_id': job_id}), status=200, mimetype='application/json')
     except Exception as e:
-        return https_fn.Response(str(e), status=500, headers=headers)
\ No newline at end of file
+        return https_fn.Response(str(e), status=500)
\ No newline at end of file
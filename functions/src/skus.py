@@ -0,0 +1,67 @@
+from firebase_admin import firestore
+from .config import db
+from .utils import get_4char_segment
+
+# One counter doc per 'BRND-CATG-COLL' prefix: sku_counters/{base_sku} = {'next': n}
+# Allocation 0 is the bare base SKU; allocation n >= 1 is base_sku + two or more digits
+# (e.g. SLAM-POLA-TUBA, SLAM-POLA-TUBA01, SLAM-POLA-TUBA02).
+# The suffixed form is 16+ characters, so it can never equal another prefix's base SKU.
+SKU_COUNTERS = 'sku_counters'
+
+def build_base_sku(brand, category, collection):
+    return f"{get_4char_segment(brand)}-{get_4char_segment(category)}-{get_4char_segment(collection)}"
+
+def format_sku(base_sku, index):
+    return base_sku if index == 0 else f"{base_sku}{str(index).zfill(2)}"
+
+def parse_sku_index(code, base_sku):
+    """Returns the allocation index of an existing code under base_sku, or None."""
+    if code == base_sku: return 0
+    suffix = code[len(base_sku):] if code and code.startswith(base_sku) else ''
+    return int(suffix) if suffix.isdigit() else None
+
+def seed_counter_from_catalog(transaction, base_sku):
+    """
+    First allocation for a prefix created before counters existed: start after
+    the highest index already in use. Runs once per prefix, never again.
+    """
+    query = db.collection('products').where('code', '>=', base_sku).where('code', '<=', base_sku + '\uf8ff').select(['code'])
+    docs = transaction.get(query) if transaction is not None else query.stream()
+    used = [parse_sku_index(doc.to_dict().get('code'), base_sku) for doc in docs]
+    used = [i for i in used if i is not None]
+    return max(used) + 1 if used else 0
+
+@firestore.transactional
+def reserve_sku_range(transaction, base_sku, count):
+    """
+    Atomically reserves `count` consecutive allocations for a prefix.
+    Costs one read and one write on the counter doc. Returns the SKUs.
+    """
+    counter_ref = db.collection(SKU_COUNTERS).document(base_sku)
+    snap = counter_ref.get(transaction=transaction)
+    start = snap.to_dict().get('next', 0) if snap.exists else seed_counter_from_catalog(transaction, base_sku)
+    transaction.set(counter_ref, {'next': start + count, 'updated_at': firestore.SERVER_TIMESTAMP})
+    return [format_sku(base_sku, i) for i in range(start, start + count)]
+
+def allocate_sku(base_sku):
+    return reserve_sku_range(db.transaction(), base_sku, 1)[0]
+
+def reserve_skus(counts):
+    """
+    Bulk reservation for imports: counts = {base_sku: n}.
+    Returns {base_sku: [sku, ...]}, one transaction per prefix.
+    """
+    return {base_sku: reserve_sku_range(db.transaction(), base_sku, n) for base_sku, n in counts.items() if n > 0}
+
+def peek_skus(counts):
+    """
+    Same result shape as reserve_skus but read-only, for dry runs.
+    The SKUs are what a reservation would return right now, not a guarantee.
+    """
+    preview = {}
+    for base_sku, n in counts.items():
+        if n <= 0: continue
+        snap = db.collection(SKU_COUNTERS).document(base_sku).get()
+        start = snap.to_dict().get('next', 0) if snap.exists else seed_counter_from_catalog(None, base_sku)
+        preview[base_sku] = [format_sku(base_sku, i) for i in range(start, start + n)]
+    return preview
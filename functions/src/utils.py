@@ -1,21 +1,85 @@
+import base64
 import datetime
+import decimal
+import itertools
+import json
 import re
-import random
+from google.cloud.firestore_v1 import DocumentReference, GeoPoint
+from .metrics import phase
 
-def serialize_doc(doc_dict):
+try:
+    import orjson
+except ImportError:  # optional, roughly 3-5x faster encoding when installed
+    orjson = None
+
+# --- JSON ENCODING ---
+# Firestore documents go straight to JSON in one pass: dumps() hands every value
+# the encoder doesn't know natively to json_default, so nothing is copied or
+# mutated beforehand. Datetimes (including DatetimeWithNanoseconds) become ISO strings.
+STREAM_BATCH = 500
+
+def json_default(value):
+    """Converts one non-JSON value (Firestore and numpy types) to a JSON-friendly one."""
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)): return value.isoformat()
+    if isinstance(value, DocumentReference): return value.path
+    if isinstance(value, GeoPoint): return {'latitude': value.latitude, 'longitude': value.longitude}
+    if isinstance(value, bytes): return base64.b64encode(value).decode('ascii')
+    if isinstance(value, decimal.Decimal): return float(value)
+    if isinstance(value, (set, frozenset)): return list(value)
+    if hasattr(value, 'item') and hasattr(value, 'dtype'): return value.item()  # numpy scalars
+    if hasattr(value, 'to_map_value'): return list(value)  # firestore Vector
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def dumps(obj):
+    """Encodes obj to a JSON string, using orjson when it is installed."""
+    with phase('serialize'):
+        if orjson is not None:
+            return orjson.dumps(obj, default=json_default, option=orjson.OPT_PASSTHROUGH_DATETIME).decode()
+        return json.dumps(obj, default=json_default)
+
+def iter_json(obj, batch_size=STREAM_BATCH):
     """
-    Converts Firestore types (like datetime) to JSON serializable formats.
-    Used recursively for nested dictionaries and lists.
+    Yields the JSON text of obj in pieces, for streamed responses. Lists and
+    generators (at the top level or as dict values) are encoded batch_size
+    items at a time, so a generator of documents is never held in memory.
     """
-    if not doc_dict: return {}
-    for key, value in doc_dict.items():
-        if isinstance(value, datetime.datetime):
-            doc_dict[key] = value.isoformat()
-        if isinstance(value, list):
-            for item in value:
-                if isinstance(item, dict):
-                    serialize_doc(item)
-    return doc_dict
+    if isinstance(obj, dict):
+        yield '{'
+        for n, (key, value) in enumerate(obj.items()):
+            yield (',' if n else '') + dumps(str(key)) + ':'
+            yield from iter_json(value, batch_size)
+        yield '}'
+    elif isinstance(obj, (list, tuple)) or hasattr(obj, '__next__'):
+        yield '['
+        items = iter(obj)
+        first = True
+        while True:
+            part = dumps(list(itertools.islice(items, batch_size)))[1:-1]
+            if not part: break
+            yield part if first else ',' + part
+            first = False
+        yield ']'
+    else:
+        yield dumps(obj)
+
+# --- SEARCH KEYWORDS ---
+# Products carry an inverted index in search_keywords: for every whitespace token
+# of the searchable fields, its 1-2 character prefixes (the whole token if shorter)
+# and all of its trigrams. Any substring of 3+ characters therefore shares its
+# first trigram with the index, and shorter queries match token starts.
+SEARCH_FIELDS = ('brand', 'category', 'collection', 'code', 'manufacturer_code')
+SEARCH_INDEX_FIELD = 'search_keywords'
+
+def search_text(product):
+    """Lower-cased searchable text of a product, the same string the client filters on."""
+    return ' '.join(str(product.get(f) or '') for f in SEARCH_FIELDS).lower()
+
+def build_search_keywords(product):
+    keywords = set()
+    for token in search_text(product).split():
+        keywords.update(token[:n] for n in (1, 2))
+        keywords.update(token[i:i + 3] for i in range(len(token) - 2))
+    return sorted(keywords)
 
 def get_4char_segment(text):
     """
@@ -36,27 +100,3 @@ def get_4char_segment(text):
         code = code.ljust(4, '1')
         
     return code
-
-def resolve_sku_collision(base_sku, existing_skus):
-    """
-    Ensures the generated SKU is unique.
-    If 'ABCD-EFGH-IJKL' exists, it tries 'ABCD-EFGH-IJK1', etc.
-    """
-    if base_sku not in existing_skus:
-        return base_sku
-    
-    parts = base_sku.split('-')
-    if len(parts) < 3: return f"{base_sku}-01"
-    
-    name_part = parts[2]
-    prefix = f"{parts[0]}-{parts[1]}"
-    base_name = name_part[:3]
-    
-    for i in range(1, 10):
-        candidate_name = f"{base_name}{i}"
-        candidate_sku = f"{prefix}-{candidate_name}"
-        if candidate_sku not in existing_skus:
-            return candidate_sku
-            
-    # Fallback to random suffix if 1-9 are taken
-    return f"{base_sku}{random.randint(10,99)}"
\ No newline at end of file
@@ -0,0 +1,52 @@
+import datetime
+import os
+
+import pytest
+
+# The Firestore client only needs a project id to build references; nothing here talks to it
+os.environ.setdefault('GCLOUD_PROJECT', 'demo-test')
+os.environ.setdefault('FIRESTORE_EMULATOR_HOST', 'localhost:8080')
+pytest.importorskip('firebase_functions')
+pytest.importorskip('firebase_admin')
+
+from src.config import db
+from src.inventory import HISTORY_RECENT, append_history, history_event_id
+
+
+class RecordingWriter:
+    def __init__(self):
+        self.writes = {}
+
+    def set(self, ref, data):
+        self.writes[ref.id] = data
+
+
+def make_events(count):
+    start = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    return [{'action': 'MOVED', 'date': start + datetime.timedelta(minutes=n), 'note': f'event {n}'} for n in range(count)]
+
+
+def test_unmigrated_log_at_exact_limit_keeps_trimmed_event():
+    item_ref = db.collection('inventory_items').document('item-1')
+    embedded = make_events(HISTORY_RECENT)
+    event = make_events(HISTORY_RECENT + 1)[-1]
+    writer = RecordingWriter()
+
+    recent = append_history(writer, item_ref, event, embedded)
+
+    assert recent == embedded[1:] + [event]
+    # The oldest embedded event leaves history_log, so it must land in the sub-collection
+    assert history_event_id(embedded[0]) in writer.writes
+    assert history_event_id(event) in writer.writes
+
+
+def test_short_log_only_writes_new_event():
+    item_ref = db.collection('inventory_items').document('item-2')
+    embedded = make_events(3)
+    event = make_events(4)[-1]
+    writer = RecordingWriter()
+
+    recent = append_history(writer, item_ref, event, embedded)
+
+    assert recent == embedded + [event]
+    assert list(writer.writes) == [history_event_id(event)]